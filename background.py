@@ -10,7 +10,8 @@ import scipy.sparse as sparse
 from scipy.ndimage import label
 import astropy.io.fits as pyfits
 
-from helper_functions import polyfit2d, polyval2d, fit_poly_surface_2D
+from helper_functions import polyfit2d, polyfit2d_normal, polyval2d, polyval2d_grid, fit_poly_surface_2D, eval_poly_surface_2D_grid
+from order_tracing import get_stripe_window_bounds
 
 
 # #make simulated background
@@ -31,7 +32,7 @@ from helper_functions import polyfit2d, polyval2d, fit_poly_surface_2D
 
 
 
-def remove_background(img, P_id, obsname, path, degpol=5, slit_height=25, save_bg=True, savefile=True, save_err=False, exclude_top_and_bottom=False, verbose=True, timit=False):
+def remove_background(img, P_id, obsname, path, degpol=5, slit_height=25, save_bg=True, savefile=True, save_err=False, exclude_top_and_bottom=False, robust=False, err_img=None, verbose=True, timit=False):
     """
     Top-level wrapper function to identify, extract, fit, and subtract the background for a given image.
     
@@ -46,6 +47,8 @@ def remove_background(img, P_id, obsname, path, degpol=5, slit_height=25, save_b
     'savefile'                : boolean - do you want to save the background-corrected science image?
     'save_err'                : boolean - do you want to save the corresponding error array as well? (remains unchanged though)
     'exclude_top_and_bottom'  : boolean - do you want to exclude the areas at top and bottom of chip, ie outside the useful orders but still containing some incomplete orders?
+    'robust'                  : boolean - do you want to use the robust (box-median, weighted, sigma-clipped) background fit? (see "fit_background_robust")
+    'err_img'                 : estimated uncertainties in the input image (only used for the weights in the robust fit; if None, the scatter within the boxes is used)
     'verbose'                 : for user information / debugging...
     'timit'                   : boolean - do you want to measure execution run time?
     
@@ -57,9 +60,9 @@ def remove_background(img, P_id, obsname, path, degpol=5, slit_height=25, save_b
         start_time = time.time()
     
     #(1) identify and extract background
-    bg = extract_background(img, P_id, slit_height=slit_height, exclude_top_and_bottom=exclude_top_and_bottom, verbose=verbose, timit=timit)
+    bg = extract_background_pixels(img, P_id, slit_height=slit_height, exclude_top_and_bottom=exclude_top_and_bottom, verbose=verbose, timit=timit)
     #(2) fit background
-    bg_coeffs,bg_img = fit_background(bg, deg=degpol, return_full=True, timit=timit)
+    bg_coeffs,bg_img = fit_background(bg, deg=degpol, return_full=True, robust=robust, err=err_img, timit=timit)
     #(3) subtract background
     corrected_image = img - bg_img
     #what about errors??????
@@ -148,25 +151,59 @@ def extract_background(img, P_id, slit_height=25, return_mask=False, exclude_top
         print('Extracting background...')
 
     ny, nx = img.shape
-    xx = np.arange(nx, dtype='f8')
-    yy = np.arange(ny, dtype='f8')
-    x_grid, y_grid = np.meshgrid(xx, yy, copy=False)
-    bg_mask = np.ones((ny, nx), dtype=bool)
+    final_bg_mask = get_background_mask(P_id, ny, nx, slit_height=slit_height, exclude_top_and_bottom=exclude_top_and_bottom)
+    
+    rows, cols = np.nonzero(final_bg_mask)
+    mat = sparse.coo_matrix((img[rows, cols], (rows, cols)), shape=(ny, nx))
+    # return mat.tocsr()
+    
+    if timit:
+        print('Elapsed time: ',time.time() - start_time,' seconds')
+    
+    if not return_mask:
+        return mat.tocsc()
+    else:
+        return mat.tocsc(), final_bg_mask
+
+
 
+
+
+def get_background_mask(P_id, ny, nx, slit_height=25, exclude_top_and_bottom=False):
+    """
+    Creates the mask of the background (ie the inter-order regions = everything outside the order stripes) directly from the
+    first and last rows of the stripes in each column (from "get_stripe_window_bounds", ie exactly the same rows as for the stripes),
+    ie without creating any full-frame coordinate grids or distance arrays. The stripes are "painted" into a difference array (+1 at the lower bound, -1 above the upper bound of each stripe in each column),
+    so that the cumulative sum along the columns is non-zero only within the stripes. This is O(n_orders * nx).
+    
+    INPUT:
+    'P_id'                    : dictionary of the form of {order: np.poly1d} (as returned by make_P_id / identify_stripes)
+    'ny'                      : number of rows of the image
+    'nx'                      : number of columns of the image
+    'slit_height'             : half the total slit height in pixels
+    'exclude_top_and_bottom'  : boolean - do you want to exclude the top and bottom bits (where there are usually incomplete orders)
+    
+    OUTPUT:
+    'bg_mask'  : boolean array containing the location of what is considered background (ie the inter-order space)
+    """
+    
+    xx = np.arange(nx)
+    diff = np.zeros((ny + 1, nx), dtype=np.int16)
+    
     for o, p in sorted(P_id.items()):
-        
         #order trace
-        y = np.poly1d(p)(xx)
-        
-        #distance from order trace
-        distance = y_grid - y.repeat(ny).reshape((nx, ny)).T
-        indices = abs(distance) > slit_height
-        
-        #include in global mask
-        bg_mask *= indices
-        
+        y = np.poly1d(p)(xx.astype('f8'))
+        #pixels within slit_height of the order trace are NOT background (using the same rows as for the stripes, ie
+        #abs(row - p(x)) <= slit_height with exactly the same floating-point comparison; see "get_stripe_window_bounds")
+        first, last = get_stripe_window_bounds(y, slit_height=slit_height)
+        lower = np.clip(first.astype(int), 0, ny)
+        upper = np.clip(last.astype(int) + 1, 0, ny)
+        onchip = upper > lower
+        np.add.at(diff, (lower[onchip], xx[onchip]), 1)
+        np.add.at(diff, (upper[onchip], xx[onchip]), -1)
+    
+    bg_mask = np.cumsum(diff[:-1,:], axis=0) == 0
     
-    final_bg_mask = bg_mask.copy()
     #in case we want to exclude the top and bottom parts where incomplete orders are located
     if exclude_top_and_bottom:
         print('WARNING: this fix works for the current Veloce CCD layout only!!!')
@@ -176,54 +213,97 @@ def extract_background(img, P_id, slit_height=25, return_mask=False, exclude_top
         toprightnumber = labelled_mask[ny-1,nx-1]
         #bottomleftnumber = labelled_mask[0,0]
         bottomrightnumber = labelled_mask[0,nx-1]
-        final_bg_mask[labelled_mask == topleftnumber] = False
-        final_bg_mask[labelled_mask == toprightnumber] = False
-        final_bg_mask[labelled_mask == bottomrightnumber] = False
+        bg_mask[np.isin(labelled_mask, [topleftnumber, toprightnumber, bottomrightnumber])] = False
     
+    return bg_mask
+
+
+
+
+
+def extract_background_pixels(img, P_id, slit_height=25, return_mask=False, exclude_top_and_bottom=False, verbose=True, timit=False):
+    """
+    Same as "extract_background", but rather than a sparse matrix it returns the coordinates and values of the background pixels
+    (ie the inter-order regions = everything outside the order stripes), which can be passed straight to "fit_background".
     
-    mat = sparse.coo_matrix((img[final_bg_mask], (y_grid[final_bg_mask], x_grid[final_bg_mask])), shape=(ny, nx))
-    # return mat.tocsr()
+    INPUT:
+    'img'                     : 2D echelle spectrum [np.array]
+    'P_id'                    : dictionary of the form of {order: np.poly1d} (as returned by make_P_id / identify_stripes)
+    'slit_height'             : half the total slit height in pixels
+    'return_mask'             : boolean - do you want to return the mask of the background locations as well?
+    'exclude_top_and_bottom'  : boolean - do you want to exclude the top and bottom bits (where there are usually incomplete orders)
+    'verbose'                 : for user info / debugging...
+    'timit'                   : for timing tests...
+    
+    OUTPUT:
+    'bg'       : dictionary containing the row indices ('rows'), column indices ('cols') and values ('z') of the background pixels, 
+                 as well as the shape of the image ('shape')
+    'bg_mask'  : boolean array containing the location of what is considered background (ie the inter-order space)
+    """
+    
+    if timit:
+        start_time = time.time()
+    
+    if verbose:
+        print('Extracting background...')
+    
+    ny, nx = img.shape
+    bg_mask = get_background_mask(P_id, ny, nx, slit_height=slit_height, exclude_top_and_bottom=exclude_top_and_bottom)
+    
+    rows, cols = np.nonzero(bg_mask)
+    bg = {'rows':rows, 'cols':cols, 'z':img[rows, cols], 'shape':(ny, nx)}
     
     if timit:
         print('Elapsed time: ',time.time() - start_time,' seconds')
     
     if not return_mask:
-        return mat.tocsc()
+        return bg
     else:
-        return mat.tocsc(), final_bg_mask
+        return bg, bg_mask
 
 
 
 
 
-def fit_background(bg, deg=5, return_full=True, timit=False):
+def fit_background(bg, deg=5, return_full=True, robust=False, err=None, timit=False, **kwargs):
     """ 
     
     INPUT:
-    'bg'                      : sparse matrix containing the inter-order regions of the 2D image
+    'bg'                      : sparse matrix containing the inter-order regions of the 2D image (from "extract_background"), or
+                                dictionary containing the coordinates and values of the background pixels (from "extract_background_pixels")
     'deg'                     : the order of the polynomials to use in the fit (for both dimensions)
     'return_full'             : boolean - if TRUE, then the full image of the background model is returned; otherwise just the set of coefficients that describe it
+    'robust'                  : boolean - if TRUE, then the robust box-median / weighted / sigma-clipped fit from "fit_background_robust" is used instead
+    'err'                     : estimated uncertainties in the 2D image (only used if 'robust' is set to TRUE)
     'timit'                   : time it...
+    **kwargs                  : are passed on to "fit_background_robust" (only used if 'robust' is set to TRUE)
     
     OUTPUT:
     'coeffs'    : polynomial coefficients that describe the background model
     'bkgd_img'  : full background image constructed from best-fit model (only if 'return_full' is set to TRUE)
     
     TODO:
-    figure out how to properly use weights here
+    figure out how to properly use weights here (see "fit_background_robust")
     """
     
+    if robust:
+        return fit_background_robust(bg, deg=deg, return_full=return_full, err=err, timit=timit, **kwargs)
+    
     if timit:
         start_time = time.time()
         
-    #find the non-zero parts of the sparse matrix
-    #format is:
-    #contents[0] = row indices
-    #contents[1] = column indices
-    #contents[2] = values
-    contents = sparse.find(bg)
-    
-    ny, nx = bg.todense().shape
+    if isinstance(bg, dict):
+        #coordinates and values of the background pixels from "extract_background_pixels"
+        contents = (bg['rows'], bg['cols'], bg['z'])
+        ny, nx = bg['shape']
+    else:
+        #find the non-zero parts of the sparse matrix
+        #format is:
+        #contents[0] = row indices
+        #contents[1] = column indices
+        #contents[2] = values
+        contents = sparse.find(bg)
+        ny, nx = bg.shape
     
     #re-normalize to [-1,+1] - otherwise small errors in parms have huge effects
     x_norm = (contents[0] / ((nx-1)/2.)) - 1.
@@ -232,7 +312,8 @@ def fit_background(bg, deg=5, return_full=True, timit=False):
     
     
     #m = polyfit2d(contents[0]-int(ny/2), contents[1]-int(nx/2), contents[2], order=deg)
-    coeffs = polyfit2d(x_norm, y_norm, z, order=deg)
+    #accumulate the normal equations in chunks, rather than building the full design matrix (which can be several GB)
+    coeffs = polyfit2d_normal(x_norm, y_norm, z, order=deg)
     #The result (m) is an array of the polynomial coefficients in the model f  = sum_i sum_j a_ij x^i y^j, 
     #eg:    m = [a00,a01,a02,a03,a10,a11,a12,a13,a20,.....,a33] for order=3
     
@@ -246,9 +327,10 @@ def fit_background(bg, deg=5, return_full=True, timit=False):
         xxn = (xx / ((nx-1)/2.)) - 1.
         yy = np.arange(ny)
         yyn = (yy / ((ny-1)/2.)) - 1.
-        X,Y = np.meshgrid(xxn,yyn)
         #bkgd_img = polyval2d(X,Y,coeffs)
-        bkgd_img = polyval2d(Y,X,coeffs)    #IDKY, but the indices are the wrong way around if I do it like in the line above!!!!! 
+        #bkgd_img = polyval2d(Y,X,coeffs)    #IDKY, but the indices are the wrong way around if I do it like in the line above!!!!! 
+        #same as polyval2d(Y,X,coeffs) with X,Y = np.meshgrid(xxn,yyn), but exploiting separability
+        bkgd_img = np.ascontiguousarray(polyval2d_grid(yyn, xxn, coeffs).T)
     
     if timit:
         print('Time taken for constructing full background image: '+np.round(time.time() - start_time_2,2).astype(str)+' seconds...')
@@ -263,12 +345,120 @@ def fit_background(bg, deg=5, return_full=True, timit=False):
  
  
  
+def fit_background_robust(bg, deg=5, boxsize=16, clip=3., maxiter=10, min_npix=10, err=None, return_full=True, timit=False, debug_level=0):
+    """ 
+    Robust version of "fit_background". Rather than doing a single unweighted fit to every single inter-order pixel, the background pixels are 
+    binned into boxes of (boxsize x boxsize) pixels, and the median in each box is used in a weighted fit (with inverse-variance weights for
+    the box medians). This is iterated, and outliers (eg from cosmic rays or small-scale scattered-light structure) are sigma-clipped, until
+    no more boxes are rejected (or 'maxiter' is reached). The coordinates are normalized in exactly the same way as in "fit_background", 
+    so the coefficients are interchangeable.
+    
+    INPUT:
+    'bg'           : sparse matrix containing the inter-order regions of the 2D image (from "extract_background"), or
+                     dictionary containing the coordinates and values of the background pixels (from "extract_background_pixels")
+    'deg'          : the order of the polynomials to use in the fit (for both dimensions)
+    'boxsize'      : size of the boxes (in pixels) in which the medians are calculated
+    'clip'         : threshold for the sigma-clipping of the box medians (in units of the robust scatter of the normalized residuals)
+    'maxiter'      : maximum number of clipping iterations
+    'min_npix'     : minimum number of background pixels in a box for it to be used (if there are fewer than (deg+1)**2 usable boxes,
+                     the plain least-squares fit from "fit_background" is used instead)
+    'err'          : estimated uncertainties in the 2D image (if None, the variances of the box medians are estimated from the scatter within each box)
+    'return_full'  : boolean - if TRUE, then the full image of the background model is returned; otherwise just the set of coefficients that describe it
+    'timit'        : time it...
+    'debug_level'  : for debugging...
+    
+    OUTPUT:
+    'coeffs'    : polynomial coefficients that describe the background model
+    'bkgd_img'  : full background image constructed from best-fit model (only if 'return_full' is set to TRUE)
+    """
+    
+    if timit:
+        start_time = time.time()
+    
+    if isinstance(bg, dict):
+        #coordinates and values of the background pixels from "extract_background_pixels"
+        contents = (bg['rows'], bg['cols'], bg['z'])
+        ny, nx = bg['shape']
+    else:
+        #find the non-zero parts of the sparse matrix
+        contents = sparse.find(bg)
+        ny, nx = bg.shape
+    rows, cols, z = contents
+    
+    #assign each pixel to a box
+    nbx = int(np.ceil(nx / float(boxsize)))
+    boxid = (rows // boxsize) * nbx + (cols // boxsize)
+    
+    #sort by box, and by value within each box
+    srt = np.lexsort((z, boxid))
+    boxid = boxid[srt]
+    z_srt = z[srt]
+    boxes, first, npix = np.unique(boxid, return_index=True, return_counts=True)
+    
+    #median in each box (from the sorted values)
+    med = 0.5 * (z_srt[first + (npix-1)//2] + z_srt[first + npix//2])
+    
+    #estimate variance of the box medians, ie var(median) ~ (pi/2) * sigma**2 / N
+    if err is not None:
+        sigsq = np.bincount(boxid, weights=err[rows[srt], cols[srt]]**2)[boxes] / npix
+    else:
+        #robust estimate of the scatter within each box from the median absolute deviation
+        absdev = np.abs(z_srt - np.repeat(med, npix))
+        absdev_srt = absdev[np.lexsort((absdev, boxid))]
+        mad = 0.5 * (absdev_srt[first + (npix-1)//2] + absdev_srt[first + npix//2])
+        sigsq = (1.4826 * mad)**2
+    var_med = (np.pi / 2.) * sigsq / npix
+    
+    #mean coordinates of the background pixels in each box
+    row_box = np.bincount(boxid, weights=rows[srt])[boxes] / npix
+    col_box = np.bincount(boxid, weights=cols[srt])[boxes] / npix
+    
+    #re-normalize to [-1,+1] (same as in "fit_background")
+    x_norm = (row_box / ((nx-1)/2.)) - 1.
+    y_norm = (col_box / ((ny-1)/2.)) - 1.
+    
+    good = (npix >= min_npix) & (var_med > 0) & np.isfinite(med) & np.isfinite(var_med)
+    if np.sum(good) < (deg+1)**2:
+        print('WARNING: not enough good boxes for the robust background fit - using the plain least-squares fit to all background pixels instead!!!')
+        return fit_background(bg, deg=deg, return_full=return_full, robust=False, timit=timit)
+    w = np.zeros(len(med))
+    w[good] = 1. / var_med[good]
+    
+    for i in range(maxiter):
+        coeffs = polyfit2d_normal(x_norm[good], y_norm[good], med[good], order=deg, weights=w[good])
+        #normalized residuals
+        resid = (med - polyval2d(x_norm, y_norm, coeffs)) * np.sqrt(w)
+        rms = 1.4826 * np.median(np.abs(resid[good] - np.median(resid[good])))
+        newgood = good & (np.abs(resid) <= clip * rms)
+        if debug_level >= 1:
+            print('iteration '+str(i+1)+': '+str(np.sum(good) - np.sum(newgood))+' boxes rejected')
+        if np.sum(newgood) == np.sum(good) or np.sum(newgood) < (deg+1)**2:
+            break
+        good = newgood
+    
+    if timit:
+        print('Time taken for fitting background model: '+np.round(time.time() - start_time,2).astype(str)+' seconds...')
+    
+    if return_full:
+        xxn = (np.arange(nx) / ((nx-1)/2.)) - 1.
+        yyn = (np.arange(ny) / ((ny-1)/2.)) - 1.
+        #same as polyval2d(Y,X,coeffs) with X,Y = np.meshgrid(xxn,yyn) (see "fit_background")
+        bkgd_img = np.ascontiguousarray(polyval2d_grid(yyn, xxn, coeffs).T)
+        return coeffs, bkgd_img
+    else:
+        return coeffs
+ 
+ 
+ 
+ 
+ 
 def fit_background_astropy(bg, poly_deg=5, polytype='chebyshev', return_full=True, timit=False):
     """ 
     WARNING: While this works just fine, it is MUCH MUCH slower than 'fit_background' above. The astropy fitting/modelling must be to blame...
     
     INPUT:
-    'bg'               : sparse matrix containing the inter-order regions of the 2D image
+    'bg'               : sparse matrix containing the inter-order regions of the 2D image (from "extract_background"), or
+                         dictionary containing the coordinates and values of the background pixels (from "extract_background_pixels")
     'poly_deg'         : the order of the polynomials to use in the fit (for both dimensions)
     'polytype'         : either 'polynomial' (default), 'legendre', or 'chebyshev' are accepted
     'return_full'      : boolean - if TRUE, then the background model for each pixel for each order is returned; otherwise just the set of coefficients that describe it
@@ -289,14 +479,18 @@ def fit_background_astropy(bg, poly_deg=5, polytype='chebyshev', return_full=Tru
     if timit:
         start_time = time.time()
     
-    #find the non-zero parts of the sparse matrix
-    #format is:
-    #contents[0] = row indices
-    #contents[1] = column indices
-    #contents[2] = values
-    contents = sparse.find(bg)
-    
-    ny, nx = bg.todense().shape
+    if isinstance(bg, dict):
+        #coordinates and values of the background pixels from "extract_background_pixels"
+        contents = (bg['rows'], bg['cols'], bg['z'])
+        ny, nx = bg['shape']
+    else:
+        #find the non-zero parts of the sparse matrix
+        #format is:
+        #contents[0] = row indices
+        #contents[1] = column indices
+        #contents[2] = values
+        contents = sparse.find(bg)
+        ny, nx = bg.shape
     
     #re-normalize arrays to [-1,+1]    
     x_norm = (contents[0] / ((nx-1)/2.)) - 1.
@@ -304,7 +498,7 @@ def fit_background_astropy(bg, poly_deg=5, polytype='chebyshev', return_full=Tru
     z = contents[2]
            
     #call the surface fitting routine
-    bkgd_coeffs = fit_poly_surface_2D(x_norm, y_norm, z, weights=None, polytype = polytype, poly_deg=poly_deg)    
+    bkgd_coeffs = fit_poly_surface_2D(x_norm, y_norm, z, weights=None, polytype = polytype, poly_deg_x=poly_deg)    
 #     cheb_coeffs = fit_poly_surface_2D(x_norm, y_norm, z, weights=None, polytype = 'c', poly_deg=3, timit=True)  
 #     lege_coeffs = fit_poly_surface_2D(x_norm, y_norm, z, weights=None, polytype = 'l', poly_deg=3, timit=True)  
 #     poly_coeffs = fit_poly_surface_2D(x_norm, y_norm, z, weights=None, polytype = 'p', poly_deg=3, timit=True)
@@ -314,9 +508,10 @@ def fit_background_astropy(bg, poly_deg=5, polytype='chebyshev', return_full=Tru
         xxn = (xx / ((nx-1)/2.)) - 1.
         yy = np.arange(ny)
         yyn = (yy / ((ny-1)/2.)) - 1.
-        X,Y = np.meshgrid(xxn,yyn)
         #bkgd_img = bkgd_coeffs(X,Y)
-        bkgd_img = bkgd_coeffs(Y,X)     #IDKY, but the indices are the wrong way around if I do it like in the line above!!!!!
+        #bkgd_img = bkgd_coeffs(Y,X)     #IDKY, but the indices are the wrong way around if I do it like in the line above!!!!!
+        #same as bkgd_coeffs(Y,X) with X,Y = np.meshgrid(xxn,yyn), but exploiting separability
+        bkgd_img = np.ascontiguousarray(eval_poly_surface_2D_grid(bkgd_coeffs, yyn, xxn).T)
 
     if timit:
         print('Time elapsed: '+np.round(time.time() - start_time,2).astype(str)+' seconds...')    
@@ -12,8 +12,8 @@ import datetime
 import copy
 import matplotlib.pyplot as plt
 
-from helper_functions import short_filenames
-from calibration import get_bias_and_readnoise_from_bias_frames, make_offmask_and_ronmask, make_master_bias_from_coeffs, make_master_dark, correct_orientation, crop_overscan_region
+from helper_functions import short_filenames, run_cached
+from calibration import get_bias_and_readnoise_from_bias_frames, get_bias_and_readnoise_from_overscan, make_offmask_and_ronmask, make_master_bias_from_coeffs, make_master_dark, correct_orientation, crop_overscan_region
 from order_tracing import find_stripes, make_P_id, make_mask_dict, extract_stripes #, find_tramlines
 from spatial_profiles import fit_profiles, fit_profiles_from_indices
 from extraction import *
@@ -55,7 +55,8 @@ gain = [1., 1., 1., 1.]
 # either from bias frames (units: [offsets] = ADUs; [RON] = e-)
 # medbias,coeffs,offsets,rons = get_bias_and_readnoise_from_bias_frames(sorted(bias_list), degpol=5, clip=5., gain=gain,
 #                                                                       save_medimg=True, debug_level=1, timit=True)
-# or from the overscan regions
+# or from the overscan regions (per frame; units: [offsets] = ADUs; [RON] = e-)
+# offsets,rons = get_bias_and_readnoise_from_overscan(correct_orientation(pyfits.getdata(bias_list[0])), clip=5., gain=gain)
 
 
 # create MASTER BIAS frame and read-out noise mask (units = ADUs)
@@ -78,15 +79,18 @@ del dumimg
 
 # (iii) WHITES 
 #create (bias- & dark-subtracted) MASTER WHITE frame and corresponding error array (units = electrons)
-MW,err_MW = process_whites(white_list, MB=MB, ronmask=ronmask, MD=MDS, gain=gain, scalable=True, fancy=False,
-                           clip=5., savefile=True, saveall=False, diffimg=False, path=path, debug_level=1, timit=False)
+#(this is only re-computed if any of the inputs (files, headers, calibration frames, or parameters) have changed since the last run)
+MW,err_MW = run_cached(process_whites, args=(sorted(white_list),), kwargs=dict(MB=MB, ronmask=ronmask, MD=MDS, gain=gain, scalable=True, fancy=False,
+                       clip=5., savefile=True, saveall=False, diffimg=False, path=path, debug_level=1, timit=False), cachedir=path+'cache/', name='MW')
 #####################################################################################################################################################
 
 
 
 # (3) ORDER TRACING #################################################################################################################################
 # find orders roughly
-P,tempmask = find_stripes(MW, deg_polynomial=2, min_peak=0.25, gauss_filter_sigma=3., simu=True, debug_level=2)
+#(again, this is only re-computed if the master white or the parameters have changed since the last run)
+P,tempmask = run_cached(find_stripes, args=(MW,), kwargs=dict(deg_polynomial=2, min_peak=0.25, gauss_filter_sigma=3., simu=True, debug_level=2),
+                        cachedir=path+'cache/', name='P')
 # assign physical diffraction order numbers (this is only a dummy function for now) to order-fit polynomials and bad-region masks
 P_id = make_P_id(P)
 mask = make_mask_dict(tempmask)
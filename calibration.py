@@ -6,58 +6,209 @@ Created on 13 Apr. 2018
 
 import astropy.io.fits as pyfits
 import numpy as np
+import glob
+import os
 from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
 import time
 import matplotlib.pyplot as plt
 
-from helper_functions import correct_orientation, sigma_clip, polyfit2d, polyval2d
+from helper_functions import correct_orientation, sigma_clip, polyfit2d, polyfit2d_normal, polyval2d, polyval2d_grid
 
 
 
 
 
-def make_median_image(imglist, MB=None, scalable=False, raw=False):
+def read_image_tile(data, t0, t1, raw=False, bscale=1., bzero=0.):
     """
-    Make a median image from a given list of images.
-
+    Read a tile from a (memory-mapped) raw image, and bring it to the "correct" orientation and crop the overscan region on the fly (unless 'raw' is set to TRUE).
+    The tiles are always contiguous blocks of rows in the image AS STORED ON DISK, so that every tile only touches its own part of the file.
+    For images in the raw orientation (4112 x 4202) this corresponds to a block of COLUMNS in the correctly oriented image, 
+    otherwise (ie for 'raw' images, or images that have already been brought to the correct orientation) it is a block of ROWS.
+    
     INPUT:
-    'imglist'  : list of files (incl. directories)
-    'MB'       : master bias frame - if provided, it will be subtracted from every image before median image is computed
-    'scalable' : boolean - do you want to scale this to an exposure time of 1s (AFTER the bias is subtracted!!!!!)
-    'raw'      : boolean - set to TRUE if you want to retain the original size and orientation;
-                 otherwise the image will be brought to the 'correct' orientation and the overscan regions will be cropped
-
+    'data'    : the image data as stored on disk (ideally a memmap, opened with do_not_scale_image_data=True)
+    't0'      : first row (on disk) of the tile
+    't1'      : last row (on disk) of the tile (exclusive)
+    'raw'     : boolean - set to TRUE if you want to retain the original size and orientation
+    'bscale'  : the BSCALE value from the FITS header
+    'bzero'   : the BZERO value from the FITS header
+    
     OUTPUT:
-    'medimg'   : median image
+    'tile'    : the tile (float64) in the output orientation
+    'outslc'  : the tuple of slices that describe where the tile lives in the output image
     """
+    
+    ny, nx = data.shape
+    
+    if raw:
+        tile = data[t0:t1,:]
+        outslc = (slice(t0,t1), slice(None))
+    elif (ny,nx) == (4112, 4202):
+        #same as correct_orientation (ie np.fliplr(img.T)) followed by crop_overscan_region, ie rows in the raw image are columns in the output image
+        tile = data[t0:t1,53:4149][::-1,:].T
+        outslc = (slice(None), slice(ny-t1, ny-t0))
+    elif (ny,nx) == (4202, 4112):
+        #already in the correct orientation, only crop the overscan region
+        tile = data[t0:t1,:]
+        outslc = (slice(t0-53, t1-53), slice(None))
+    else:
+        print('ERROR: wrong image size encountered!!!')
+        return
+    
+    tile = tile.astype('f8')
+    if bscale != 1.:
+        tile *= bscale
+    if bzero != 0.:
+        tile += bzero
+    
+    return tile, outslc
 
-    # from veloce_reduction.calibration import crop_overscan_region
 
-    # prepare array
-    allimg = []
 
-    # loop over all files in "dark_list"
-    for file in imglist:
-        
-        # read in dark image
-        img = pyfits.getdata(file)
-        if not raw:
-            # bring to "correct" orientation
-            img = correct_orientation(img)
-            # remove the overscan region
-            img = crop_overscan_region(img)
-        if MB is not None:
-            # subtract master bias (if provided)
-            img = img - MB
+
+
+def combine_images(imglist, method='median', MB=None, scalable=False, raw=False, clip=5., maxiter=3, memory_budget=1024, return_abssum=False, debug_level=0, timit=False):
+    """
+    Combine a stack of images (eg biases, darks, whites) pixel by pixel, without ever holding the whole stack in memory. 
+    The images are opened as memory-mapped FITS files, and the stack is processed in tiles of contiguous rows (as stored on disk),
+    such that the memory footprint of the (float64) tile stacks stays within the given memory budget. The data are read without
+    scaling (do_not_scale_image_data=True), and BSCALE / BZERO are applied manually for every tile.
+    
+    INPUT:
+    'imglist'        : list of files (incl. directories)
+    'method'         : how to combine the images - 'median' (default), 'mean', or 'clippedmean' (iteratively sigma-clipped mean)
+    'MB'             : master bias frame - if provided, it will be subtracted from every image before the images are combined
+    'scalable'       : boolean - do you want to scale this to an exposure time of 1s (AFTER the bias is subtracted!!!!!)
+    'raw'            : boolean - set to TRUE if you want to retain the original size and orientation;
+                       otherwise the image will be brought to the 'correct' orientation and the overscan regions will be cropped
+    'clip'           : number of sigmas for the sigma-clipping (only used if method is 'clippedmean')
+    'maxiter'        : maximum number of iterations for the sigma-clipping (only used if method is 'clippedmean')
+    'memory_budget'  : approximate maximum amount of memory (in MB) to be used for the tile stacks
+    'return_abssum'  : boolean - do you also want the sum of the absolute pixel values over all images? (eg for the error estimate for the whites)
+    'debug_level'    : for debugging...
+    'timit'          : boolean - do you want to measure execution run time?
+    
+    OUTPUT:
+    'combined'  : the combined image
+    'abssum'    : the sum of the absolute pixel values over all images (only if 'return_abssum' is set to TRUE)
+    """
+    
+    if timit:
+        start_time = time.time()
+    
+    if method.lower() not in ['median', 'mean', 'clippedmean']:
+        print('ERROR: combination method not recognized!!!')
+        return
+    
+    nimg = len(imglist)
+    
+    #open all files as memmaps (this does not read any data yet)
+    hdus = [pyfits.open(file, memmap=True, do_not_scale_image_data=True) for file in imglist]
+    
+    try:
+        alldata = [hdu[0].data for hdu in hdus]
+        bscales = [hdu[0].header.get('BSCALE', 1.) for hdu in hdus]
+        bzeros = [hdu[0].header.get('BZERO', 0.) for hdu in hdus]
         if scalable:
-            texp = pyfits.getval(file, 'TOTALEXP')
-            img /= texp
+            texps = [hdu[0].header['TOTALEXP'] for hdu in hdus]
+        
+        if len(set([data.shape for data in alldata])) > 1:
+            print('ERROR: not all images have the same dimensions!!!')
+            return
+        ny_disk, nx_disk = alldata[0].shape
+        
+        #output dimensions and the range of rows (on disk) to loop over
+        if raw:
+            outshape = (ny_disk, nx_disk)
+            rowrange = (0, ny_disk)
+        elif (ny_disk, nx_disk) == (4112, 4202):
+            outshape = (4096, 4112)
+            rowrange = (0, ny_disk)
+        elif (ny_disk, nx_disk) == (4202, 4112):
+            outshape = (4096, 4112)
+            rowrange = (53, 4149)
+        else:
+            print('ERROR: wrong image size encountered!!!')
+            return
+        
+        #number of rows per tile such that the stack (plus temporary copies for the median / clipping) fits into the memory budget
+        bytes_per_row = nimg * nx_disk * 8 * 3
+        rows_per_tile = int(np.clip(memory_budget * 2**20 // bytes_per_row, 1, rowrange[1] - rowrange[0]))
+        if debug_level >= 1:
+            print('Combining '+str(nimg)+' images in tiles of '+str(rows_per_tile)+' rows...')
+        
+        combined = np.zeros(outshape)
+        if return_abssum:
+            abssum = np.zeros(outshape)
+        
+        for t0 in range(rowrange[0], rowrange[1], rows_per_tile):
+            t1 = min(t0 + rows_per_tile, rowrange[1])
+            
+            for i,data in enumerate(alldata):
+                tile, outslc = read_image_tile(data, t0, t1, raw=raw, bscale=bscales[i], bzero=bzeros[i])
+                if i == 0:
+                    stack = np.empty((nimg,) + tile.shape)
+                if MB is not None:
+                    # subtract master bias (if provided)
+                    tile -= MB[outslc]
+                if scalable:
+                    tile /= texps[i]
+                stack[i] = tile
+            
+            if return_abssum:
+                abssum[outslc] = np.sum(np.abs(stack), axis=0)
+            
+            if method.lower() == 'median':
+                combined[outslc] = np.median(stack, axis=0)
+            elif method.lower() == 'mean':
+                combined[outslc] = np.mean(stack, axis=0)
+            else:
+                #iteratively sigma-clipped mean
+                for n in range(maxiter):
+                    with np.errstate(invalid='ignore'):
+                        med = np.nanmedian(stack, axis=0)
+                        sig = np.nanstd(stack, axis=0)
+                        outies = np.abs(stack - med) > clip * sig
+                    if not np.any(outies):
+                        break
+                    stack[outies] = np.nan
+                combined[outslc] = np.nanmean(stack, axis=0)
+    
+    finally:
+        for hdu in hdus:
+            hdu.close()
+    
+    if timit:
+        print('Time elapsed: '+str(np.round(time.time() - start_time,1))+' seconds')
+    
+    if return_abssum:
+        return combined, abssum
+    else:
+        return combined
+
+
 
-        # add image to list
-        allimg.append(img)
 
-    # get median image
-    medimg = np.median(np.array(allimg), axis=0)
+
+def make_median_image(imglist, MB=None, scalable=False, raw=False, memory_budget=1024):
+    """
+    Make a median image from a given list of images.
+    The images are combined tile by tile from memory-mapped files (see "combine_images"), ie the full stack is never held in memory.
+
+    INPUT:
+    'imglist'        : list of files (incl. directories)
+    'MB'             : master bias frame - if provided, it will be subtracted from every image before median image is computed
+    'scalable'       : boolean - do you want to scale this to an exposure time of 1s (AFTER the bias is subtracted!!!!!)
+    'raw'            : boolean - set to TRUE if you want to retain the original size and orientation;
+                       otherwise the image will be brought to the 'correct' orientation and the overscan regions will be cropped
+    'memory_budget'  : approximate maximum amount of memory (in MB) to be used for the tile stacks
+
+    OUTPUT:
+    'medimg'   : median image
+    """
+
+    medimg = combine_images(imglist, method='median', MB=MB, scalable=scalable, raw=raw, memory_budget=memory_budget)
 
     return medimg
 
@@ -68,20 +219,68 @@ def make_median_image(imglist, MB=None, scalable=False, raw=False):
 def make_quadrant_masks(nx, ny):
     # define four quadrants via masks
     q1 = np.zeros((ny, nx), dtype='bool')
-    q1[:(ny / 2), :(nx / 2)] = True
+    q1[:(ny // 2), :(nx // 2)] = True
     q2 = np.zeros((ny, nx), dtype='bool')
-    q2[:(ny / 2), (nx / 2):] = True
+    q2[:(ny // 2), (nx // 2):] = True
     q3 = np.zeros((ny, nx), dtype='bool')
-    q3[(ny / 2):, (nx / 2):] = True
+    q3[(ny // 2):, (nx // 2):] = True
     q4 = np.zeros((ny, nx), dtype='bool')
-    q4[(ny / 2):, :(nx / 2)] = True
+    q4[(ny // 2):, :(nx // 2)] = True
+
+    return q1, q2, q3, q4
+
 
+
+
+
+def get_quadrant_views(img):
+    """
+    Returns the four quadrants of an image as views (ie no copies, and no full-frame boolean masks), using the same quadrant definitions
+    as "make_quadrant_masks". As these are views, in-place operations on them (eg q1 *= gain[0]) modify the original image.
+    
+    INPUT:
+    'img'  : the image (2-dim numpy array)
+    
+    OUTPUT:
+    'q1', 'q2', 'q3', 'q4'  : views of the four quadrants
+    """
+    
+    ny,nx = img.shape
+    
+    q1 = img[:ny//2, :nx//2]
+    q2 = img[:ny//2, nx//2:]
+    q3 = img[ny//2:, nx//2:]
+    q4 = img[ny//2:, :nx//2]
+    
     return q1, q2, q3, q4
 
 
 
 
 
+def get_quadrant_medians(img):
+    """
+    Calculates the median (ignoring NaNs) of each of the four quadrants of an image in one go, by reshaping the image into a 
+    (2, ny/2, 2, nx/2) array, rather than by gathering each quadrant via boolean masks.
+    
+    INPUT:
+    'img'  : the image (2-dim numpy array)
+    
+    OUTPUT:
+    'medians'  : 4-element array containing the medians of the four quadrants (same order as in "make_quadrant_masks")
+    """
+    
+    ny,nx = img.shape
+    
+    #medians[i,j] is the median of the i-th half in y and j-th half in x
+    medians = np.nanmedian(np.reshape(img, (2, ny//2, 2, nx//2)), axis=(1,3))
+    
+    return np.array([medians[0,0], medians[0,1], medians[1,1], medians[1,0]])
+
+
+
+
+
 def crop_overscan_region(img):
     """
     As of July 2018, Veloce uses an e2v CCD231-84-1-E74 4kx4k chip.
@@ -141,7 +340,119 @@ def extract_overscan_region(img):
 
 
 
-def get_bias_and_readnoise_from_bias_frames(bias_list, degpol=5, clip=5, gain=None, save_medimg=True, debug_level=0, timit=False):
+def get_bias_and_readnoise_from_overscan(img, clip=5, gain=None):
+    """
+    Determine the bias levels (offsets) and the read-out noise for the four quadrants of a single frame from its overscan regions, 
+    so that no separate stack of bias frames is needed. The overscan regions are accessed as views (see "extract_overscan_region").
+    
+    INPUT:
+    'img'   : the raw image (either as read from disk, or in the 'correct' orientation, but with the overscan regions NOT yet cropped) [ADU]
+    'clip'  : number of 'sigmas' used to identify outliers in the overscan regions
+    'gain'  : array of gains for each quadrant (in units of e-/ADU) - if provided, the read-out noise is returned in units of electrons
+    
+    OUTPUT:
+    'offsets'  : the 4 constant offsets per quadrant [ADU]
+    'rons'     : read-out noise for the 4 quadrants [ADU, or e- if 'gain' is provided]
+    """
+    
+    overscans = extract_overscan_region(img)
+    if overscans is None:
+        return
+    
+    offsets = np.array([np.nanmedian(os) for os in overscans])
+    rons = np.array([np.nanstd(sigma_clip(np.ravel(os).astype(float), clip)) for os in overscans])
+    
+    #convert read-out noise (but NOT offsets!!!) to units of electrons rather than ADUs by multiplying with the gain (which has units of e-/ADU)
+    if gain is not None:
+        rons = rons * np.array(gain)
+    
+    return offsets, rons
+
+
+
+
+
+def get_raw_frame_view(filename, raw=False):
+    """
+    Read an image from a FITS file via a memory map, and bring it to the "correct" orientation and crop the overscan regions
+    as (strided) views, so that only the wanted region is actually read from disk and copied into a new array (rather than
+    reading the full frame, and then making another full-frame copy for the orientation and cropping). The file (and the
+    memory map) are closed before returning.
+    If the FITS file requires scaling (BSCALE / BZERO, eg for unsigned 16-bit integers), the scaling is only applied to the cropped region.
+    
+    INPUT:
+    'filename'  : filename of the FITS file (incl. directory)
+    'raw'       : boolean - set to TRUE if you want to retain the original size and orientation
+    
+    OUTPUT:
+    'img'  : the image
+    """
+    
+    with pyfits.open(filename, memmap=True, do_not_scale_image_data=True, mode='readonly') as hdul:
+        data = hdul[0].data
+        bscale = hdul[0].header.get('BSCALE', 1.)
+        bzero = hdul[0].header.get('BZERO', 0.)
+        
+        if raw:
+            img = data
+        else:
+            #both of these only create views
+            img = crop_overscan_region(correct_orientation(data))
+        
+        #copy the wanted region out of the memory map before the file is closed
+        if bscale != 1. or bzero != 0.:
+            #astropy would read and scale the entire frame; here only the part we actually want is scaled
+            img = img.astype('f8')
+            img *= bscale
+            img += bzero
+        else:
+            img = np.array(img)
+        del data
+    
+    return img
+
+
+
+
+
+def read_frames(filelist, raw=False, nthreads=4, prefetch=None):
+    """
+    Generator that reads a list of FITS images (via "get_raw_frame_view") using a pool of threads, and yields the images in the same order 
+    as in 'filelist'. While the caller is working on one image, the next 'prefetch' images are already being read in the background,
+    which hides most of the read latency (eg on network-mounted disks).
+    
+    INPUT:
+    'filelist'  : list of filenames (incl. directories)
+    'raw'       : boolean - set to TRUE if you want to retain the original size and orientation;
+                  otherwise the images will be brought to the 'correct' orientation and the overscan regions will be cropped
+    'nthreads'  : number of threads used for reading
+    'prefetch'  : maximum number of images to read ahead (default: 'nthreads')
+    
+    OUTPUT:
+    'img'  : the images (yielded one at a time, in the same order as in 'filelist')
+    """
+    
+    if prefetch is None:
+        prefetch = nthreads
+    
+    def load(filename):
+        #the data are read from disk in the background thread
+        return get_raw_frame_view(filename, raw=raw)
+    
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        futures = [executor.submit(load, filename) for filename in filelist[:prefetch]]
+        for i in range(len(filelist)):
+            img = futures[i].result()
+            futures[i] = None
+            if i + prefetch < len(filelist):
+                futures.append(executor.submit(load, filelist[i + prefetch]))
+            yield img
+
+
+
+
+
+def get_bias_and_readnoise_from_bias_frames(bias_list, degpol=5, clip=5, gain=None, pairs='consecutive', max_pairs=None, memory_budget=1024, save_medimg=True, debug_level=0, timit=False):
     """
     Calculate the median bias frame, the offsets in the four different quadrants (assuming bias frames are flat within a quadrant),
     and the read-out noise per quadrant (ie the STDEV of the signal, but from difference images).
@@ -151,10 +462,19 @@ def get_bias_and_readnoise_from_bias_frames(bias_list, degpol=5, clip=5, gain=No
     'degpol'       : order of the polynomial (in each direction) to be used in the 2-dim polynomial surface fits to each quadrant's median bais frame
     'clip'         : number of 'sigmas' used to identify outliers when 'cleaning' each quadrant's median bais frame before the surface fitting
     'gain'         : array of gains for each quadrant (in units of e-/ADU)
+    'pairs'        : which pairs of bias frames to use for the difference images for the read-out noise estimate:
+                     'consecutive' (default) - only consecutive pairs (N-1 pairs)
+                     'all'                   - all different combinations of length 2 (N*(N-1)/2 pairs; optionally limited to 'max_pairs')
+    'max_pairs'    : maximum number of pairs to use (only used if 'pairs' is set to 'all'; pairs are then sampled evenly from all combinations)
+    'memory_budget': approximate maximum amount of memory (in MB) to be used for the tile stacks of the median image (see "combine_images")
     'save_medimg'  : boolean - do you want to save the median image to a FITS file?
     'debug_level'  : for debugging...
     'timit'        : boolean - do you want to measure execution run time?
     
+    NOTE: for the offsets and the read-out noise every frame is only read once, and only two frames are held in memory at any time
+          (for 'consecutive' pairs); the median image is computed tile by tile from the memory-mapped files, so the full stack
+          is never held in memory. With pairs='all' both frames of every pair are read again.
+    
     OUTPUT:
     'medimg'   : the median bias frame [ADU]
     'coeffs'   : the coefficients that describe the 2-dim polynomial surface fit to the 4 quadrants
@@ -167,20 +487,6 @@ def get_bias_and_readnoise_from_bias_frames(bias_list, degpol=5, clip=5, gain=No
 
     print('Determining offset levels and read-out noise properties from bias frames for 4 quadrants...')
 
-    img = pyfits.getdata(bias_list[0])
-
-    #do some formatting things for real observations
-    #bring to "correct" orientation
-    img = correct_orientation(img)
-    #remove the overscan region, which looks crap for actual bias images
-    img = crop_overscan_region(img)
-
-
-    ny,nx = img.shape
-
-    #define four quadrants via masks
-    q1,q2,q3,q4 = make_quadrant_masks(nx,ny)
-
     #co-add all bias frames
     #MB = create_master_img(bias_list, imgtype='bias', with_errors=False, savefiles=False, remove_outliers=True)
 
@@ -197,80 +503,91 @@ def get_bias_and_readnoise_from_bias_frames(bias_list, degpol=5, clip=5, gain=No
     #means_q4 = []
     medians_q4 = []
     sigs_q4 = []
-    allimg = []
 
     if debug_level >= 1:
         print('Determining bias levels and read-out noise from '+str(len(bias_list))+' bias frames...')
 
+    if pairs not in ['consecutive', 'all']:
+        print('ERROR: "pairs" must be either "consecutive" or "all"!!!')
+        return
+
     #first get mean / median for all bias images (per quadrant)
-    for name in bias_list:
+    prev_img = None
+    #images are read (and brought to "correct" orientation, and overscan region removed - which looks crap for actual bias images)
+    #in the background while we work on the previous one
+    for i,(name,img) in enumerate(zip(bias_list, read_frames(bias_list))):
         
         if debug_level >= 1:
             print('OK, reading ',name)
         
-        img = pyfits.getdata(name)
+        if i == 0:
+            ny,nx = img.shape
         
-        #bring to "correct" orientation
-        img = correct_orientation(img)
-        #remove the overscan region, which looks crap for actual bias images
-        img = crop_overscan_region(img)
+        #all four quadrants in one go (using reshaped views rather than boolean masks)
+        medians = get_quadrant_medians(img)
+        medians_q1.append(medians[0])
+        medians_q2.append(medians[1])
+        medians_q3.append(medians[2])
+        medians_q4.append(medians[3])
         
-        #means_q1.append(np.nanmean(img[q1]))
-        medians_q1.append(np.nanmedian(img[q1]))
-        #means_q2.append(np.nanmean(img[q2]))
-        medians_q2.append(np.nanmedian(img[q2]))
-        #means_q3.append(np.nanmean(img[q3]))
-        medians_q3.append(np.nanmedian(img[q3]))
-        #means_q4.append(np.nanmean(img[q4]))
-        medians_q4.append(np.nanmedian(img[q4]))
-        allimg.append(img)
-
-    # now get sigma of RON for ALL DIFFERENT COMBINATIONS of length 2 of the images in 'bias_list'
-    # by using the difference images we are less susceptible to funny pixels (hot, warm, cosmics, etc.)
-    list_of_combinations = list(combinations(bias_list, 2))
-    for (name1,name2) in list_of_combinations:
+        # get sigma of RON from the difference image of consecutive pairs, so that every image only has to be read once
+        # by using the difference images we are less susceptible to funny pixels (hot, warm, cosmics, etc.)
+        if pairs == 'consecutive' and prev_img is not None:
+            #take difference and do sigma-clipping
+            diff = img.astype(float) - prev_img.astype(float)
+            q1,q2,q3,q4 = get_quadrant_views(diff)
+            sigs_q1.append(np.nanstd(sigma_clip(q1.ravel(), 5))/np.sqrt(2))
+            sigs_q2.append(np.nanstd(sigma_clip(q2.ravel(), 5))/np.sqrt(2))
+            sigs_q3.append(np.nanstd(sigma_clip(q3.ravel(), 5))/np.sqrt(2))
+            sigs_q4.append(np.nanstd(sigma_clip(q4.ravel(), 5))/np.sqrt(2))
+        prev_img = img
+
+    if pairs == 'all':
+        # now get sigma of RON for ALL DIFFERENT COMBINATIONS of length 2 of the images in 'bias_list'
+        # by using the difference images we are less susceptible to funny pixels (hot, warm, cosmics, etc.)
+        list_of_combinations = list(combinations(range(len(bias_list)), 2))
+        if max_pairs is not None and len(list_of_combinations) > max_pairs:
+            # sample a bounded number of pairs evenly from all combinations
+            list_of_combinations = [list_of_combinations[i] for i in np.linspace(0, len(list_of_combinations)-1, max_pairs).astype(int)]
+        for (i1,i2) in list_of_combinations:
         
-        # read in observations and bring to right format
-        img1 = pyfits.getdata(name1)
-        img2 = pyfits.getdata(name2)
-
-        img1 = correct_orientation(img1)
-        img1 = crop_overscan_region(img1)
-        img2 = correct_orientation(img2)
-        img2 = crop_overscan_region(img2)
-
-        #take difference and do sigma-clipping
-        diff = img1.astype(long) - img2.astype(long)
-        sigs_q1.append(np.nanstd(sigma_clip(diff[q1], 5))/np.sqrt(2))
-        sigs_q2.append(np.nanstd(sigma_clip(diff[q2], 5))/np.sqrt(2))
-        sigs_q3.append(np.nanstd(sigma_clip(diff[q3], 5))/np.sqrt(2))
-        sigs_q4.append(np.nanstd(sigma_clip(diff[q4], 5))/np.sqrt(2))
+            # read in observations and bring to right format
+            img1 = get_raw_frame_view(bias_list[i1])
+            img2 = get_raw_frame_view(bias_list[i2])
+
+            #take difference and do sigma-clipping
+            diff = img1.astype(float) - img2.astype(float)
+            q1,q2,q3,q4 = get_quadrant_views(diff)
+            sigs_q1.append(np.nanstd(sigma_clip(q1.ravel(), 5))/np.sqrt(2))
+            sigs_q2.append(np.nanstd(sigma_clip(q2.ravel(), 5))/np.sqrt(2))
+            sigs_q3.append(np.nanstd(sigma_clip(q3.ravel(), 5))/np.sqrt(2))
+            sigs_q4.append(np.nanstd(sigma_clip(q4.ravel(), 5))/np.sqrt(2))
 
     #now average over all images
     #allmeans = np.array([np.median(medians_q1), np.median(medians_q2), np.median(medians_q3), np.median(medians_q4)])
     offsets = np.array([np.median(medians_q1), np.median(medians_q2), np.median(medians_q3), np.median(medians_q4)])
     rons = np.array([np.median(sigs_q1), np.median(sigs_q2), np.median(sigs_q3), np.median(sigs_q4)])
     
-    #get median image as well
-    medimg = np.median(np.array(allimg), axis=0)
+    #get median image as well (tile by tile from the memory-mapped files, rather than stacking all images in memory)
+    medimg = make_median_image(bias_list, memory_budget=memory_budget)
     
     ##### now fit a 2D polynomial surface to the median bias image (for each quadrant separately)
         
     #now, because all quadrants are the same size, they have the same "normalized coordinates", so only have to do that once
-    xq1 = np.arange(0,(nx/2))
-    yq1 = np.arange(0,(ny/2))
+    xq1 = np.arange(0,(nx//2))
+    yq1 = np.arange(0,(ny//2))
     XX_q1,YY_q1 = np.meshgrid(xq1,yq1)
     x_norm = (XX_q1.flatten() / ((len(xq1)-1)/2.)) - 1.
     y_norm = (YY_q1.flatten() / ((len(yq1)-1)/2.)) - 1.
     
     #Quadrant 1
-    medimg_q1 = medimg[:(ny/2), :(nx/2)]
+    medimg_q1 = medimg[:(ny//2), :(nx//2)]
     #clean this, otherwise the surface fit will be rubbish
     medimg_q1[np.abs(medimg_q1 - np.median(medians_q1)) > clip * np.median(sigs_q1)] = np.median(medians_q1)
-    coeffs_q1 = polyfit2d(x_norm, y_norm, medimg_q1.flatten(), order=degpol)
+    coeffs_q1 = polyfit2d_normal(x_norm, y_norm, medimg_q1.flatten(), order=degpol)
     
     #Quadrant 2
-    medimg_q2 = medimg[:(ny/2), (nx/2):]
+    medimg_q2 = medimg[:(ny//2), (nx//2):]
     #clean this, otherwise the surface fit will be rubbish
     medimg_q2[np.abs(medimg_q2 - np.median(medians_q2)) > clip * np.median(sigs_q2)] = np.median(medians_q2)
 #     xq2 = np.arange((nx/2),nx)
@@ -278,19 +595,19 @@ def get_bias_and_readnoise_from_bias_frames(bias_list, degpol=5, clip=5, gain=No
 #     XX_q2,YY_q2 = np.meshgrid(xq2,yq2)
 #     xq2_norm = (XX_q2.flatten() / ((len(xq2)-1)/2.)) - 3.   #not quite right
 #     yq2_norm = (YY_q2.flatten() / ((len(yq2)-1)/2.)) - 1.
-    coeffs_q2 = polyfit2d(x_norm, y_norm, medimg_q2.flatten(), order=degpol)
+    coeffs_q2 = polyfit2d_normal(x_norm, y_norm, medimg_q2.flatten(), order=degpol)
     
     #Quadrant 3
-    medimg_q3 = medimg[(ny/2):, (nx/2):]
+    medimg_q3 = medimg[(ny//2):, (nx//2):]
     #clean this, otherwise the surface fit will be rubbish
     medimg_q3[np.abs(medimg_q3 - np.median(medians_q3)) > clip * np.median(sigs_q3)] = np.median(medians_q3)
-    coeffs_q3 = polyfit2d(x_norm, y_norm, medimg_q3.flatten(), order=degpol)
+    coeffs_q3 = polyfit2d_normal(x_norm, y_norm, medimg_q3.flatten(), order=degpol)
     
     #Quadrant 4
-    medimg_q4 = medimg[(ny/2):, :(nx/2)]
+    medimg_q4 = medimg[(ny//2):, :(nx//2)]
     #clean this, otherwise the surface fit will be rubbish
     medimg_q4[np.abs(medimg_q4 - np.median(medians_q4)) > clip * np.median(sigs_q4)] = np.median(medians_q4)
-    coeffs_q4 = polyfit2d(x_norm, y_norm, medimg_q4.flatten(), order=degpol)
+    coeffs_q4 = polyfit2d_normal(x_norm, y_norm, medimg_q4.flatten(), order=degpol)
     
     #return all coefficients as 4-element array
     coeffs = np.array([coeffs_q1, coeffs_q2, coeffs_q3, coeffs_q4])            
@@ -355,11 +672,10 @@ def make_offmask_and_ronmask(offsets, rons, nx, ny, gain=None, savefiles=False,
     elif nq == 4:
         offmask = np.ones((ny,nx))
         ronmask = np.ones((ny,nx))
-        q1,q2,q3,q4 = make_quadrant_masks(nx,ny)
-        for q,offset in zip([q1,q2,q3,q4],offsets):
-            offmask[q] = offmask[q] * offset
-        for q,RON in zip([q1,q2,q3,q4],rons):
-            ronmask[q] = ronmask[q] * RON 
+        for q,offset in zip(get_quadrant_views(offmask),offsets):
+            q *= offset
+        for q,RON in zip(get_quadrant_views(ronmask),rons):
+            q *= RON 
     else:
         print('ERROR: "offsets" must either be a scalar (for single-port readout) or a 4-element array/list (for four-port readout)!')
         return
@@ -450,24 +766,23 @@ def make_master_bias_from_coeffs(coeffs, nx, ny, savefile=False, path=None, timi
     
     #create normalized x- & y-coordinates; size of the quadrants is (nx/2) x (ny/2)
     #the normalized coordinates are the same for all quadrants, of course
-    xx_q1 = np.arange(nx/2)    
-    yy_q1 = np.arange(ny/2)      
-    xxn_q1 = (xx_q1 / (((nx/2)-1)/2.)) - 1. 
-    yyn_q1 = (yy_q1 / (((ny/2)-1)/2.)) - 1.
-    XX_norm,YY_norm = np.meshgrid(xxn_q1,yyn_q1)
-    
-    #model the 4 quadrants
-    model_q1 = polyval2d(XX_norm, YY_norm, coeffs_q1)
-    model_q2 = polyval2d(XX_norm, YY_norm, coeffs_q2)
-    model_q3 = polyval2d(XX_norm, YY_norm, coeffs_q3)
-    model_q4 = polyval2d(XX_norm, YY_norm, coeffs_q4)
+    xx_q1 = np.arange(nx//2)    
+    yy_q1 = np.arange(ny//2)      
+    xxn_q1 = (xx_q1 / (((nx//2)-1)/2.)) - 1. 
+    yyn_q1 = (yy_q1 / (((ny//2)-1)/2.)) - 1.
+    
+    #model the 4 quadrants (same as polyval2d on the meshgrid of xxn_q1 and yyn_q1, but exploiting separability)
+    model_q1 = polyval2d_grid(xxn_q1, yyn_q1, coeffs_q1)
+    model_q2 = polyval2d_grid(xxn_q1, yyn_q1, coeffs_q2)
+    model_q3 = polyval2d_grid(xxn_q1, yyn_q1, coeffs_q3)
+    model_q4 = polyval2d_grid(xxn_q1, yyn_q1, coeffs_q4)
     
     #make master bias frame from 4 quadrant models
     master_bias = np.zeros((ny,nx))
-    master_bias[:(ny/2), :(nx/2)] = model_q1
-    master_bias[:(ny/2), (nx/2):] = model_q2
-    master_bias[(ny/2):, (nx/2):] = model_q3
-    master_bias[(ny/2):, :(nx/2)] = model_q4
+    master_bias[:(ny//2), :(nx//2)] = model_q1
+    master_bias[:(ny//2), (nx//2):] = model_q2
+    master_bias[(ny//2):, (nx//2):] = model_q3
+    master_bias[(ny//2):, :(nx//2)] = model_q4
     
     
     #now save to FITS file
@@ -573,12 +888,8 @@ def make_master_dark(dark_list, MB, gain=None, scalable=False, savefile=True, pa
             print('ERROR: gain(s) not given!!!')
             return
         else:
-            ny,nx = MD.shape
-            q1,q2,q3,q4 = make_quadrant_masks(nx,ny)
-            MD[q1] = gain[0] * MD[q1]
-            MD[q2] = gain[1] * MD[q2]
-            MD[q3] = gain[2] * MD[q3]
-            MD[q4] = gain[3] * MD[q4]
+            for q,g in zip(get_quadrant_views(MD),gain):
+                q *= g
     else:
         # make dark "sublists" for all unique exposure times
         all_dark_lists = []
@@ -593,12 +904,8 @@ def make_master_dark(dark_list, MB, gain=None, scalable=False, savefile=True, pa
                 print('ERROR: gain(s) not given!!!')
                 return
             else:
-                ny,nx = sub_MD.shape
-                q1,q2,q3,q4 = make_quadrant_masks(nx,ny)
-                sub_MD[q1] = gain[0] * sub_MD[q1]
-                sub_MD[q2] = gain[1] * sub_MD[q2]
-                sub_MD[q3] = gain[2] * sub_MD[q3]
-                sub_MD[q4] = gain[3] * sub_MD[q4]
+                for q,g in zip(get_quadrant_views(sub_MD),gain):
+                    q *= g
             MD.append(sub_MD)
 
 
@@ -643,6 +950,117 @@ def make_master_dark(dark_list, MB, gain=None, scalable=False, savefile=True, pa
 
 
 
+def make_dark_library(path, pattern='master_dark_t*.fits', tempkey=None, debug_level=0):
+    """
+    Creates a "library" of all available master dark frames (as created by "make_master_dark") in a given directory, indexed by exposure 
+    time (and optionally detector temperature). Only the headers are read here; the actual dark frames are only loaded (memory-mapped) 
+    when they are first requested via "get_dark", and are then kept in the library for subsequent requests.
+    
+    INPUT:
+    'path'         : the directory containing the master dark frames
+    'pattern'      : the file name pattern of the master dark frames
+    'tempkey'      : FITS header keyword for the detector temperature (eg 'DETTEMP'); if None, the temperature is not used
+    'debug_level'  : for debugging...
+    
+    OUTPUT:
+    'library'  : dictionary containing the file names ('files'), the exposure times ('texp'), the temperatures ('temp'), 
+                 the scalable master dark file name if available ('scalable'), and the already loaded dark frames ('data')
+    """
+    
+    files = sorted(glob.glob(path + pattern))
+    
+    texp = np.array([pyfits.getval(file, 'TOTALEXP') for file in files])
+    if tempkey is not None:
+        temp = np.array([pyfits.getheader(file).get(tempkey, np.nan) for file in files], dtype=float)
+    else:
+        temp = np.full(len(files), np.nan)
+    
+    if os.path.exists(path + 'master_dark_scalable.fits'):
+        scalable = path + 'master_dark_scalable.fits'
+    else:
+        scalable = None
+    
+    if debug_level >= 1:
+        print('Found '+str(len(files))+' master dark frames with exposure times: '+str(texp))
+    
+    library = {'files':files, 'texp':texp, 'temp':temp, 'scalable':scalable, 'data':{}}
+    
+    return library
+
+
+
+
+
+def load_dark_from_library(library, filename):
+    """
+    Returns a (memory-mapped, read-only) master dark frame from the library, loading it on first use.
+    """
+    if filename not in library['data']:
+        library['data'][filename] = pyfits.getdata(filename, 0, memmap=True)
+    return library['data'][filename]
+
+
+
+
+
+def get_dark(library, texp, temp=None, method='nearest'):
+    """
+    Returns a master dark frame for a given exposure time (and optionally detector temperature) from a dark library (see "make_dark_library").
+    
+    INPUT:
+    'library'  : the dark library (from "make_dark_library")
+    'texp'     : the exposure time [s] of the image that needs to be dark-corrected
+    'temp'     : the detector temperature of the image that needs to be dark-corrected (only master darks at the nearest temperature are considered)
+    'method'   : 'nearest'      - the master dark with the nearest exposure time
+                 'interpolate'  - linear interpolation between the two master darks bracketing the exposure time (or nearest if outside the range)
+                 'scale'        - the scalable master dark (if available), otherwise the nearest master dark, scaled to the exposure time
+    
+    OUTPUT:
+    'MD'  : the master dark frame [e-] (read-only if method is 'nearest')
+    """
+    
+    if method not in ['nearest', 'interpolate', 'scale']:
+        print('ERROR: method must be either "nearest", "interpolate", or "scale"!!!')
+        return
+    
+    if method == 'scale' and library['scalable'] is not None:
+        return load_dark_from_library(library, library['scalable']) * texp
+    
+    if len(library['files']) == 0:
+        print('ERROR: no master dark frames found in library!!!')
+        return
+    
+    #only consider master darks at the nearest temperature (if known)
+    ix = np.arange(len(library['files']))
+    if temp is not None and np.any(np.isfinite(library['temp'])):
+        tempdiff = np.abs(library['temp'] - temp)
+        ix = ix[tempdiff == np.nanmin(tempdiff)]
+    texps = library['texp'][ix]
+    
+    #nearest exposure time
+    nearest = ix[np.argmin(np.abs(texps - texp))]
+    
+    if method == 'nearest':
+        return load_dark_from_library(library, library['files'][nearest])
+    elif method == 'scale':
+        return load_dark_from_library(library, library['files'][nearest]) * (texp / library['texp'][nearest])
+    else:
+        lower = ix[texps <= texp]
+        upper = ix[texps >= texp]
+        if len(lower) == 0 or len(upper) == 0:
+            #outside the range of exposure times, so just use the nearest one
+            return np.array(load_dark_from_library(library, library['files'][nearest]))
+        lo = lower[np.argmax(library['texp'][lower])]
+        hi = upper[np.argmin(library['texp'][upper])]
+        if library['texp'][hi] == library['texp'][lo]:
+            return np.array(load_dark_from_library(library, library['files'][lo]))
+        frac = (texp - library['texp'][lo]) / (library['texp'][hi] - library['texp'][lo])
+        return (1. - frac) * load_dark_from_library(library, library['files'][lo]) + frac * load_dark_from_library(library, library['files'][hi])
+
+
+
+
+
 def correct_for_bias_and_dark(img, MB, MD, gain=None, scalable=False, texp=None, timit=False):
     """
     This routine subtracts both the MASTER BIAS frame [in ADU], and the MASTER DARK frame [in e-] from a given image.
@@ -691,7 +1109,7 @@ def correct_for_bias_and_dark(img, MB, MD, gain=None, scalable=False, texp=None,
 
 
 
-def correct_for_bias_and_dark_from_filename(imgname, MB, MD, gain=None, scalable=False, savefile=False, path=None, simu=False, timit=False):
+def correct_for_bias_and_dark_from_filename(imgname, MB, MD, gain=None, scalable=False, savefile=False, path=None, simu=False, img=None, bias_from_overscan=False, timit=False):
     """
     This routine subtracts both the MASTER BIAS frame [in ADU], and the MASTER DARK frame [in e-] from a given image.
     It also corrects the orientation of the image and crops the overscan regions.
@@ -706,6 +1124,9 @@ def correct_for_bias_and_dark_from_filename(imgname, MB, MD, gain=None, scalable
     'savefile'  : boolean - do you want to save the bias- & dark-corrected image (and corresponding error array) to a FITS file?
     'path'      : output file directory
     'simu'      : boolean - are you using Echelle++ simulated observations?
+    'img'       : the raw image [ADU], already brought to 'correct' orientation and with the overscan regions cropped (eg from "read_frames");
+                  if not provided, it is read from 'imgname' (if 'bias_from_overscan' is set to TRUE, the overscan regions must NOT be cropped)
+    'bias_from_overscan' : boolean - do you want to determine the bias levels from the overscan regions of this very image instead of using 'MB'?
     'timit'     : boolean - do you want to measure the execution run time?
     
     OUTPUT:
@@ -718,17 +1139,25 @@ def correct_for_bias_and_dark_from_filename(imgname, MB, MD, gain=None, scalable
     if timit:
         start_time = time.time()
 
-    #(0) read in raw image [ADU] 
-    img = pyfits.getdata(imgname)
-    if not simu:
-        #bring to "correct" orientation
-        img = correct_orientation(img)
-        #remove the overscan region
-        img = crop_overscan_region(img)
+    if bias_from_overscan:
+        #(0) read in raw image [ADU] (and bring to "correct" orientation, but keep the overscan regions for now)
+        if img is None:
+            img = correct_orientation(get_raw_frame_view(imgname, raw=True))
+        
+        #(1) BIAS SUBTRACTION [ADU] - using the offsets from the overscan regions of this image
+        offsets,rons = get_bias_and_readnoise_from_overscan(img)
+        #bias-corrected_image
+        bc_img = crop_overscan_region(img).astype(float)
+        for q,offset in zip(get_quadrant_views(bc_img),offsets):
+            q -= offset
+    else:
+        #(0) read in raw image [ADU] (and bring to "correct" orientation and remove the overscan region, unless simu is set to TRUE)
+        if img is None:
+            img = get_raw_frame_view(imgname, raw=simu)
 
-    #(1) BIAS SUBTRACTION [ADU]
-    #bias-corrected_image
-    bc_img = img - MB
+        #(1) BIAS SUBTRACTION [ADU]
+        #bias-corrected_image
+        bc_img = img - MB
 
 
     #(2) conversion to ELECTRONS and DARK SUBTRACTION [e-]
@@ -744,12 +1173,8 @@ def correct_for_bias_and_dark_from_filename(imgname, MB, MD, gain=None, scalable
             print('ERROR: "texp" has to be provided when "scalable" is set to TRUE')
             return
     #convert image to electrons now    
-    ny,nx = bc_img.shape
-    q1,q2,q3,q4 = make_quadrant_masks(nx,ny)
-    bc_img[q1] = gain[0] * bc_img[q1]
-    bc_img[q2] = gain[1] * bc_img[q2]
-    bc_img[q3] = gain[2] * bc_img[q3]
-    bc_img[q4] = gain[3] * bc_img[q4]
+    for q,g in zip(get_quadrant_views(bc_img),gain):
+        q *= g
     #now subtract master dark frame [e-] to create dark- & bias-corrected image [e-]
     dc_bc_img = bc_img - MD
 
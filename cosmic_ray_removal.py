@@ -7,10 +7,12 @@ Created on 4 Oct. 2017
 from scipy import ndimage
 import numpy as np
 import time
-from click._compat import raw_input
-import scipy.interpolate as ipol
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 import astropy.io.fits as pyfits
 
+from linalg import solve_batched
+
 # imgname = '/Users/christoph/UNSW/cosmics/image.fit'
 # img = pyfits.getdata(imgname)
 # 
@@ -18,7 +20,7 @@ import astropy.io.fits as pyfits
 # xcen = pyfits.getdata(xcenname)
 
 
-def remove_cosmics(img, ronmask, obsname, path, Flim=3.0, siglim=5.0, maxiter=20, savemask=True, savefile=False, save_err=False, verbose=False, timit=False):
+def remove_cosmics(img, ronmask, obsname, path, Flim=3.0, siglim=5.0, maxiter=20, savemask=True, savefile=False, save_err=False, nthreads=1, verbose=False, timit=False):
     """
     Top-level wrapper function for the cosmic-ray cleaning of an image. 
     
@@ -33,6 +35,7 @@ def remove_cosmics(img, ronmask, obsname, path, Flim=3.0, siglim=5.0, maxiter=20
     'savemask' : boolean - do you want to save the cosmic-ray mask?
     'savefile' : boolean - do you want to save the cosmic-ray corrected image?
     'save_err' : boolean - do you want to save the corresponding error array as well? (remains unchanged though)
+    'nthreads' : number of threads to use for the cosmic-ray identification (see "identify_cosmics_tiled")
     'verbose'  : boolean - for user information / debugging...
     'timit'    : boolean - do you want to measure execution run time?
     
@@ -47,7 +50,7 @@ def remove_cosmics(img, ronmask, obsname, path, Flim=3.0, siglim=5.0, maxiter=20
         print('Cleaning cosmic rays...')
     
     #some preparations    
-    global_mask = np.cast['bool'](np.zeros(img.shape))
+    global_mask = np.zeros(img.shape, dtype=bool)
     n_cosmics = 0
     niter = 0
     n_new = 0
@@ -57,7 +60,10 @@ def remove_cosmics(img, ronmask, obsname, path, Flim=3.0, siglim=5.0, maxiter=20
     while ((niter == 0) or n_new > 0) and (niter < maxiter):
         print('Now running iteration '+str(niter+1)+'...')
         #go and identify cosmics
-        mask = identify_cosmics(cleaned, ronmask, Flim=Flim, siglim=siglim, verbose=verbose, timit=timit)
+        if nthreads > 1:
+            mask = identify_cosmics_tiled(cleaned, ronmask, Flim=Flim, siglim=siglim, nthreads=nthreads, verbose=verbose, timit=timit)
+        else:
+            mask = identify_cosmics(cleaned, ronmask, Flim=Flim, siglim=siglim, verbose=verbose, timit=timit)
         n_new = np.sum(mask)
         #add to global mask
         global_mask = np.logical_or(global_mask, mask)
@@ -161,7 +167,7 @@ def identify_cosmics(img, ronmask, Flim=3.0, siglim=5.0, verbose=False, timit=Fa
     ###this works, but it is slow
     ###im5 = signal.medfilt(img, kernel_size=5)
     #this is faster (they are equal if mode='constant', but that's just edge effects):
-    im5 = ndimage.filters.median_filter(img, size=5, mode='mirror')   #again, IDK if that is the right mode
+    im5 = ndimage.median_filter(img, size=5, mode='mirror')   #again, IDK if that is the right mode
     if np.min(im5) < 0.00001:
         im5 = im5.clip(min=0.00001) # As we will take the sqrt
         
@@ -177,12 +183,12 @@ def identify_cosmics(img, ronmask, Flim=3.0, siglim=5.0, verbose=False, timit=Fa
     S = 0.5 * lbarplus / noise
     
     #median-filter S to smooth out larger structures
-    S_m5 = ndimage.filters.median_filter(S, size=5, mode='mirror')
+    S_m5 = ndimage.median_filter(S, size=5, mode='mirror')
     S_prime = S - S_m5
     
     #fine-structure image F
-    im3 = ndimage.filters.median_filter(img, size=3, mode='mirror')
-    im3_m7 = ndimage.filters.median_filter(im3, size=7, mode='mirror')
+    im3 = ndimage.median_filter(img, size=3, mode='mirror')
+    im3_m7 = ndimage.median_filter(im3, size=7, mode='mirror')
     F = im3 - im3_m7
     # In the article that's it, but in lacosmic.cl f is divided by the noise...
     # Ok I understand why, it depends on if you use sp/f or L+/f as criterion.
@@ -198,13 +204,13 @@ def identify_cosmics(img, ronmask, Flim=3.0, siglim=5.0, verbose=False, timit=Fa
     cosmic_mask = np.logical_and(sig_mask, F_mask)
     
     # We "grow" these cosmics a first time to determine the immediate neighbourhood  :
-    growcosmics = np.cast['bool'](ndimage.convolve(np.cast['float32'](cosmic_mask),growkernel))   
+    growcosmics = ndimage.convolve(cosmic_mask.astype('float32'),growkernel).astype(bool)   
     # From this grown set, we keep those that have sp > siglim
     # so obviously not requiring S_prine/F2 > Flim, otherwise it would be pointless...
     growcosmics = np.logical_and(S_prime > siglim, growcosmics)
     
     # Now we repeat this procedure, but lower the detection limit to sigmalimlow :        
-    final_mask = np.cast['bool'](ndimage.convolve(np.cast['float32'](growcosmics),growkernel))
+    final_mask = ndimage.convolve(growcosmics.astype('float32'),growkernel).astype(bool)
     final_mask = np.logical_and(S_prime > 0.3*siglim, final_mask)
     
     #user info
@@ -224,6 +230,78 @@ def identify_cosmics(img, ronmask, Flim=3.0, siglim=5.0, verbose=False, timit=Fa
 
 
 
+def identify_cosmics_tiled(img, ronmask, Flim=3.0, siglim=5.0, nbands=None, halo=8, nthreads=4, verbose=False, timit=False):
+    """
+    Same as "identify_cosmics", but the image is split into (overlapping) bands of rows, which are processed in parallel on a pool of threads
+    (the median filters and convolutions in "scipy.ndimage" release the GIL). Every step in "identify_cosmics" only depends on the pixels
+    within a few pixels of each pixel (the combined footprint of all the filters is +/- 6 pixels), so as long as every band is padded with
+    a halo of at least that many rows, the stitched mask is identical to the one obtained from the full frame. Band boundaries and the
+    halo are kept even, so that the 2x2 subsampling for the Laplacian image lines up with the full frame.
+    
+    INPUT:
+    "img"       - a 2-dim image
+    "ronmask"   - read-out noise in ADUs (either a scalar or a 2-dim array of the same dimensions as "img")
+    "Flim"      - lower threshold for the identification of a pixel as a cosmic ray when using L+/F (see "identify_cosmics")
+    "siglim"    - sigma threshold for identification as cosmic in S_prime
+    "nbands"    - number of bands (default is 'nthreads')
+    "halo"      - number of rows added to either side of each band (must be even and at least 8)
+    "nthreads"  - number of threads to use
+    
+    OUTPUT:
+    "final_mask"   - a boolean mask, where True identifies pixels affected by cosmic rays. This mask has the same dimensions as the input image "img"
+    """
+    
+    #timing
+    if timit:
+        start_time = time.time()
+    
+    if halo < 8 or (halo % 2) != 0:
+        print('ERROR: halo must be an even number of at least 8 rows!!!')
+        return
+    
+    if nbands is None:
+        nbands = nthreads
+    
+    ny = img.shape[0]
+    
+    #band boundaries (even numbers)
+    edges = 2 * (np.linspace(0, ny, nbands+1) // 2).astype(int)
+    edges[-1] = ny
+    edges = np.unique(edges)
+    
+    def identify_band(r0, r1):
+        #padded band
+        p0 = max(r0 - halo, 0)
+        p1 = min(r1 + halo, ny)
+        if np.ndim(ronmask) == 2:
+            band_ronmask = ronmask[p0:p1,:]
+        else:
+            band_ronmask = ronmask
+        band_mask = identify_cosmics(img[p0:p1,:], band_ronmask, Flim=Flim, siglim=siglim, verbose=False, timit=False)
+        #only keep the part without the halo
+        return band_mask[r0-p0:r1-p0,:]
+    
+    final_mask = np.zeros(img.shape, dtype=bool)
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        futures = [executor.submit(identify_band, r0, r1) for r0,r1 in zip(edges[:-1], edges[1:])]
+        for r0,r1,future in zip(edges[:-1], edges[1:], futures):
+            final_mask[r0:r1,:] = future.result()
+    
+    #user info
+    if verbose:
+        print('Number of pixels found to be affected by cosmic rays: '+str(np.sum(final_mask)))
+    
+    #timing
+    if timit:
+        delta_t = time.time() - start_time
+        print('Time taken for cosmic ray identification: '+str(delta_t)+' seconds...')
+    
+    return final_mask
+
+
+
+
+
 def clean_cosmics(img, mask, badpixmask=None, method='median', boxsize=5, verbose=False, timit=False):
         """
         This routine replaces the flux in the pixels identified as being affected by cosmics rays (from function "identify_cosmics") with either
@@ -238,16 +316,16 @@ def clean_cosmics(img, mask, badpixmask=None, method='median', boxsize=5, verbos
         
         KWARGS:
         "method"    - 'median' : the flux values in the cosmic-affected pixels are replaced by the median value of the surrounding non-cosmic-affected pixels
-                    - 'spline' : a cubic spline interpolation is performed through the surrounding non-cosmic-affected pixels and the flux of the cosmic-affected
-                                 pixels is replaced with the interpolated value at their respective locations
+                    - 'spline' / 'surface' : a quadratic surface is fit to the surrounding non-cosmic-affected pixels and the flux of the cosmic-affected
+                                 pixels is replaced with the value of that surface at their respective locations (clipped to the range of the surrounding pixels;
+                                 the median is used if there are fewer than 6 good surrounding pixels)
         "boxsize"   - the size of the surrounding pixels to be considered. default value is 5, ie a box of 5x5 pixels centred on the affected pixel
         "verbose"   - for debugging...
         "timit"     - boolean - do you want to measure execution run time?
 
         This routine borrows heavily from the python translation of LACosmic by Malte Tewes!
-        
-        TODO:
-        implement surface fit method
+        The boxes around all cosmic-affected pixels are gathered at once into an (ncosmics, boxsize*boxsize) array (with NaNs for cosmic-affected, 
+        bad, or off-chip pixels), so there is no loop over individual cosmics.
         """
         
         if timit:
@@ -262,18 +340,7 @@ def clean_cosmics(img, mask, badpixmask=None, method='median', boxsize=5, verbos
         #if badpixmask is supplied, check that it has the same dimensions as well
         if (badpixmask is not None):
             if badpixmask.shape != mask.shape:
-                print('WARNING: Bad pixel mask has different dimension than image and cosmic pixel mask!!!')
-                choice = None
-                while choice == None:   
-                    choice = raw_input('Do you want to continue without using the bad pixel mask? ["y"/"n"]     : ')
-                    if choice in ['n','N','no','No']:
-                        quit()
-                        return
-                    elif choice in ['y','Y','yes','Yes']:
-                        print('OK, ignoring bad pixel mask...')
-                    else:
-                        print('Invalid input! Please try again...')
-                        choice = None
+                raise ValueError('Bad pixel mask has different dimensions '+str(badpixmask.shape)+' than image and cosmic pixel mask '+str(mask.shape)+'!!!')
         
         #check that boxsize is an odd number
         while (boxsize % 2) == 0:
@@ -287,63 +354,81 @@ def clean_cosmics(img, mask, badpixmask=None, method='median', boxsize=5, verbos
             print("Cleaning cosmic-affected pixels ...")
         
         # So...mask is a 2D-array containing False and True, where True means "here is a cosmic"
-        # We want to loop through these cosmics one by one. This is a list of the indices of cosmic affected pixels:
-        cosmicindices = np.argwhere(mask)   
-        
-        # We put cosmic ray pixels to np.Inf to flag them :
-        cleaned[mask] = np.Inf
+        # Rather than looping through these cosmics one by one, we gather the surrounding boxes of ALL cosmic-affected pixels at once. 
+        # These are the indices of cosmic affected pixels:
+        xc,yc = np.nonzero(mask)
         
-        # Now we want to have a 2 pixel frame of Inf padding around our image.
+        # Now we want to have a frame of NaN padding around our image.
         w = cleaned.shape[0]
         h = cleaned.shape[1]
-        #padsize = floor(boxsize/2.)   #same thing really...
-        padsize = int(boxsize)/2
+        padsize = int(boxsize)//2
         #create this "padarray" so that edge effects are taken care of without the need for awkward for-/if-loops around adge pixels
-        padarray = np.zeros((w+boxsize-1, h+boxsize-1)) + np.Inf
-        padarray[padsize:w+padsize,padsize:h+padsize] = cleaned.copy() # that copy is important, we need 2 independent arrays
+        padarray = np.full((w+boxsize-1, h+boxsize-1), np.nan)
+        padarray[padsize:w+padsize,padsize:h+padsize] = img
         
-        # The medians will be evaluated in this padarray, excluding the infinite values (that are either the edges, the cosmic-affected pixels or the otherwise bad pixels)
-        # Now in this copy called padarray, we also put the saturated stars to np.Inf, if available :
+        # The medians will be evaluated in this padarray, excluding the NaN values (that are either the edges, the cosmic-affected pixels or the otherwise bad pixels)
+        # So we put cosmic ray pixels to NaN to flag them, and also the saturated stars / bad pixels, if available :
+        padarray[padsize:w+padsize,padsize:h+padsize][mask] = np.nan
         if badpixmask is not None:
-            padarray[padsize:w+padsize,padsize:h+padsize][badpixmask] = np.Inf
+            padarray[padsize:w+padsize,padsize:h+padsize][badpixmask] = np.nan
         
-        # A loop through every cosmic pixel :
-        for cosmicpos in cosmicindices:
-            x = cosmicpos[0]
-            y = cosmicpos[1]
-#             if verbose:
-#                 print('[x,y] = ['+str(x)+','+str(y)+']')
-            cutout = padarray[x:x+boxsize, y:y+boxsize].ravel() # remember the shift due to the padding !
-            # Now we have our cutout pixels, some of them are np.Inf, which will be ignored for calculating median or interpolating
-            goodcutout = cutout[cutout != np.Inf]
+        # offsets of all pixels in the box relative to the centre
+        dx,dy = np.meshgrid(np.arange(-padsize,padsize+1), np.arange(-padsize,padsize+1))
+        dx = dx.ravel()
+        dy = dy.ravel()
+        
+        # backup value in case a cosmic fills the entire box
+        backupvalue = None
+        
+        # work on chunks of cosmics, so that the (ncosmics, boxsize*boxsize) cutouts do not get too large
+        chunksize = 2**16
+        for i0 in range(0, len(xc), chunksize):
+            x = xc[i0:i0+chunksize]
+            y = yc[i0:i0+chunksize]
+            # all cutouts at once, shape (ncosmics, boxsize*boxsize); remember the shift due to the padding !
+            cutouts = padarray[x[:,np.newaxis] + padsize + dy, y[:,np.newaxis] + padsize + dx]
+            good = ~np.isnan(cutouts)
+            ngood = np.sum(good, axis=1)
+            
+            with warnings.catch_warnings():
+                #all-NaN cutouts (ie huge cosmics) are dealt with below
+                warnings.simplefilter('ignore', RuntimeWarning)
+                replacementvalues = np.nanmedian(cutouts, axis=1)
+            
+            #WHICH METHOD???
+            if method in ['spline', 'surface']:
+                # fit a quadratic surface, ie z = c0 + c1*dx + c2*dy + c3*dx^2 + c4*dx*dy + c5*dy^2, to the good pixels in each box at once,
+                # and evaluate it at the centre (ie c0); need at least 6 good pixels that constrain the surface, otherwise we keep the median
+                G = np.array([np.ones(len(dx)), dx, dy, dx*dx, dx*dy, dy*dy]).T
+                fit = ngood >= G.shape[1]
+                A = np.einsum('kj,jl,jm->klm', good[fit].astype(float), G, G)
+                #the surface is not constrained if the good pixels are (eg) all in the same row(s) or column(s)
+                sv = np.linalg.svd(A, compute_uv=False)
+                constrained = sv[:,-1] > 1e-8 * sv[:,0]
+                fit[fit] = constrained
+                A = A[constrained]
+                if np.any(fit):
+                    wz = np.where(good[fit], cutouts[fit], 0.)
+                    b = np.einsum('kj,jl->kl', wz, G)
+                    c0 = solve_batched(A, b)[:,0]
+                    # do not allow the surface fit to overshoot the range of the surrounding pixels
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('ignore', RuntimeWarning)
+                        c0 = np.clip(c0, np.nanmin(cutouts[fit], axis=1), np.nanmax(cutouts[fit], axis=1))
+                    replacementvalues[fit] = np.where(np.isfinite(c0), c0, replacementvalues[fit])
+            elif method != 'median':
+                #raise RuntimeError, 'invalid kwarg for "method" !'
+                raise RuntimeError('invalid kwarg for "method" !')
             
-            if np.alen(goodcutout) >= boxsize*boxsize :
-                # This never happened, but you never know ...
-                #raise RuntimeError, "Mega error in clean !"
-                raise RuntimeError("Mega error in clean !")
-            elif np.alen(goodcutout) > 0 :
-                #WHICH METHOD???
-                if method == 'median':
-                    replacementvalue = np.median(goodcutout)
-                elif method == 'spline':
-                    print('WARNING: THIS IS NOT FULLY IMPLEMENTED YET!!!!!')
-                    box = padarray[x:x+boxsize, y:y+boxsize]
-                    goodbox = np.argwhere(box != np.Inf)
-                    xx = goodbox[:,1]
-                    yy = goodbox[:,0]
-                    zz = goodcutout
-                    spline_func = ipol.interp2d(xx,yy,zz,kind='cubic')
-                    replacementvalue = spline_func(padsize,padsize)
-                else:
-                    #raise RuntimeError, 'invalid kwarg for "method" !'
-                    raise RuntimeError('invalid kwarg for "method" !')
-            else :    
+            if np.any(ngood == 0):
                 # i.e. no good pixels : Shit, a huge cosmic, we will have to improvise ...
                 print("WARNING: Huge cosmic ray encounterd - it fills the entire ("+str(boxsize)+"x"+str(boxsize)+")-pixel cutout! Using backup value...")
-                replacementvalue = np.median(padarray[padarray != np.Inf])    #I don't like this...maybe need to do sth smarter in the future, but I doubt it will ever happen if boxsize is sufficiently large
+                if backupvalue is None:
+                    backupvalue = np.nanmedian(padarray)    #I don't like this...maybe need to do sth smarter in the future, but I doubt it will ever happen if boxsize is sufficiently large
+                replacementvalues[ngood == 0] = backupvalue
             
             # Now update the cleaned array, but remember the median was calculated from the padarray...otherwise it would depend on the order in which the cosmics are treated!!!
-            cleaned[x, y] = replacementvalue
+            cleaned[x, y] = replacementvalues
             
         # That's it.
         if verbose:
@@ -400,7 +485,7 @@ def rebin(a, newshape):
         
     shape = a.shape
     lenShape = len(shape)
-    factor = np.asarray(shape)/np.asarray(newshape)
+    factor = np.asarray(shape)//np.asarray(newshape)
     #print factor
     #evList = ['a.reshape('] + ['newshape[%d],factor[%d],'%(i,i) for i in xrange(lenShape)] + [')'] + ['.sum(%d)'%(i+1) for i in xrange(lenShape)] + ['/factor[%d]'%i for i in xrange(lenShape)]
     evList = ['a.reshape('] + ['newshape[%d],factor[%d],'%(i,i) for i in range(lenShape)] + [')'] + ['.sum(%d)'%(i+1) for i in range(lenShape)] + ['/factor[%d]'%i for i in range(lenShape)]
@@ -420,4 +505,4 @@ def rebin2x2(a):
         #raise RuntimeError, "I want even image shapes !"
         raise RuntimeError("I want even image shapes !")
         
-    return rebin(a, inshape/2)         
\ No newline at end of file
+    return rebin(a, inshape//2)         
\ No newline at end of file
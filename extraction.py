@@ -9,10 +9,13 @@ import time
 import datetime
 import astropy.io.fits as pyfits
 import os
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing.util import Finalize
 
-from helper_functions import fibmodel_with_amp, make_norm_profiles_5, short_filenames, make_norm_single_profile_simu
+from helper_functions import fibmodel_with_amp, make_norm_profiles_5, make_norm_profiles_for_order, make_norm_profiles_for_order_cached, get_bandwidth_from_fibparms, get_file_hash, short_filenames, make_norm_single_profile_simu
 from spatial_profiles import fit_single_fibre_profile
-from linalg import linalg_extract_column
+from linalg import linalg_extract_column, linalg_extract_order
 from order_tracing import flatten_single_stripe, flatten_single_stripe_from_indices, extract_stripes
 
 
@@ -93,6 +96,7 @@ def quick_extract_from_indices(img, err_img, stripe_indices, slit_height=25, ver
     'img'            : 2-dim input array
     'err_img'        : 2-dim array of the corresponding errors
     'stripe_indices' : dictionary (keys = orders) containing the indices of the pixels that are identified as the "stripes" (ie the to-be-extracted regions centred on the orders)
+                       (or alternatively the much more compact stripe geometry from "make_stripe_geometry")
     'slit_height'    : height of the extraction slit (ie the pixel columns are 2*slit_height pixels long)
     'verbose'        : boolean - for debugging...
     'timit'          : boolean - do you want to measure execution run time?
@@ -373,10 +377,14 @@ def optimal_extraction(stripes, err_stripes=None, ron_stripes=None, RON=0., slit
 
         npix = sc.shape[1]
 
-        flux[ord] = {}
-        err[ord] = {}
         pix[ord] = []
-        if not phi_onthefly and not collapse:
+        if phi_onthefly or collapse:
+            # only a single flux / error per pixel column
+            flux[ord] = []
+            err[ord] = []
+        else:
+            flux[ord] = {}
+            err[ord] = {}
             if individual_fibres:
                 for j in range(nfib):
                     fib = 'fibre_' + str(j + 1).zfill(2)
@@ -473,7 +481,7 @@ def optimal_extraction(stripes, err_stripes=None, ron_stripes=None, RON=0., slit
                     # THIS IS THE NORMAL CASE!!!
                     # NOTE: take the read-out noise as the average of the individual-pixel read-out noise values over
                     # the cutout, as it can change if we cross a quadrant boundary!
-                    f, v = linalg_extract_column(z, pix_w, phi, RON=np.mean(roncol))
+                    f, v = linalg_extract_column(z, pix_w, phi, RON=np.mean(roncol), solver='cholesky')
             else:
                 # f,v = (np.sum(z-np.median(z)), np.sum(z-np.median(z)) + len(phi)*RON*RON)   ### background should already be taken care of here...
                 # f,v = (np.sum(z), np.sum(z) + len(phi)*RON*RON)
@@ -563,12 +571,264 @@ def optimal_extraction(stripes, err_stripes=None, ron_stripes=None, RON=0., slit
 
 
 
+def optimal_extraction_single_order_batched(sc, sr, ron_sc, fppo, cols, err_sc=None, integrate_profiles=False, slope=False,
+                                            offset=False, fibs='all', solver='dense', bandwidth=None, nsig=6., phi=None):
+    """
+    Performs the optimal extraction for ALL the requested pixel columns of one order at once, rather than looping over the
+    columns and calling "linalg_extract_column" for each of them. The results are the same as for the per-column loop in
+    "optimal_extraction_from_indices".
+
+    INPUT:
+    'sc'      : the flattened stripe (from "flatten_single_stripe_from_indices"), shape (nrow, npix)
+    'sr'      : the corresponding row-indices, shape (nrow, npix)
+    'ron_sc'  : the flattened read-out noise stripe, shape (nrow, npix)
+    'fppo'    : fibre profile parameters for that order
+    'cols'    : the pixel columns to extract
+
+    OPTIONAL INPUT / KEYWORDS:
+    'err_sc'             : the flattened error stripe (if not provided, the errors are estimated as sqrt(flux + RON**2))
+    'integrate_profiles' : boolean - integrate over the pixels when creating the profiles?
+    'slope'              : boolean - include a slope (along the slit) as an extra 'fibre'?
+    'offset'             : boolean - include an offset as an extra 'fibre'?
+    'fibs'               : which fibres do you want to include? ['all', 'stellar', 'sky2', 'sky3', 'allsky']
+    'solver'             : 'dense' or 'banded' - the latter exploits the fact that each fibre profile only overlaps with its neighbours
+    'bandwidth'          : number of sub-diagonals of the cross-talk matrices for the banded solver (if not provided, it is
+                           derived from the fibre profile parameters)
+    'nsig'               : if 'bandwidth' is not provided: how many (combined) sigmas do two fibres have to be apart to be
+                           considered non-overlapping?
+    'phi'                : the normalized profiles for the cutouts, shape (ncol, nrow, nfib), if they have already been created
+                           (eg from "make_norm_profiles_for_order_cached"); otherwise they are created here
+
+    OUTPUT:
+    'f'  : the extracted fluxes, shape (ncol, nfib)
+    'v'  : the corresponding variances, shape (ncol, nfib)
+    """
+
+    Z = sc[:, cols].T
+    ron_cols = ron_sc[:, cols].T
+
+    # if error is not provided, estimate it here (NOT RECOMMENDED!!!)
+    if err_sc is None:
+        pixerr = np.sqrt(ron_cols ** 2 + np.abs(Z))
+    else:
+        pixerr = err_sc[:, cols].T
+
+    # assign weights for flux (and take care of NaNs and INFs)
+    with np.errstate(divide='ignore'):
+        W = 1. / (pixerr * pixerr)
+    W[np.isinf(W)] = 0.
+
+    # get normalized profiles for all fibres for all cutouts
+    if phi is None:
+        PHI = make_norm_profiles_for_order(sr, cols, fppo, integrate=integrate_profiles, fibs=fibs, slope=slope, offset=offset)
+    else:
+        PHI = phi
+
+    # NOTE: take the read-out noise as the average of the individual-pixel read-out noise values over
+    # the cutout, as it can change if we cross a quadrant boundary!
+    ron = np.mean(ron_cols, axis=1)
+
+    # do the optimal extraction for all columns in one go
+    if solver == 'banded' and bandwidth is None:
+        bandwidth = get_bandwidth_from_fibparms(fppo, cols=cols, nsig=nsig)
+    f, v = linalg_extract_order(Z, W, PHI, RON=ron, solver=solver, bandwidth=bandwidth, nextra=int(slope) + int(offset))
+
+    # columns where there is no profile at all
+    nophi = np.sum(PHI, axis=(1,2)) == 0
+    f[nophi,:] = 0.
+    v[nophi,:] = np.sqrt(np.sum(pixerr[nophi,:] ** 2, axis=1))[:, np.newaxis]
+
+    # not sure if this is the proper way to do this, but we can't have negative variance
+    ron2 = (ron ** 2)[:, np.newaxis]
+    v = np.where(np.logical_or(v <= 0, f <= 0), ron2, v)
+    v = np.where(v < ron2, np.maximum(ron2, 1.), v)  # just a stupid fix so that variance is never below 1
+
+    return f, v
+
+
+
+
+
+# arrays (ie image, error image, RON) shared with the worker processes of the order-parallel extraction
+shared_arrays = {}
+
+def init_extraction_worker(shm_specs):
+    """
+    Initializer for the worker processes of the order-parallel extraction (see "optimal_extraction_parallel"). Attaches to the
+    shared memory blocks containing the image, the error image and the RON image, so that these are not copied to every worker.
+    """
+    for name, (shmname, shape, dtype) in shm_specs.items():
+        shm = shared_memory.SharedMemory(name=shmname)
+        shared_arrays[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    # detach from the shared memory blocks again when the worker process exits
+    Finalize(None, close_shared_arrays, exitpriority=10)
+    return
+
+
+def close_shared_arrays():
+    """
+    Closes the shared memory blocks attached by "init_extraction_worker" (the blocks are unlinked by the parent process).
+    """
+    shms = [shm for shm, arr in shared_arrays.values()]
+    # the arrays have to be released before the memory blocks can be closed
+    shared_arrays.clear()
+    for shm in shms:
+        shm.close()
+    return
+
+
+def get_goodrange(ord, npix, simu=False):
+    """
+    Returns the pixel columns of an order that can be extracted, ie all of them, except for the range of order_01 (m = 65) that
+    does fall off the chip.
+    """
+    if ord == 'order_01':
+        if simu:
+            return np.arange(1301, 4096)
+        else:
+            return np.arange(900, 4112)
+    return np.arange(npix)
+
+
+def extract_single_order_worker(args):
+    """
+    Does the batched optimal extraction for one order in a worker process of the order-parallel extraction (see "optimal_extraction_parallel").
+    """
+    ord, indices, fppo, goodrange, slit_height, kwargs = args
+    phi_cache = kwargs.pop('phi_cache')
+    fibparms_hash = kwargs.pop('fibparms_hash')
+
+    sc, sr = flatten_single_stripe_from_indices(shared_arrays['img'][1], indices, slit_height=slit_height, timit=False)
+    ron_sc, ron_sr = flatten_single_stripe_from_indices(shared_arrays['RON'][1], indices, slit_height=slit_height, timit=False)
+    if 'err_img' in shared_arrays:
+        err_sc, err_sr = flatten_single_stripe_from_indices(shared_arrays['err_img'][1], indices, slit_height=slit_height, timit=False)
+    else:
+        err_sc = None
+
+    if phi_cache is not None:
+        phi = make_norm_profiles_for_order_cached(sr, goodrange, fppo, phi_cache, fibparms_hash, ord, slit_height=slit_height,
+                                                  integrate=kwargs['integrate_profiles'], fibs=kwargs['fibs'], slope=kwargs['slope'], offset=kwargs['offset'])
+    else:
+        phi = None
+
+    f, v = optimal_extraction_single_order_batched(sc, sr, ron_sc, fppo, goodrange, err_sc=err_sc, phi=phi, **kwargs)
+
+    return ord, f, v
+
+
+def optimal_extraction_parallel(img, err_img, RON, stripe_indices, fibparms, goodranges, nproc, slit_height=25, phi_cache=None,
+                                fibparms_hash=None, **kwargs):
+    """
+    Performs the batched optimal extraction (see "optimal_extraction_single_order_batched") for all orders, distributing the
+    orders over a pool of 'nproc' worker processes. The image, the error image and the RON image are placed in shared memory,
+    so that the workers do not have to copy them.
+
+    INPUT:
+    'img'             : 2-dim input array
+    'err_img'         : 2-dim array of the corresponding errors (or None)
+    'RON'             : 2-dim array of the read-out noise
+    'stripe_indices'  : dictionary (keys = orders) containing the indices of the pixels that are identified as the "stripes"
+    'fibparms'        : dictionary (keys = orders) containing the fibre profile parameters
+    'goodranges'      : dictionary (keys = orders) containing the pixel columns to extract
+    'nproc'           : number of worker processes
+
+    OPTIONAL INPUT / KEYWORDS:
+    'slit_height'     : height of the extraction slit is 2*slit_height pixels
+    'phi_cache'       : directory where the normalized profiles are cached (see "make_norm_profiles_for_order_cached")
+    'fibparms_hash'   : hash of the fibparms file (only needed if 'phi_cache' is provided)
+    '**kwargs'        : passed on to "optimal_extraction_single_order_batched"
+
+    OUTPUT:
+    'results'  : dictionary (keys = orders) containing the tuples (f,v) of extracted fluxes and variances, each of shape (ncol, nfib)
+    """
+
+    arrays = {'img': img, 'RON': RON}
+    if err_img is not None:
+        arrays['err_img'] = err_img
+
+    shms = []
+    try:
+        # place the arrays in shared memory
+        shm_specs = {}
+        for name, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+            shms.append(shm)
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+            shm_specs[name] = (shm.name, arr.shape, arr.dtype)
+
+        tasks = []
+        for ord in sorted(stripe_indices.keys()):
+            taskkwargs = dict(kwargs, phi_cache=phi_cache, fibparms_hash=fibparms_hash)
+            tasks.append((ord, stripe_indices[ord], fibparms[ord], goodranges[ord], slit_height, taskkwargs))
+
+        pool = multiprocessing.Pool(processes=nproc, initializer=init_extraction_worker, initargs=(shm_specs,))
+        try:
+            results = {}
+            for ord, f, v in pool.imap_unordered(extract_single_order_worker, tasks):
+                results[ord] = (f, v)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    return results
+
+
+
+
+
+def get_object_columns(nfib):
+    """
+    Returns the columns of the extracted fibre intensities (as created from the profiles in "make_norm_profiles_5", ie the
+    first 'nfib' columns, with any slope and/or offset "fibres" after that) that belong to the different "objects"
+    (Laser, Sky, Stellar, ThXe). The current IFU only has 24 fibres (19 stellar + 5 sky), ie there are no profiles for
+    the calibration fibres, so the laser and thxe columns are empty.
+
+    INPUT:
+    'nfib'  : number of fibres that were extracted (24 for fibs='all', 19 for 'stellar', 2 for 'sky2', 3 for 'sky3',
+              5 for 'allsky', 1 for 'single')
+
+    OUTPUT:
+    'objcols'  : dictionary (keys = 'laser', 'sky', 'stellar', 'thxe') containing the column indices for each object
+    """
+
+    objcols = {'laser': np.array([], dtype=int), 'sky': np.array([], dtype=int), 'stellar': np.array([], dtype=int),
+               'thxe': np.array([], dtype=int)}
+
+    if nfib == 24:
+        objcols['sky'] = np.r_[np.arange(2), np.arange(21, 24)]
+        objcols['stellar'] = np.arange(2, 21)
+    elif nfib in [2, 3, 5]:
+        objcols['sky'] = np.arange(nfib)
+    else:
+        objcols['stellar'] = np.arange(nfib)
+
+    return objcols
+
+
+
+
+
 def optimal_extraction_from_indices(img, stripe_indices, err_img=None, RON=0., slit_height=25,
                                     phi_onthefly=False, timit=False, simu=False, individual_fibres=True,
                                     combined_profiles=False, integrate_profiles=False, slope=False, offset=False,
-                                    fibs='all', fibpos='01', relints=None, collapse=False, debug_level=0):
+                                    fibs='all', fibpos='01', relints=None, collapse=False, batched=True, solver='dense',
+                                    bandwidth=None, phi_cache=None, nproc=1, return_arrays=False, debug_level=0):
     # if error array is not provided, then RON and gain must be provided (but this is bad because that way we don't
     # know about large errors for the cosmic-corrected pixels etc)
+    # if 'batched' is set to TRUE, all pixel columns of an order are extracted at once (only for pre-computed individual-fibre
+    # profiles, ie not for phi_onthefly / combined_profiles / collapse / simu, which still use the per-column loop)
+    # 'solver' ('dense' or 'banded') and 'bandwidth' are only used for the batched extraction
+    # 'phi_cache' is a directory where the normalized profiles are cached (only for the batched extraction; default is no caching)
+    # 'nproc' is the number of processes over which the orders are distributed (only for the batched extraction; default is no parallelisation)
+    # if 'return_arrays' is set to TRUE, the outputs are also returned as arrays, ie pixarr (n_ord, n_pix) containing integer pixel IDs (ordnum*10000 + pixnum),
+    # fluxarr & errarr (n_ord, n_fib, n_pix) (or (n_ord, 4, n_pix) for the 4 objects [laser, sky, stellar, thxe] if individual_fibres is FALSE),
+    # and addarr & adderrarr (n_ord, n_add, n_pix) containing the offset and/or slope terms (in that order) if 'slope' and/or 'offset' are set
+    # (only for the batched extraction; None otherwise); for 'collapse' or 'phi_onthefly', fluxarr & errarr are (n_ord, n_pix)
 
     if timit:
         start_time = time.time()
@@ -600,14 +860,50 @@ def optimal_extraction_from_indices(img, stripe_indices, err_img=None, RON=0., s
         # fibparms = np.load('/Users/christoph/OneDrive - UNSW/fibre_profiles/real/from_master_white_40orders.npy').item()
         # fibparms = np.load('/Users/christoph/OneDrive - UNSW/fibre_profiles/fibre_profile_fits_20180925.npy').item()
         print('Oha! Loading NEWest fibre profile parameters...')
-        fibparms = np.load('/Users/christoph/OneDrive - UNSW/fibre_profiles/fibre_profile_fits_20181107.npy').item()
+        fibparms_file = '/Users/christoph/OneDrive - UNSW/fibre_profiles/fibre_profile_fits_20181107.npy'
+        fibparms = np.load(fibparms_file).item()
+    # the hash of the fibparms file is only needed for the profile cache
+    if phi_cache is not None and not simu:
+        fibparms_hash = get_file_hash(fibparms_file)
+    else:
+        fibparms_hash = None
 
     flux = {}
     err = {}
     pix = {}
 
+    use_batched = batched and not phi_onthefly and not combined_profiles and not collapse and not simu
+
+    # integer pixel IDs, ie ordnum*10000 + pixnum (same as the string labels in "pix", but created in one go)
+    orders = sorted(stripe_indices.keys())
+    pixarr = np.array([int(ord[-2:]) * 10000 for ord in orders])[:, np.newaxis] + np.arange(1, img.shape[1] + 1)
+    # for the batched extraction, the output arrays are preallocated and filled directly (the dictionaries only contain views into these arrays)
+    if use_batched:
+        if individual_fibres:
+            fluxarr = np.zeros((len(orders), nfib, img.shape[1]))
+        else:
+            fluxarr = np.zeros((len(orders), 4, img.shape[1]))
+        errarr = np.zeros(fluxarr.shape)
+        # the offset and/or slope "fibres" are kept separately
+        addarr = np.zeros((len(orders), int(slope) + int(offset), img.shape[1]))
+        adderrarr = np.zeros(addarr.shape)
+    else:
+        addarr = None
+        adderrarr = None
+    objcols = get_object_columns(nfib)
+
+    # extract all orders in parallel (if desired) first
+    parallel_results = {}
+    if use_batched and nproc > 1:
+        # exclude the range of order_01 (m = 65) that does fall off the chip! (same as for the serial extraction below)
+        goodranges = {ord: get_goodrange(ord, img.shape[1], simu=simu) for ord in stripe_indices.keys()}
+        parallel_results = optimal_extraction_parallel(img, err_img, RON, stripe_indices, fibparms, goodranges, nproc, slit_height=slit_height,
+                                                       phi_cache=phi_cache, fibparms_hash=fibparms_hash,
+                                                       integrate_profiles=integrate_profiles, slope=slope, offset=offset, fibs=fibs,
+                                                       solver=solver, bandwidth=bandwidth)
+
     # loop over all orders
-    for ord in sorted(stripe_indices.iterkeys()):
+    for o, ord in enumerate(orders):
         if debug_level > 0:
             print('OK, now processing order: ' + ordnum)
         if timit:
@@ -624,17 +920,22 @@ def optimal_extraction_from_indices(img, stripe_indices, err_img=None, RON=0., s
         indices = stripe_indices[ord]
         # find the "order-box"
         # sc,sr = flatten_single_stripe(stripe,slit_height=slit_height,timit=False)
-        sc, sr = flatten_single_stripe_from_indices(img, indices, slit_height=slit_height, timit=False)
-        ron_sc, ron_sr = flatten_single_stripe_from_indices(RON, indices, slit_height=slit_height, timit=False)
-        if err_img is not None:
-            err_sc, err_sr = flatten_single_stripe_from_indices(err_img, indices, slit_height=slit_height, timit=False)
+        if ord not in parallel_results:
+            sc, sr = flatten_single_stripe_from_indices(img, indices, slit_height=slit_height, timit=False)
+            ron_sc, ron_sr = flatten_single_stripe_from_indices(RON, indices, slit_height=slit_height, timit=False)
+            if err_img is not None:
+                err_sc, err_sr = flatten_single_stripe_from_indices(err_img, indices, slit_height=slit_height, timit=False)
 
-        npix = sc.shape[1]
+        npix = img.shape[1]
 
-        flux[ord] = {}
-        err[ord] = {}
         pix[ord] = []
-        if not phi_onthefly and not collapse:
+        if phi_onthefly or collapse:
+            # only a single flux / error per pixel column
+            flux[ord] = []
+            err[ord] = []
+        else:
+            flux[ord] = {}
+            err[ord] = {}
             if individual_fibres:
                 if nfib == 1:
                     fib = 'fibre_' + fibpos
@@ -663,175 +964,197 @@ def optimal_extraction_from_indices(img, stripe_indices, err_img=None, RON=0., s
         #             e_ord = np.zeros(npix)
 
         # exclude the range of order_01 (m = 65) that does fall off the chip!
-        goodrange = np.arange(npix)
-        if simu and ord == 'order_01':
-            # goodrange = goodrange[fibparms[ord]['fibre_21']['onchip']]
-            goodrange = np.arange(1301, 4096)
-            for j in range(1301):
-                pix[ord].append(ordnum + str(j + 1).zfill(4))
-        if not simu and ord == 'order_01':
-            # goodrange = goodrange[fibparms[ord]['fibre_21']['onchip']]
-            goodrange = np.arange(900, 4112)
-            for j in range(900):
-                pix[ord].append(ordnum + str(j + 1).zfill(4))
-
-
-        for i in goodrange:
-            if debug_level > 0:
-                print('pixel ' + str(i + 1) + '/' + str(npix))
-            pix[ord].append(ordnum + str(i + 1).zfill(4))
-            z = sc[:, i].copy()
-            # if simu:
-            #     z -= 1.  # note the minus 1 is because we added 1 artificially at the beginning in order for "extract_stripes" to work properly
-            roncol = ron_sc[:, i].copy()
-
-            # if error is not provided, estimate it here (NOT RECOMMENDED!!!)
-            if err_img is None:
-                pixerr = np.sqrt(ron_sc[:, i] ** 2 + np.abs(z))
+        # goodrange = goodrange[fibparms[ord]['fibre_21']['onchip']]
+        goodrange = get_goodrange(ord, npix, simu=simu)
+
+        if use_batched:
+            # extract all pixel columns of this order at once
+            pix[ord] = np.char.mod('%06d', pixarr[o]).tolist()
+            if ord in parallel_results:
+                # already extracted by the worker processes
+                f, v = parallel_results[ord]
             else:
-                pixerr = err_sc[:, i].copy()
-
-            # assign weights for flux (and take care of NaNs and INFs)
-            pix_w = 1. / (pixerr * pixerr)
-
-            # Initially I thought this was clearly rubbish as it down-weights the central parts
-            # and that we really want to use the relative errors, ie w_i = 1/(relerr_i)**2
-            # relerr = pixerr / z     ### the pixel err
-            # pix_w = 1. / (relerr)**2
-            # HOWEVER: this is not true, and the optimal extraction linalg routine requires absolute errors!!!
+                if phi_cache is not None:
+                    phi = make_norm_profiles_for_order_cached(sr, goodrange, fppo, phi_cache, fibparms_hash, ord, slit_height=slit_height,
+                                                              integrate=integrate_profiles, fibs=fibs, slope=slope, offset=offset)
+                else:
+                    phi = None
+                f, v = optimal_extraction_single_order_batched(sc, sr, ron_sc, fppo, goodrange, err_sc=err_sc if err_img is not None else None,
+                                                               integrate_profiles=integrate_profiles, slope=slope, offset=offset, fibs=fibs,
+                                                               solver=solver, bandwidth=bandwidth, phi=phi)
+
+            # the offset and/or slope "fibres" (if any) come after the actual fibres
+            addarr[o][:, goodrange] = f[:, nfib:].T
+            adderrarr[o][:, goodrange] = np.sqrt(v[:, nfib:]).T
+            if individual_fibres:
+                # fill flux- and error- output arrays for individual fibres
+                fluxarr[o][:, goodrange] = f[:, :nfib].T
+                errarr[o][:, goodrange] = np.sqrt(v[:, :nfib]).T
+            else:
+                # Optimal extraction was done for all fibres individually, but now add up the respective "eta's"
+                # for the different "objects" (Laser, Sky, Stellar, ThXe)
+                for k, obj in enumerate(['laser', 'sky', 'stellar', 'thxe']):
+                    fluxarr[o][k, goodrange] = np.sum(f[:, objcols[obj]], axis=1)
+                    errarr[o][k, goodrange] = np.sqrt(np.sum(v[:, objcols[obj]], axis=1))
 
-            # check for NaNs etc
-            pix_w[np.isinf(pix_w)] = 0.
+            # the dictionaries are just views into the output arrays
+            for j, fib in enumerate(sorted(flux[ord].keys())):
+                flux[ord][fib] = fluxarr[o, j]
+                err[ord][fib] = errarr[o, j]
 
-            if phi_onthefly:
-                quickfit = fit_single_fibre_profile(sr[:, i], z)
-                bestparms = np.array([quickfit.best_values['mu'], quickfit.best_values['sigma'],
-                                      quickfit.best_values['amp'], quickfit.best_values['beta']])
-                phi = fibmodel_with_amp(sr[:, i], *bestparms)
-                phi /= np.max([np.sum(phi), 0.001])  # we can do this because grid-stepsize = 1; also make sure that we do not divide by zero
-                phi = phi.reshape(len(phi), 1)  # stupid python...
-            else:
-                # get normalized profiles for all fibres for this cutout
-                if combined_profiles:
-                    print('WARNING: we currently do not have a profile estimate for the calibration fibres!!!')
-                    phi_laser = np.sum(make_norm_profiles_4(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='laser'), axis=1)
-                    phi_thxe = np.sum(make_norm_profiles_4(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='thxe'), axis=1)
-                    phis_sky3 = make_norm_profiles_4(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='sky3')
-                    phi_sky3 = np.sum(phis_sky3, axis=1) / 3.
-                    phis_stellar = make_norm_profiles_4(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='stellar')
-                    phi_stellar = np.sum(phis_stellar * relints, axis=1)
-                    phis_sky2 = make_norm_profiles_4(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='sky2')
-                    phi_sky2 = np.sum(phis_sky2, axis=1) / 2.
-                    phi_sky = (phi_sky3 + phi_sky2) / 2.
-                    phi = np.vstack((phi_laser, phi_sky, phi_stellar, phi_thxe)).T
+        else:
+            for j in range(goodrange[0]):
+                pix[ord].append(ordnum + str(j + 1).zfill(4))
+            for i in goodrange:
+                if debug_level > 0:
+                    print('pixel ' + str(i + 1) + '/' + str(npix))
+                pix[ord].append(ordnum + str(i + 1).zfill(4))
+                z = sc[:, i].copy()
+                # if simu:
+                #     z -= 1.  # note the minus 1 is because we added 1 artificially at the beginning in order for "extract_stripes" to work properly
+                roncol = ron_sc[:, i].copy()
+
+                # if error is not provided, estimate it here (NOT RECOMMENDED!!!)
+                if err_img is None:
+                    pixerr = np.sqrt(ron_sc[:, i] ** 2 + np.abs(z))
                 else:
-                    # phi = make_norm_profiles(sr[:,i], ord, i, fibparms)
-                    # phi = make_norm_profiles_temp(sr[:,i], ord, i, fibparms)
-                    # phi = make_norm_single_profile_temp(sr[:,i], ord, i, fibparms)
-                    if simu:
-                        phi = make_norm_single_profile_simu(sr[:, i], i, fppo, slope=slope, offset=offset, fib=fibpos)
+                    pixerr = err_sc[:, i].copy()
+
+                # assign weights for flux (and take care of NaNs and INFs)
+                pix_w = 1. / (pixerr * pixerr)
+
+                # Initially I thought this was clearly rubbish as it down-weights the central parts
+                # and that we really want to use the relative errors, ie w_i = 1/(relerr_i)**2
+                # relerr = pixerr / z     ### the pixel err
+                # pix_w = 1. / (relerr)**2
+                # HOWEVER: this is not true, and the optimal extraction linalg routine requires absolute errors!!!
+
+                # check for NaNs etc
+                pix_w[np.isinf(pix_w)] = 0.
+
+                if phi_onthefly:
+                    quickfit = fit_single_fibre_profile(sr[:, i], z)
+                    bestparms = np.array([quickfit.best_values['mu'], quickfit.best_values['sigma'],
+                                          quickfit.best_values['amp'], quickfit.best_values['beta']])
+                    phi = fibmodel_with_amp(sr[:, i], *bestparms)
+                    phi /= np.max([np.sum(phi), 0.001])  # we can do this because grid-stepsize = 1; also make sure that we do not divide by zero
+                    phi = phi.reshape(len(phi), 1)  # stupid python...
+                else:
+                    # get normalized profiles for all fibres for this cutout
+                    if combined_profiles:
+                        print('WARNING: we currently do not have a profile estimate for the calibration fibres!!!')
+                        phi_laser = np.sum(make_norm_profiles_4(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='laser'), axis=1)
+                        phi_thxe = np.sum(make_norm_profiles_4(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='thxe'), axis=1)
+                        phis_sky3 = make_norm_profiles_4(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='sky3')
+                        phi_sky3 = np.sum(phis_sky3, axis=1) / 3.
+                        phis_stellar = make_norm_profiles_4(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='stellar')
+                        phi_stellar = np.sum(phis_stellar * relints, axis=1)
+                        phis_sky2 = make_norm_profiles_4(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='sky2')
+                        phi_sky2 = np.sum(phis_sky2, axis=1) / 2.
+                        phi_sky = (phi_sky3 + phi_sky2) / 2.
+                        phi = np.vstack((phi_laser, phi_sky, phi_stellar, phi_thxe)).T
                     else:
-                        phi = make_norm_profiles_5(sr[:, i], i, fppo, integrate=integrate_profiles, slope=slope, offset=offset, fibs=fibs)
-
-            # print('WARNING: TEMPORARY offset correction is not commented out!!!')
-            # # subtract the median as the offset if BG is not properly corrected for
-            # z -= np.median(z)
-
-            # do the optimal extraction
-            if not collapse:
-                if np.sum(phi) == 0:
-                    # f,v = (0.,np.sqrt(len(phi)*RON*RON))
-                    f, v = (0., np.sqrt(np.sum(pixerr * pixerr)))
+                        # phi = make_norm_profiles(sr[:,i], ord, i, fibparms)
+                        # phi = make_norm_profiles_temp(sr[:,i], ord, i, fibparms)
+                        # phi = make_norm_single_profile_temp(sr[:,i], ord, i, fibparms)
+                        if simu:
+                            phi = make_norm_single_profile_simu(sr[:, i], i, fppo, slope=slope, offset=offset, fib=fibpos)
+                        else:
+                            phi = make_norm_profiles_5(sr[:, i], i, fppo, integrate=integrate_profiles, slope=slope, offset=offset, fibs=fibs)
+
+                # print('WARNING: TEMPORARY offset correction is not commented out!!!')
+                # # subtract the median as the offset if BG is not properly corrected for
+                # z -= np.median(z)
+
+                # do the optimal extraction
+                if not collapse:
+                    if np.sum(phi) == 0:
+                        # f,v = (0.,np.sqrt(len(phi)*RON*RON))
+                        f, v = (0., np.sqrt(np.sum(pixerr * pixerr)))
+                    else:
+                        # THIS IS THE NORMAL CASE!!!
+                        # NOTE: take the read-out noise as the average of the individual-pixel read-out noise values over
+                        # the cutout, as it can change if we cross a quadrant boundary!
+                        f, v = linalg_extract_column(z, pix_w, phi, RON=np.mean(roncol), solver='cholesky')
                 else:
-                    # THIS IS THE NORMAL CASE!!!
-                    # NOTE: take the read-out noise as the average of the individual-pixel read-out noise values over
-                    # the cutout, as it can change if we cross a quadrant boundary!
-                    f, v = linalg_extract_column(z, pix_w, phi, RON=np.mean(roncol))
-            else:
-                # f,v = (np.sum(z-np.median(z)), np.sum(z-np.median(z)) + len(phi)*RON*RON)   ### background should already be taken care of here...
-                # f,v = (np.sum(z), np.sum(z) + len(phi)*RON*RON)
-                f, v = (np.sum(z), np.sqrt(np.sum(pixerr * pixerr)))
-
-            # e = np.sqrt(v)
-            # model = np.sum(f*phi,axis=1)
-
-            # fill output arrays depending on the selected method
-            if not phi_onthefly and not collapse:
+                    # f,v = (np.sum(z-np.median(z)), np.sum(z-np.median(z)) + len(phi)*RON*RON)   ### background should already be taken care of here...
+                    # f,v = (np.sum(z), np.sum(z) + len(phi)*RON*RON)
+                    f, v = (np.sum(z), np.sqrt(np.sum(pixerr * pixerr)))
+
+                # e = np.sqrt(v)
+                # model = np.sum(f*phi,axis=1)
+
+                # fill output arrays depending on the selected method
+                if not phi_onthefly and not collapse:
+
+                    # theoretically there should not be negative values, but we will allow them (bias and dark subtraction can produce those)
+                    # f[f < 0] = 0.
+                    # however, their errors are treated below
+                    # not sure if this is the proper way to do this, but we can't have negative variance
+                    # v[np.logical_or(v<=0,f<=0)] = RON*RON
+                    # v[v<RON*RON] = np.maximum(RON*RON,1.)   # just a stupid fix so that variance is never below 1
+                    v[np.logical_or(v <= 0, f <= 0)] = np.mean(roncol) ** 2
+                    v[v < np.mean(roncol) ** 2] = np.maximum(np.mean(roncol) ** 2, 1.)  # just a stupid fix so that variance is never below 1
+
+                    if individual_fibres:
+                        # fill flux- and error- output arrays for individual fibres
+                        if nfib == 1:
+                            fib = 'fibre_' + fibpos
+                            flux[ord][fib].append(f)
+                            err[ord][fib].append(np.sqrt(v))
+                        else:
+                            for j in range(nfib):
+                                fib = 'fibre_' + str(j + 1).zfill(2)
+                                flux[ord][fib].append(f[j])
+                                err[ord][fib].append(np.sqrt(v[j]))
+
+                    elif combined_profiles:
+                        # fill flux- and error- output arrays for all objects (Laser, Sky, Stellar, ThXe)
+                        # Laser
+                        flux[ord]['laser'].append(f[0])
+                        err[ord]['laser'].append(np.sqrt(v[0]))
+                        # Sky
+                        flux[ord]['sky'].append(f[1])
+                        err[ord]['sky'].append(np.sqrt(v[1]))
+                        # Stellar
+                        flux[ord]['stellar'].append(f[2])
+                        err[ord]['stellar'].append(np.sqrt(v[2]))
+                        # ThXe
+                        flux[ord]['thxe'].append(f[3])
+                        err[ord]['thxe'].append(np.sqrt(v[3]))
 
-                # theoretically there should not be negative values, but we will allow them (bias and dark subtraction can produce those)
-                # f[f < 0] = 0.
-                # however, their errors are treated below
-                # not sure if this is the proper way to do this, but we can't have negative variance
-                # v[np.logical_or(v<=0,f<=0)] = RON*RON
-                # v[v<RON*RON] = np.maximum(RON*RON,1.)   # just a stupid fix so that variance is never below 1
-                v[np.logical_or(v <= 0, f <= 0)] = np.mean(roncol) ** 2
-                v[v < np.mean(roncol) ** 2] = np.maximum(np.mean(roncol) ** 2, 1.)  # just a stupid fix so that variance is never below 1
-
-                if individual_fibres:
-                    # fill flux- and error- output arrays for individual fibres
-                    if nfib == 1:
-                        fib = 'fibre_' + fibpos
-                        flux[ord][fib].append(f)
-                        err[ord][fib].append(np.sqrt(v))
                     else:
-                        for j in range(nfib):
-                            fib = 'fibre_' + str(j + 1).zfill(2)
-                            flux[ord][fib].append(f[j])
-                            err[ord][fib].append(np.sqrt(v[j]))
-
-                elif combined_profiles:
-                    # fill flux- and error- output arrays for all objects (Laser, Sky, Stellar, ThXe)
-                    # Laser
-                    flux[ord]['laser'].append(f[0])
-                    err[ord]['laser'].append(np.sqrt(v[0]))
-                    # Sky
-                    flux[ord]['sky'].append(f[1])
-                    err[ord]['sky'].append(np.sqrt(v[1]))
-                    # Stellar
-                    flux[ord]['stellar'].append(f[2])
-                    err[ord]['stellar'].append(np.sqrt(v[2]))
-                    # ThXe
-                    flux[ord]['thxe'].append(f[3])
-                    err[ord]['thxe'].append(np.sqrt(v[3]))
+                        # Optimal extraction was done for all fibres individually, but now add up the respective "eta's"
+                        # for the different "objects"
+                        # fill flux- and error- output arrays for all objects (Laser, Sky, Stellar, ThXe)
+                        for obj in ['laser', 'sky', 'stellar', 'thxe']:
+                            flux[ord][obj].append(np.sum(f[objcols[obj]]))
+                            err[ord][obj].append(np.sqrt(np.sum(v[objcols[obj]])))
 
                 else:
-                    # Optimal extraction was done for all fibres individually, but now add up the respective "eta's"
-                    # for the different "objects"
-                    # fill flux- and error- output arrays for all objects (Laser, Sky, Stellar, ThXe)
-                    # Laser
-                    flux[ord]['laser'].append(f[0])
-                    err[ord]['laser'].append(np.sqrt(v[0]))
-                    # Sky
-                    flux[ord]['sky'].append(np.sum(f[1:4]) + np.sum(f[25:27]))
-                    err[ord]['sky'].append(np.sqrt(np.sum(v[1:4]) + np.sum(v[25:27])))
-                    # Stellar
-                    flux[ord]['stellar'].append(np.sum(f[5:24]))
-                    err[ord]['stellar'].append(np.sqrt(np.sum(v[5:24])))
-                    # ThXe
-                    flux[ord]['thxe'].append(f[27])
-                    err[ord]['thxe'].append(np.sqrt(v[27]))
-
-            else:
-                # flux[ord].append(np.max([f, 0.]))
-                flux[ord].append(f)
-                # if f <= 0 or v <= 0:
-                if v <= 0:
-                    # err[ord].append(np.sqrt(len(phi)*RON*RON))
-                    err[ord].append(np.sqrt(np.sum(pixerr * pixerr)))
-                else:
-                    err[ord].append(np.sqrt(v))
+                    # flux[ord].append(np.max([f, 0.]))
+                    flux[ord].append(f)
+                    # if f <= 0 or v <= 0:
+                    if v <= 0:
+                        # err[ord].append(np.sqrt(len(phi)*RON*RON))
+                        err[ord].append(np.sqrt(np.sum(pixerr * pixerr)))
+                    else:
+                        err[ord].append(np.sqrt(v))
 
 
-        # fix for order_01
-        if ord == 'order_01':
+        # fix for order_01 (not needed for the batched extraction, as the output arrays already cover all pixels)
+        if ord == 'order_01' and not use_batched:
             if simu:
-                for fib in sorted(flux[ord].keys()):
-                    flux['order_01'][fib] = np.r_[np.repeat(0., 1301), np.squeeze(flux['order_01'][fib])]
-                    err['order_01'][fib] = np.r_[np.repeat(0., 1301), np.squeeze(err['order_01'][fib])]
+                nmiss = 1301
+            else:
+                nmiss = 900
+            if phi_onthefly or collapse:
+                flux['order_01'] = np.r_[np.repeat(0., nmiss), np.squeeze(flux['order_01'])]
+                err['order_01'] = np.r_[np.repeat(0., nmiss), np.squeeze(err['order_01'])]
             else:
                 for fib in sorted(flux[ord].keys()):
-                    flux['order_01'][fib] = np.r_[np.repeat(0., 900), flux['order_01'][fib]]
-                    err['order_01'][fib] = np.r_[np.repeat(0., 900), err['order_01'][fib]]
+                    flux['order_01'][fib] = np.r_[np.repeat(0., nmiss), np.squeeze(flux['order_01'][fib])]
+                    err['order_01'][fib] = np.r_[np.repeat(0., nmiss), np.squeeze(err['order_01'][fib])]
 
         if timit:
             print('Time taken for extraction of ' + ord + ': ' + str(time.time() - order_start_time) + ' seconds')
@@ -840,7 +1163,18 @@ def optimal_extraction_from_indices(img, stripe_indices, err_img=None, RON=0., s
         print('Time elapsed for optimal extraction of entire spectrum: ' + str(
             time.time() - start_time) + ' seconds...')
 
-    return pix, flux, err
+    if return_arrays:
+        if not use_batched:
+            if phi_onthefly or collapse:
+                # only one flux per pixel, ie the arrays are (n_ord, n_pix)
+                fluxarr = np.array([np.squeeze(flux[ord]) for ord in orders])
+                errarr = np.array([np.squeeze(err[ord]) for ord in orders])
+            else:
+                fluxarr = np.array([[np.squeeze(flux[ord][fib]) for fib in sorted(flux[ord].keys())] for ord in orders])
+                errarr = np.array([[np.squeeze(err[ord][fib]) for fib in sorted(err[ord].keys())] for ord in orders])
+        return pix, flux, err, pixarr, fluxarr, errarr, addarr, adderrarr
+    else:
+        return pix, flux, err
 
 
 
@@ -995,6 +1329,16 @@ def extract_spectrum(stripes, err_stripes, ron_stripes, method='optimal', indivi
                 h_err = h.copy()
                 h_err['HISTORY'] = 'estimated uncertainty in EXTRACTED SPECTRUM - created '+time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())+' (GMT)'
                 pyfits.append(outfn, errarr, h_err, clobber=True)
+                #and the offset and/or slope terms (if any), with dimensions (n_ord, n_add, n_pix)
+                if method.lower() == 'optimal' and addarr is not None and addarr.shape[1] > 0:
+                    addnames = ['offset'] * offset + ['slope'] * slope
+                    h_add = h.copy()
+                    h_add['HISTORY'] = 'OFFSET / SLOPE terms of EXTRACTED SPECTRUM - created '+time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())+' (GMT)'
+                    h_add['ADDTERMS'] = (','.join(addnames), 'extra terms along 2nd axis')
+                    pyfits.append(outfn, addarr, h_add)
+                    h_adderr = h_add.copy()
+                    h_adderr['HISTORY'] = 'estimated uncertainty in OFFSET / SLOPE terms of EXTRACTED SPECTRUM'
+                    pyfits.append(outfn, adderrarr, h_adderr)
                 
             if filetype in ['dict', 'both']:
                 #OK, save as a python dictionary
@@ -1012,7 +1356,7 @@ def extract_spectrum(stripes, err_stripes, ron_stripes, method='optimal', indivi
 
 
 def extract_spectrum_from_indices(img, err_img, stripe_indices, method='optimal', individual_fibres=True, combined_profiles=False, integrate_profiles=False, slope=False,
-                                  offset=False, fibs='all', fibpos='01', slit_height=25, RON=0., savefile=False, filetype='fits', obsname=None, path=None, simu=False, verbose=False, timit=False, debug_level=0):
+                                  offset=False, fibs='all', fibpos='01', slit_height=25, RON=0., savefile=False, filetype='fits', obsname=None, path=None, simu=False, batched=True, solver='dense', bandwidth=None, phi_cache=None, nproc=1, verbose=False, timit=False, debug_level=0):
     """
     CLONE OF 'extract_spectrum'!
     This routine is simply a wrapper code for the different extraction methods. There are a total FIVE (1,2,3a,3b,3c) different extraction methods implemented, 
@@ -1042,6 +1386,7 @@ def extract_spectrum_from_indices(img, err_img, stripe_indices, method='optimal'
     'img'            : 2-dim input array
     'err_img'        : 2-dim array of the corresponding errors
     'stripe_indices' : dictionary (keys = orders) containing the indices of the pixels that are identified as the "stripes" (ie the to-be-extracted regions centred on the orders)
+                       (or alternatively the much more compact stripe geometry from "make_stripe_geometry")
     
     OPTIONAL INPUT / KEYWORDS:
     'method'             : method for extraction - valid options are ["quick" / "tramline" / "optimal"]
@@ -1056,10 +1401,17 @@ def extract_spectrum_from_indices(img, err_img, stripe_indices, method='optimal'
     'RON'                : read-out noise per pixel
     'gain'               : gain
     'savefile'           : boolean - do you want to save the extracted spectrum to a file? 
-    'filetype'           : if 'savefile' is set to TRUE: do you want to save it as a 'fits' file, or as a 'dict' (python disctionary)
+    'filetype'           : if 'savefile' is set to TRUE: do you want to save it as a 'fits' file, or as a 'dict' (python disctionary);
+                           for the batched optimal extraction with 'slope' and/or 'offset', the FITS file has two more HDUs containing the
+                           offset and/or slope terms and their uncertainties
     'obsname'            : (short) name of observation file
     'path'               : directory to the destination of the output file
     'simu'               : boolean - are you using ES-simulated spectra???
+    'batched'            : boolean - do you want to extract all pixel columns of an order at once (much faster)? [only for method (3a) & (3b)]
+    'solver'             : solver for the batched extraction - 'dense' or 'banded' (the latter exploits the fact that each fibre profile only overlaps with its neighbours)
+    'bandwidth'          : number of sub-diagonals for the banded solver (if not provided, it is derived from the fibre profile sigmas)
+    'phi_cache'          : directory where the normalized profiles are cached (memory-mapped), so that they can be re-used for all frames [only for batched extraction]
+    'nproc'              : number of processes over which the orders are distributed (image, error image and RON are shared, not copied) [only for batched extraction]
     'verbose'            : boolean - for debugging...
     'timit'              : boolean - do you want to measure execution run time?
     'debug_level'        : for debugging...
@@ -1087,9 +1439,12 @@ def extract_spectrum_from_indices(img, err_img, stripe_indices, method='optimal'
         #tramlines = find_tramlines(fibre_profiles_02, fibre_profiles_03, fibre_profiles_21, fibre_profiles_22, mask_02, mask_03, mask_21, mask_22)
         #pix,flux,err = collapse_extract_from_indices(img, err_img, stripe_indices, tramlines, slit_height=slit_height, verbose=verbose, timit=timit, debug_level=debug_level)
     elif method.lower() == 'optimal':
-        pix,flux,err = optimal_extraction_from_indices(img, stripe_indices, err_img=err_img, RON=RON, slit_height=slit_height, individual_fibres=individual_fibres,
-                                                       combined_profiles=combined_profiles, integrate_profiles=integrate_profiles, slope=slope, offset=offset, fibs=fibs, 
-                                                       fibpos=fibpos, simu=simu, timit=timit, debug_level=debug_level)
+        pix,flux,err,pixarr,fluxarr,errarr,addarr,adderrarr = optimal_extraction_from_indices(img, stripe_indices, err_img=err_img, RON=RON, slit_height=slit_height,
+                                                                             individual_fibres=individual_fibres, combined_profiles=combined_profiles,
+                                                                             integrate_profiles=integrate_profiles, slope=slope, offset=offset, fibs=fibs,
+                                                                             fibpos=fibpos, simu=simu, batched=batched, solver=solver, bandwidth=bandwidth,
+                                                                             phi_cache=phi_cache, nproc=nproc, return_arrays=True, timit=timit,
+                                                                             debug_level=debug_level)
     else:
         print('ERROR: Nightmare! That should never happen  --  must be an error in the Matrix...')
         return    
@@ -1125,13 +1480,10 @@ def extract_spectrum_from_indices(img, err_img, stripe_indices, method='optimal'
                 print('ERROR: file type for output file not recognized!')
                 filetype = raw_input('Which file type do you want to use (valid options are ["fits" / "dict" / "both"] )?') 
             if filetype in ['fits', 'both']:
-                if method.lower() == 'optimal' and submethod == '3a':      # ie for individual-fibre extraction
-                    fluxarr = np.zeros((len(pix), len(flux['order_01']), len(pix['order_01'])))
-                    errarr = np.zeros((len(pix), len(flux['order_01']), len(pix['order_01'])))
-                    for i,o in enumerate(sorted(pix.keys())):
-                        for j,fib in enumerate(sorted(flux[o].keys())):
-                            fluxarr[i,j,:] = flux[o][fib]
-                            errarr[i,j,:] = err[o][fib]
+                if method.lower() == 'optimal':
+                    # fluxarr & errarr are returned directly by the optimal extraction, with dimensions (n_ord, n_fib, n_pix) for
+                    # individual-fibre extraction (3a), or (n_ord, 4, n_pix) for the 4 objects [laser, sky, stellar, thxe] (3b & 3c)
+                    pass
                 else:
                     fluxarr = np.zeros((len(pix), len(pix['order_01'])))
                     errarr = np.zeros((len(pix), len(pix['order_01'])))
@@ -1169,6 +1521,16 @@ def extract_spectrum_from_indices(img, err_img, stripe_indices, method='optimal'
                 h_err = h.copy()
                 h_err['HISTORY'] = 'estimated uncertainty in EXTRACTED SPECTRUM - created '+time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())+' (GMT)'
                 pyfits.append(outfn, errarr, h_err, clobber=True)
+                #and the offset and/or slope terms (if any), with dimensions (n_ord, n_add, n_pix)
+                if method.lower() == 'optimal' and addarr is not None and addarr.shape[1] > 0:
+                    addnames = ['offset'] * offset + ['slope'] * slope
+                    h_add = h.copy()
+                    h_add['HISTORY'] = 'OFFSET / SLOPE terms of EXTRACTED SPECTRUM - created '+time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())+' (GMT)'
+                    h_add['ADDTERMS'] = (','.join(addnames), 'extra terms along 2nd axis')
+                    pyfits.append(outfn, addarr, h_add)
+                    h_adderr = h_add.copy()
+                    h_adderr['HISTORY'] = 'estimated uncertainty in OFFSET / SLOPE terms of EXTRACTED SPECTRUM'
+                    pyfits.append(outfn, adderrarr, h_adderr)
                 
             if filetype in ['dict', 'both']:
                 #OK, save as a python dictionary
@@ -11,10 +11,14 @@ import warnings
 import time
 import math
 import datetime
+import hashlib
+import json
+import os
 from astropy.modeling import models, fitting
 import collections
 # from scipy import ndimage
 from scipy import special, signal
+from scipy.linalg import cho_factor, cho_solve
 from numpy.polynomial import polynomial
 from scipy.integrate import quad, fixed_quad
 from scipy import ndimage
@@ -103,6 +107,39 @@ def fibmodel(xarr, mu, sigma, beta=2, alpha=0, norm=0):
 
 
 
+def fibmodel_integrated(xarr, mu, sigma, beta=2, n=5):
+    """
+    Integrates "fibmodel" (with alpha=0 and norm=0) over the pixels centred on 'xarr', ie from xarr-0.5 to xarr+0.5, for all
+    pixels (and fibres, and columns) at once. All inputs are broadcast against each other.
+    For beta=2 (ie a pure Gaussian) the closed form (via the error function) is used, otherwise an n-point Gauss-Legendre
+    quadrature (which gives the same results as "scipy.integrate.fixed_quad" with the same n, but is vectorised).
+    """
+
+    xarr, mu, sigma, beta = np.broadcast_arrays(xarr, mu, sigma, beta)
+    phi = np.zeros(xarr.shape)
+
+    gauss = np.isclose(beta, 2.)
+
+    # closed form for the Gaussian case
+    if np.any(gauss):
+        s2 = np.sqrt(2.) * sigma[gauss]
+        phi[gauss] = np.sqrt(np.pi / 2.) * sigma[gauss] * (special.erf((xarr[gauss] + 0.5 - mu[gauss]) / s2) -
+                                                            special.erf((xarr[gauss] - 0.5 - mu[gauss]) / s2))
+
+    # Gauss-Legendre quadrature for everything else
+    if not np.all(gauss):
+        other = ~gauss
+        x, m, s, b = (xarr[other], mu[other], sigma[other], beta[other])
+        nodes, weights = np.polynomial.legendre.leggauss(n)
+        integral = np.zeros(x.shape)
+        for node, weight in zip(nodes, weights):
+            integral += weight * fibmodel(x + 0.5 * node, m, s, beta=b, alpha=0, norm=0)
+        phi[other] = 0.5 * integral
+
+    return phi
+
+
+
 def CMB_multi_gaussian(x, *p):
     f = np.zeros(len(x))
     for i in range(len(p)//3):
@@ -395,9 +432,8 @@ def make_norm_profiles_4(x, col, fppo, integrate=False, fibs='stellar', slope=Fa
         # now, I think we actually don't want to evaluate the functional form of the profiles as declared by "fibmodel" at the respective locations,
         # but rather we want to integrate the (highly non-linear) function from the left edge to the right edge of the pixels (co-ordinates are pixel centres!!!)
         if integrate:
-            for i in np.arange(len(x)):
-                phi[i,k] = fixed_quad(fibmodel, x[i]-0.5, x[i]+0.5, args=(mu, sigma, beta))[0]
-                # phi[i, k] = quad(fibmodel, x[i] - 0.5, x[i] + 0.5, args=(mu, sigma, beta))[0]
+            # vectorised version of fixed_quad(fibmodel, x[i]-0.5, x[i]+0.5, args=(mu, sigma, beta)) for all pixels
+            phi[:,k] = fibmodel_integrated(x, mu, sigma, beta=beta)
         else:
             phi[:, k] = fibmodel(x, mu, sigma, beta=beta, alpha=0, norm=0)
 
@@ -478,9 +514,8 @@ def make_norm_profiles_5(x, col, fppo, integrate=False, fibs='stellar', slope=Fa
         # now, I think we actually don't want to evaluate the functional form of the profiles as declared by "fibmodel" at the respective locations,
         # but rather we want to integrate the (highly non-linear) function from the left edge to the right edge of the pixels (co-ordinates are pixel centres!!!)
         if integrate:
-            for i in np.arange(len(x)):
-                phi[i,k] = fixed_quad(fibmodel, x[i]-0.5, x[i]+0.5, args=(mu, sigma, beta))[0]
-                # phi[i, k] = quad(fibmodel, x[i] - 0.5, x[i] + 0.5, args=(mu, sigma, beta))[0]
+            # vectorised version of fixed_quad(fibmodel, x[i]-0.5, x[i]+0.5, args=(mu, sigma, beta)) for all pixels
+            phi[:,k] = fibmodel_integrated(x, mu, sigma, beta=beta)
         else:
             phi[:, k] = fibmodel(x, mu, sigma, beta=beta, alpha=0, norm=0)
 
@@ -503,6 +538,310 @@ def make_norm_profiles_5(x, col, fppo, integrate=False, fibs='stellar', slope=Fa
 
     return phinorm
 
+def make_norm_profiles_for_order(sr, cols, fppo, integrate=False, fibs='stellar', slope=False, offset=False):
+    """
+    Batched clone of "make_norm_profiles_5", ie it creates the normalized profiles for ALL the requested pixel columns of an
+    order at once, rather than for a single cutout.
+
+    INPUT:
+    'sr'         : row-indices of the flattened stripe (from "flatten_single_stripe(_from_indices)"), shape (nrow, npix)
+    'cols'       : the pixel columns for which to create the profiles
+    'fppo'       : fibre profile parameters for that order (in explicit form, as for "make_norm_profiles_5")
+    'integrate'  : boolean - integrate over the pixels rather than evaluating the profiles at the pixel centres?
+    'fibs'       : which fibres do you want to include? ['all', 'stellar', 'sky2', 'sky3', 'allsky']
+    'slope'      : boolean - include a slope (along the slit) as an extra 'fibre'?
+    'offset'     : boolean - include an offset as an extra 'fibre'?
+
+    OUTPUT:
+    'phinorm'  : the normalized profiles, shape (ncol, nrow, nfib)
+    """
+
+    cols = np.asarray(cols)
+
+    nfib = 24
+
+    # same number of fibres for every order, of course
+    if fibs == 'all':
+        userange = np.arange(nfib)
+    elif fibs == 'stellar':
+        userange = np.arange(2, 21, 1)
+    elif fibs == 'sky3':
+        userange = np.arange(21, 24, 1)
+    elif fibs == 'sky2':
+        userange = np.arange(2)
+    elif fibs == 'allsky':
+        userange = np.r_[np.arange(2),np.arange(21, 24, 1)]
+    else:
+        print('ERROR: fibre selection not recognised!!!')
+        return
+
+    # Do we want to include extra "fibres" to take care of slope and/or offset?
+    addfibs = 0
+    if offset:
+        addfibs += 1
+    if slope:
+        addfibs += 1
+
+    # the cutouts, shape (ncol, nrow)
+    x = sr[:, cols].T
+    phi = np.zeros((len(cols), x.shape[1], nfib + addfibs))
+
+    # NOTE: need to turn fibre numbers around here to be correct
+    fibnames = sorted(fppo.keys())[::-1]
+    mu = np.array([fppo[fib]['mu_fit'][cols] for fib in fibnames]).T
+    sigma = np.array([fppo[fib]['sigma_fit'][cols] for fib in fibnames]).T
+    beta = np.array([fppo[fib]['beta_fit'][cols] for fib in fibnames]).T
+    if integrate:
+        phi[:, :, :len(fibnames)] = fibmodel_integrated(x[:, :, np.newaxis], mu[:, np.newaxis, :], sigma[:, np.newaxis, :], beta=beta[:, np.newaxis, :])
+    else:
+        phi[:, :, :len(fibnames)] = fibmodel(x[:, :, np.newaxis], mu[:, np.newaxis, :], sigma[:, np.newaxis, :], beta=beta[:, np.newaxis, :], alpha=0, norm=0)
+
+    if offset and not slope:
+        phi[:, :, -1] = 1.
+        userange = np.append(userange, nfib)
+    if slope and not offset:
+        phi[:, :, -1] = x - x[:, :1]
+        userange = np.append(userange, nfib)
+    if offset and slope:
+        phi[:, :, -2] = 1.
+        phi[:, :, -1] = x - x[:, :1]
+        userange = np.append(userange, np.array([nfib,nfib+1]))
+
+    # deprecate phi-array to only use wanted fibres
+    phi = phi[:, :, userange]
+
+    # return normalized profiles
+    phinorm = phi / np.sum(phi, axis=1)[:, np.newaxis, :]
+
+    return phinorm
+
+def get_file_hash(filename, blocksize=2**20):
+    """
+    Returns the SHA1 hash (as a hex string) of the contents of a file.
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def make_norm_profiles_for_order_cached(sr, cols, fppo, cachedir, fibparms_hash, ord, slit_height=25, integrate=False, fibs='stellar',
+                                        slope=False, offset=False):
+    """
+    Cached version of "make_norm_profiles_for_order". The normalized profile tensor for an order is saved to disk (as .npy file),
+    and simply re-loaded (memory-mapped) for all subsequent frames, as long as the fibre profile parameters (ie the fibparms file),
+    the stripe geometry (ie the row-indices of the flattened stripe) and the keywords for the creation of the profiles do not change.
+
+    INPUT:
+    'sr'             : row-indices of the flattened stripe (from "flatten_single_stripe(_from_indices)"), shape (nrow, npix)
+    'cols'           : the pixel columns for which to create the profiles
+    'fppo'           : fibre profile parameters for that order (in explicit form, as for "make_norm_profiles_5")
+    'cachedir'       : the directory where the cached profiles are stored
+    'fibparms_hash'  : hash of the fibparms file (from "get_file_hash")
+    'ord'            : the order (used in the file name only)
+    'slit_height'    : height of the extraction slit is 2*slit_height pixels
+    'integrate'      : boolean - integrate over the pixels rather than evaluating the profiles at the pixel centres?
+    'fibs'           : which fibres do you want to include? ['all', 'stellar', 'sky2', 'sky3', 'allsky']
+    'slope'          : boolean - include a slope (along the slit) as an extra 'fibre'?
+    'offset'         : boolean - include an offset as an extra 'fibre'?
+
+    OUTPUT:
+    'phinorm'  : the (read-only, memory-mapped) normalized profiles, shape (ncol, nrow, nfib)
+    """
+
+    cols = np.asarray(cols)
+
+    # the cache key; the stripe rows are included as well, as the profiles depend on where the stripe lies on the chip
+    sha = hashlib.sha1()
+    sha.update(str((fibparms_hash, slit_height, integrate, fibs, slope, offset)).encode())
+    sha.update(np.ascontiguousarray(sr[:, cols]).astype(float).tobytes())
+    sha.update(cols.astype(int).tobytes())
+    cachefile = os.path.join(cachedir, 'phi_' + ord + '_' + sha.hexdigest() + '.npy')
+
+    if not os.path.exists(cachefile):
+        phinorm = make_norm_profiles_for_order(sr, cols, fppo, integrate=integrate, fibs=fibs, slope=slope, offset=offset)
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        # write to temporary file first, so that other processes never see a half-written cache file
+        tmpfile = cachefile[:-4] + '_' + str(os.getpid()) + '.tmp.npy'
+        np.save(tmpfile, phinorm)
+        os.rename(tmpfile, cachefile)
+
+    return np.load(cachefile, mmap_mode='r')
+
+def get_bandwidth_from_fibparms(fppo, cols=None, nsig=6.):
+    """
+    Estimates the bandwidth (ie the number of sub-diagonals) of the (banded) cross-talk matrices for the optimal extraction,
+    ie how many neighbouring fibres each fibre profile overlaps with. Two fibres are considered to overlap if their separation
+    is less than nsig * sqrt(sigma_1**2 + sigma_2**2) in any of the pixel columns. The bandwidth is calculated using all fibres,
+    which is an upper limit for any selection of fibres.
+
+    INPUT:
+    'fppo'  : fibre profile parameters for that order (in explicit form, as for "make_norm_profiles_5")
+    'cols'  : the pixel columns to consider (default is all columns)
+    'nsig'  : how many (combined) sigmas do the fibres have to be apart to be considered non-overlapping?
+
+    OUTPUT:
+    'bandwidth'  : the bandwidth of the cross-talk matrices
+    """
+
+    # NOTE: need to turn fibre numbers around here to be correct
+    fibnames = sorted(fppo.keys())[::-1]
+    if cols is None:
+        cols = np.arange(len(fppo[fibnames[0]]['mu_fit']))
+    mu = np.array([fppo[fib]['mu_fit'][cols] for fib in fibnames])
+    sigma = np.array([fppo[fib]['sigma_fit'][cols] for fib in fibnames])
+
+    bandwidth = 0
+    for d in range(1, len(fibnames)):
+        sep = np.abs(mu[d:] - mu[:-d])
+        if np.any(sep < nsig * np.sqrt(sigma[d:]**2 + sigma[:-d]**2)):
+            bandwidth = d
+
+    return bandwidth
+
+# in-memory cache for the content hashes of input files (keys = (filename, size, modification time); see "update_cache_hash")
+file_hash_cache = {}
+
+def update_cache_hash(sha, item):
+    """
+    Recursively feeds an item into a hash object (see "get_cache_key"). Files are represented by their name and the hash of their
+    contents (see "get_file_hash"; the content hash is only re-computed if the size or modification time of the file have changed),
+    arrays by their shape, dtype and contents, and everything else by its repr.
+    """
+    if isinstance(item, dict):
+        sha.update(b'dict')
+        for k in sorted(item.keys(), key=str):
+            update_cache_hash(sha, k)
+            update_cache_hash(sha, item[k])
+    elif isinstance(item, (list, tuple)):
+        sha.update(b'list' + str(len(item)).encode())
+        for it in item:
+            update_cache_hash(sha, it)
+    elif isinstance(item, np.ndarray):
+        sha.update(str((item.shape, item.dtype.str)).encode())
+        sha.update(np.ascontiguousarray(item).tobytes())
+    elif isinstance(item, str) and os.path.isfile(item):
+        stat = os.stat(item)
+        filekey = (os.path.abspath(item), stat.st_size, stat.st_mtime_ns)
+        if filekey not in file_hash_cache:
+            file_hash_cache[filekey] = get_file_hash(item)
+        sha.update(str((os.path.basename(item), file_hash_cache[filekey])).encode())
+    else:
+        sha.update(repr(item).encode())
+
+def get_cache_key(*items):
+    """
+    Returns a content-based cache key (SHA1 hash as a hex string) for an arbitrary number of inputs, eg a list of raw files,
+    master calibration frames, and the parameters of a calibration step. Files are identified by their name and contents.
+    """
+    sha = hashlib.sha1()
+    for item in items:
+        update_cache_hash(sha, item)
+    return sha.hexdigest()
+
+def encode_cache_result(item, arrays):
+    """
+    Converts the result of a calibration step into a JSON-serializable description of its structure, and adds all arrays it contains 
+    to the dictionary 'arrays' (so that they can be stored with np.savez, ie without pickling). Supported are arrays, np.poly1d objects,
+    scalars, strings, None, and (nested) lists, tuples and dictionaries (with string keys) of those. Raises a TypeError for anything else.
+    """
+    if isinstance(item, np.poly1d):
+        key = 'arr_' + str(len(arrays))
+        arrays[key] = item.coeffs
+        return {'type': 'poly1d', 'key': key}
+    elif isinstance(item, np.ndarray):
+        if item.dtype.hasobject:
+            raise TypeError('object arrays cannot be cached')
+        key = 'arr_' + str(len(arrays))
+        arrays[key] = item
+        return {'type': 'array', 'key': key}
+    elif isinstance(item, (list, tuple)):
+        return {'type': type(item).__name__, 'items': [encode_cache_result(it, arrays) for it in item]}
+    elif isinstance(item, dict):
+        if not all(isinstance(k, str) for k in item.keys()):
+            raise TypeError('only dictionaries with string keys can be cached')
+        return {'type': 'dict', 'keys': list(item.keys()), 'items': [encode_cache_result(it, arrays) for it in item.values()]}
+    elif isinstance(item, np.generic):
+        return encode_cache_result(np.asarray(item), arrays)
+    elif item is None or isinstance(item, (bool, int, float, str)):
+        return {'type': 'scalar', 'value': item}
+    else:
+        raise TypeError('objects of type ' + type(item).__name__ + ' cannot be cached')
+
+def decode_cache_result(struct, arrays):
+    """
+    Inverse of "encode_cache_result", ie re-builds the result of a calibration step from the description of its structure and the
+    arrays loaded from the cache file.
+    """
+    if struct['type'] == 'poly1d':
+        return np.poly1d(arrays[struct['key']])
+    elif struct['type'] == 'array':
+        return arrays[struct['key']]
+    elif struct['type'] == 'list':
+        return [decode_cache_result(it, arrays) for it in struct['items']]
+    elif struct['type'] == 'tuple':
+        return tuple(decode_cache_result(it, arrays) for it in struct['items'])
+    elif struct['type'] == 'dict':
+        return {k: decode_cache_result(it, arrays) for k, it in zip(struct['keys'], struct['items'])}
+    else:
+        return struct['value']
+
+def run_cached(func, args=(), kwargs=None, cachedir=None, name=None, debug_level=0):
+    """
+    Runs a (calibration) step, ie func(*args, **kwargs), but only if it has not been run with the same inputs before; otherwise the 
+    result is simply re-loaded from the cache. The cache key is calculated from the name of the function and all positional and keyword 
+    arguments (incl. the contents of any input files, see "get_cache_key"), so changing any input file, calibration frame or parameter
+    creates a new cache entry. Results (eg master frames, (master, error) tuples, or the P_id dictionary) are stored as .npz files
+    (without pickling, see "encode_cache_result"); results that cannot be stored this way are not cached.
+
+    INPUT:
+    'func'         : the function to run
+    'args'         : tuple of positional arguments for 'func'
+    'kwargs'       : dictionary of keyword arguments for 'func'
+    'cachedir'     : the directory where the cached results are stored
+    'name'         : name of the step (used in the file name only; default is the name of the function)
+    'debug_level'  : for debugging...
+
+    OUTPUT:
+    'result'  : the result of func(*args, **kwargs)
+    """
+
+    if kwargs is None:
+        kwargs = {}
+    if name is None:
+        name = func.__name__
+    if cachedir is None:
+        print('ERROR: cache directory not provided!!!')
+        return
+
+    cachefile = os.path.join(cachedir, 'cache_' + name + '_' + get_cache_key(func.__name__, args, kwargs) + '.npz')
+
+    if os.path.exists(cachefile):
+        if debug_level >= 1:
+            print('Loading cached result for "' + name + '" from ' + cachefile)
+        with np.load(cachefile) as npz:
+            arrays = {k: npz[k] for k in npz.files}
+        return decode_cache_result(json.loads(str(arrays.pop('structure'))), arrays)
+
+    result = func(*args, **kwargs)
+
+    arrays = {}
+    try:
+        struct = encode_cache_result(result, arrays)
+    except TypeError as e:
+        print('WARNING: result of "' + name + '" cannot be cached (' + str(e) + ')!!!')
+        return result
+
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    # write to temporary file first, so that other processes never see a half-written cache file
+    tmpfile = cachefile[:-4] + '_' + str(os.getpid()) + '.tmp.npz'
+    np.savez(tmpfile, structure=np.array(json.dumps(struct)), **arrays)
+    os.rename(tmpfile, cachefile)
+
+    return result
+
 def make_norm_profiles_temp(x, o, col, fibparms, slope=False, offset=False):  
     
     #xx = np.arange(4096)
@@ -629,6 +968,76 @@ def polyfit2d(x, y, z, order=3, return_res=False):
 
 
 
+def polyfit2d_normal(x, y, z, order=3, weights=None, chunksize=2**18, return_res=False):
+    """
+    Same as "polyfit2d", but instead of building the full design matrix G (npts x (order+1)**2) and calling np.linalg.lstsq,
+    the normal equations G.T @ W @ G and G.T @ W @ z are accumulated in chunks of 'chunksize' points, so that the memory
+    footprint is independent of the number of points. The (small) normal-equation system is then solved via Cholesky
+    decomposition (with a fallback to np.linalg.lstsq if it is not positive definite).
+    The result (m) is an array of the polynomial coefficients in the model f  = sum_i sum_j a_ij x^i y^j, 
+    has the form m = [a00,a01,a02,a03,a10,a11,a12,a13,a20,.....,a33] for order=3 (ie same as "polyfit2d")
+    
+    INPUT:
+    'x'          : x-values (should be normalized to [-1,+1])
+    'y'          : y-values (should be normalized to [-1,+1])
+    'z'          : the 'observed' values
+    'order'      : degree of the polynomial in each direction
+    'weights'    : weights to use in the fitting (eg inverse variances) - if None, all points are weighted equally
+    'chunksize'  : number of points to process at once
+    'return_res' : boolean - do you want to return the (weighted) sum of the squared residuals as well?
+    
+    OUTPUT:
+    'm'    : the coefficients of the best-fit polynomial surface
+    'res'  : the (weighted) sum of the squared residuals (only if 'return_res' is set to TRUE)
+    """
+    
+    x = np.asarray(x, dtype='f8').ravel()
+    y = np.asarray(y, dtype='f8').ravel()
+    z = np.asarray(z, dtype='f8').ravel()
+    if weights is not None:
+        weights = np.asarray(weights, dtype='f8').ravel()
+    
+    ncols = (order + 1)**2
+    GTG = np.zeros((ncols, ncols))
+    GTz = np.zeros(ncols)
+    zTz = 0.
+    
+    for i0 in range(0, x.size, chunksize):
+        sl = slice(i0, i0 + chunksize)
+        #powers of x and y (faster than calculating x**i and y**j from scratch)
+        xp = np.ones((len(x[sl]), order+1))
+        yp = np.ones((len(x[sl]), order+1))
+        for i in range(1, order+1):
+            xp[:,i] = xp[:,i-1] * x[sl]
+            yp[:,i] = yp[:,i-1] * y[sl]
+        #same column order as itertools.product(range(order+1), range(order+1)), ie (i,j) = (0,0), (0,1), ..., (1,0), ...
+        G = (xp[:,:,np.newaxis] * yp[:,np.newaxis,:]).reshape(-1, ncols)
+        if weights is None:
+            WG = G
+            Wz = z[sl]
+        else:
+            WG = G * weights[sl,np.newaxis]
+            Wz = z[sl] * weights[sl]
+        GTG += np.dot(WG.T, G)
+        GTz += np.dot(WG.T, z[sl])
+        zTz += np.dot(Wz, z[sl])
+    
+    try:
+        m = cho_solve(cho_factor(GTG), GTz)
+        if not np.all(np.isfinite(m)):
+            raise np.linalg.LinAlgError
+    except (np.linalg.LinAlgError, ValueError):
+        m = np.linalg.lstsq(GTG, GTz, rcond=None)[0]
+    
+    if return_res:
+        #sum of squared residuals from the accumulated quantities: z.T W z - 2 m.T G.T W z + m.T G.T W G m
+        res = np.array([zTz - 2.*np.dot(m, GTz) + np.dot(m, np.dot(GTG, m))])
+        return m, res
+    else:
+        return m
+
+
+
 def test_polyfit2d(x, y, f, deg=3):
     x = np.asarray(x)
     y = np.asarray(y)
@@ -656,6 +1065,82 @@ def polyval2d(x, y, m):
 
 
 
+def polyval2d_grid(x, y, m):
+    """
+    Same as "polyval2d", but evaluates the polynomial surface on the grid spanned by the 1-dim coordinate arrays x and y, 
+    ie the result is identical to polyval2d(*np.meshgrid(x,y), m). Because the polynomial is separable, the 1-dim power bases 
+    along x and y are only calculated once, and the full grid is then obtained from a single small matrix product, rather than 
+    by looping over all (order+1)**2 terms on full 2-dim meshgrids.
+    e.g.: m = [a00,a01,a02,a03,a10,a11,a12,a13,a20,.....,a33] for order=3
+    
+    INPUT:
+    'x'  : 1-dim array of x-values
+    'y'  : 1-dim array of y-values
+    'm'  : the coefficients of the polynomial surface (as returned by "polyfit2d")
+    
+    OUTPUT:
+    'z'  : 2-dim array of shape (len(y), len(x)) containing the values of the polynomial surface
+    """
+    order = int(np.sqrt(len(m))) - 1
+    #A[i,j] = a_ij
+    A = np.reshape(m, (order+1, order+1))
+    #1-dim bases: Vx[:,i] = x**i, Vy[:,j] = y**j
+    Vx = polynomial.polyvander(np.asarray(x, dtype='f8'), order)
+    Vy = polynomial.polyvander(np.asarray(y, dtype='f8'), order)
+    #z[r,c] = sum_i sum_j a_ij x[c]**i y[r]**j
+    z = np.dot(Vy, np.dot(A.T, Vx.T))
+    return z
+
+
+
+def eval_poly_surface_2D_grid(p, x, y):
+    """
+    Evaluates a 2D polynomial model (as returned by "fit_poly_surface_2D") on the grid spanned by the 1-dim coordinate arrays x and y, 
+    ie the result is identical to p(*np.meshgrid(x,y)), but exploits the separability of the polynomials: the 1-dim bases are only 
+    calculated once along x and y, and the full grid is then obtained from a single small matrix product.
+    
+    INPUT:
+    'p'  : astropy model of the polynomial surface (either Polynomial2D, Chebyshev2D, or Legendre2D)
+    'x'  : 1-dim array of x-values
+    'y'  : 1-dim array of y-values
+    
+    OUTPUT:
+    'z'  : 2-dim array of shape (len(y), len(x)) containing the values of the polynomial surface
+    """
+    
+    x = np.asarray(x, dtype='f8')
+    y = np.asarray(y, dtype='f8')
+    
+    if isinstance(p, models.Polynomial2D):
+        xdeg = ydeg = p.degree
+        vander = polynomial.polyvander
+    elif isinstance(p, models.Chebyshev2D):
+        xdeg, ydeg = p.x_degree, p.y_degree
+        vander = np.polynomial.chebyshev.chebvander
+    elif isinstance(p, models.Legendre2D):
+        xdeg, ydeg = p.x_degree, p.y_degree
+        vander = np.polynomial.legendre.legvander
+    else:
+        print('ERROR: polynomial type not recognized!!!')
+        return
+    
+    #map the coordinates from the domain to the window (same as astropy does internally)
+    if getattr(p, 'x_domain', None) is not None:
+        x = np.polynomial.polyutils.mapdomain(x, p.x_domain, p.x_window)
+    if getattr(p, 'y_domain', None) is not None:
+        y = np.polynomial.polyutils.mapdomain(y, p.y_domain, p.y_window)
+    
+    #coefficient matrix A[i,j] = c_i_j, where c_i_j multiplies the i-th basis function in x and the j-th basis function in y
+    A = np.zeros((xdeg+1, ydeg+1))
+    for name, val in zip(p.param_names, p.parameters):
+        i,j = name[1:].split('_')
+        A[int(i), int(j)] = val
+    
+    z = np.dot(vander(y, ydeg), np.dot(A.T, vander(x, xdeg).T))
+    return z
+
+
+
 def fit_poly_surface_2D(x_norm, y_norm, z, weights=None, polytype = 'chebyshev', poly_deg_x=5, poly_deg_y=None, timit=False, debug_level=0):
     """
     Calculate 2D polynomial fit to normalized x and y values.
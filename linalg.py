@@ -5,10 +5,18 @@ Created on 3 Aug. 2018
 '''
 
 import numpy as np
+from scipy.linalg import cho_factor, cho_solve
 
 
 
-def linalg_extract_column(z, w, phi, RON=3.3, naive_variance=False, altvar=True):
+def linalg_extract_column(z, w, phi, RON=3.3, naive_variance=False, altvar=True, solver='inv'):
+    
+    #solver = 'cholesky' avoids the diagonal weight matrix and the explicit matrix inversions (see "linalg_extract_column_cholesky")
+    if solver.lower() == 'cholesky':
+        return linalg_extract_column_cholesky(z, w, phi, RON=RON, naive_variance=naive_variance, altvar=altvar)
+    elif solver.lower() != 'inv':
+        print('ERROR: solver not recognised!!!')
+        return
     
     #create diagonal matrix for weights
     ### XXX maybe use sparse matrix here instead to save memory / speed things up
@@ -68,6 +76,302 @@ def linalg_extract_column(z, w, phi, RON=3.3, naive_variance=False, altvar=True)
 
 
 
+def linalg_extract_column_cholesky(z, w, phi, RON=3.3, naive_variance=False, altvar=True):
+    """
+    Clone of "linalg_extract_column", but without creating the (2*slit_height x 2*slit_height) diagonal weight matrix, ie
+    C = phi.T @ (w * phi) is formed directly, and C is never explicitly inverted (a Cholesky solve is used instead).
+    
+    INPUT:
+    'z'               : flux in the cutout
+    'w'               : weights (ie inverse variances) of the pixels in the cutout
+    'phi'             : normalized fibre profiles for the cutout, shape (len(z), nfib)
+    'RON'             : read-out noise
+    'naive_variance'  : boolean - do you want to use the "naive" errorbars, ie sqrt(eta)?
+    'altvar'          : boolean - Sharp & Birchall paragraph 5.2.2 (TRUE) or 5.2.1 (FALSE)
+    
+    OUTPUT:
+    np.array([eta, var])   (same as "linalg_extract_column")
+    """
+    
+    #create the cross-talk matrix
+    C = np.matmul(phi.T, w[:, np.newaxis] * phi)
+    #compute b
+    b = np.matmul(phi.T, w * z)
+    
+    #compute eta (ie the array of the fibre-intensities (or amplitudes)
+    try:
+        eta = cho_solve(cho_factor(C), b)
+    except np.linalg.LinAlgError:
+        #C is not positive definite (eg b/c of zero weights), so fall back to the explicit inverse
+        eta = np.matmul(np.linalg.inv(C), b)
+    
+    if not naive_variance:
+        if altvar:
+            #THIS CORRESPONDS TO SHARP & BIRCHALL paragraph 5.2.2
+            C_prime_inv = np.linalg.inv(np.matmul(phi.T, phi))
+            b_prime = np.sum(phi * ((1./w) - RON*RON)[:, np.newaxis], axis=0)
+            var = np.matmul(C_prime_inv, b_prime)
+        else:
+            #THIS CORRESPONDS TO SHARP & BIRCHALL paragraph 5.2.1
+            T = np.maximum(np.sum(eta * phi, axis=1), 1e-6)
+            fracs = (eta * phi) / T[:, np.newaxis]
+            var = np.sum(fracs**2 * (1./w)[:, np.newaxis], axis=0)
+    else:
+        #these are the "naive errorbars"
+        var = np.abs(eta)
+    
+    return np.array([eta, var])
+
+
+
+
+
+def linalg_extract_order(Z, W, PHI, RON=3.3, naive_variance=False, altvar=True, solver='dense', bandwidth=None, nextra=0):
+    """
+    Batched version of "linalg_extract_column", ie solves the optimal extraction normal equations for ALL pixel columns
+    of an order at once, rather than calling "linalg_extract_column" once per column.
+
+    INPUT:
+    'Z'               : flux in the cutouts, shape (ncol, nrow)
+    'W'               : weights (ie inverse variances) of the pixels in the cutouts, shape (ncol, nrow)
+    'PHI'             : normalized fibre profiles for all cutouts, shape (ncol, nrow, nfib)
+    'RON'             : read-out noise, either a scalar or one value per cutout, ie shape (ncol,)
+    'naive_variance'  : boolean - do you want to use the "naive" errorbars, ie sqrt(eta)?
+    'altvar'          : boolean - Sharp & Birchall paragraph 5.2.2 (TRUE) or 5.2.1 (FALSE)
+    'solver'          : 'dense' or 'banded' - the latter only uses the band of the cross-talk matrices within 'bandwidth'
+                        of the diagonal, ie it assumes that each fibre profile only overlaps with its neighbours
+    'bandwidth'       : number of sub-diagonals of the cross-talk matrices (required if solver is 'banded')
+    'nextra'          : number of extra "fibres" at the end of PHI that overlap with all fibres (ie slope and/or offset);
+                        these are treated as a dense border of the banded matrices (only used if solver is 'banded')
+
+    OUTPUT:
+    'eta'  : the fibre intensities, shape (ncol, nfib)
+    'var'  : the corresponding variances, shape (ncol, nfib)
+    """
+
+    if solver.lower() == 'banded':
+        return linalg_extract_order_banded(Z, W, PHI, bandwidth, RON=RON, naive_variance=naive_variance, altvar=altvar, nextra=nextra)
+    elif solver.lower() != 'dense':
+        print('ERROR: solver not recognised!!!')
+        return
+
+    PHI_T = np.swapaxes(PHI, 1, 2)
+
+    #create the cross-talk matrices for all columns, ie C[i] = PHI[i].T @ diag(W[i]) @ PHI[i]
+    C = np.matmul(PHI_T, W[:,:,np.newaxis] * PHI)
+    #compute b for all columns
+    b = np.sum(PHI * (W * Z)[:,:,np.newaxis], axis=1)
+
+    #compute eta (ie the array of the fibre-intensities (or amplitudes)) for all columns in one go
+    eta = solve_batched(C, b)
+
+    if not naive_variance:
+        if altvar:
+            #THIS CORRESPONDS TO SHARP & BIRCHALL paragraph 5.2.2
+            C_prime = np.matmul(PHI_T, PHI)
+            if np.ndim(RON) > 0:
+                RON = np.asarray(RON)[:,np.newaxis]
+            with np.errstate(divide='ignore'):
+                b_prime = np.sum(PHI * ((1./W) - RON*RON)[:,:,np.newaxis], axis=1)
+            var = solve_batched(C_prime, b_prime)
+        else:
+            #THIS CORRESPONDS TO SHARP & BIRCHALL paragraph 5.2.1
+            etaphi = eta[:,np.newaxis,:] * PHI
+            T = np.maximum(np.sum(etaphi, axis=2), 1e-6)
+            fracs = etaphi / T[:,:,np.newaxis]
+            with np.errstate(divide='ignore'):
+                var = np.sum(fracs**2 * (1./W)[:,:,np.newaxis], axis=1)
+    else:
+        #these are the "naive errorbars"
+        var = np.abs(eta)
+
+    return eta, var
+
+
+
+
+
+def solve_batched(A, b):
+    """
+    Solves the linear systems A[i] @ x[i] = b[i] for a whole stack of (small) square matrices at once.
+    Falls back to the pseudo-inverse if any of the matrices in the stack is singular.
+
+    INPUT:
+    'A'  : stack of square matrices, shape (n, m, m)
+    'b'  : stack of right-hand sides, shape (n, m)
+
+    OUTPUT:
+    'x'  : the solutions, shape (n, m)
+    """
+    try:
+        x = np.linalg.solve(A, b[:,:,np.newaxis])[:,:,0]
+    except np.linalg.LinAlgError:
+        x = np.matmul(np.linalg.pinv(A), b[:,:,np.newaxis])[:,:,0]
+    return x
+
+
+
+
+
+def linalg_extract_order_banded(Z, W, PHI, bandwidth, RON=3.3, naive_variance=False, altvar=True, nextra=0):
+    """
+    Clone of "linalg_extract_order", but exploits the fact that (as the fibres are packed along the slit) each fibre profile
+    only overlaps with its few neighbours, so that the cross-talk matrices are banded. Only the band is ever computed, and
+    the banded systems are solved for all pixel columns at once with a banded Cholesky decomposition (see "solve_banded_batched"),
+    which scales linearly with the number of fibres. Extra "fibres" (slope and/or offset) at the end of PHI overlap with all
+    fibres, so they are treated as a dense border of the banded matrices (via the Schur complement).
+
+    INPUT:
+    'Z'               : flux in the cutouts, shape (ncol, nrow)
+    'W'               : weights (ie inverse variances) of the pixels in the cutouts, shape (ncol, nrow)
+    'PHI'             : normalized fibre profiles for all cutouts, shape (ncol, nrow, nfib); the fibres must be ordered by position along the slit
+    'bandwidth'       : number of sub-diagonals of the cross-talk matrices
+    'RON'             : read-out noise, either a scalar or one value per cutout, ie shape (ncol,)
+    'naive_variance'  : boolean - do you want to use the "naive" errorbars, ie sqrt(eta)?
+    'altvar'          : boolean - Sharp & Birchall paragraph 5.2.2 (TRUE) or 5.2.1 (FALSE)
+    'nextra'          : number of extra "fibres" (ie slope and/or offset) at the end of PHI
+
+    OUTPUT:
+    'eta'  : the fibre intensities, shape (ncol, nfib)
+    'var'  : the corresponding variances, shape (ncol, nfib)
+    """
+
+    #compute b for all columns
+    b = np.sum(PHI * (W * Z)[:,:,np.newaxis], axis=1)
+
+    #compute eta (ie the array of the fibre-intensities (or amplitudes)) for all columns in one go
+    eta = solve_bordered_batched(PHI, W[:,:,np.newaxis] * PHI, b, bandwidth, nextra=nextra)
+
+    if not naive_variance:
+        if altvar:
+            #THIS CORRESPONDS TO SHARP & BIRCHALL paragraph 5.2.2
+            if np.ndim(RON) > 0:
+                RON = np.asarray(RON)[:,np.newaxis]
+            with np.errstate(divide='ignore'):
+                b_prime = np.sum(PHI * ((1./W) - RON*RON)[:,:,np.newaxis], axis=1)
+            var = solve_bordered_batched(PHI, PHI, b_prime, bandwidth, nextra=nextra)
+        else:
+            #THIS CORRESPONDS TO SHARP & BIRCHALL paragraph 5.2.1
+            etaphi = eta[:,np.newaxis,:] * PHI
+            T = np.maximum(np.sum(etaphi, axis=2), 1e-6)
+            fracs = etaphi / T[:,:,np.newaxis]
+            with np.errstate(divide='ignore'):
+                var = np.sum(fracs**2 * (1./W)[:,:,np.newaxis], axis=1)
+    else:
+        #these are the "naive errorbars"
+        var = np.abs(eta)
+
+    return eta, var
+
+
+
+
+
+def solve_bordered_batched(PHI, WPHI, b, bandwidth, nextra=0):
+    """
+    Solves the systems (PHI[i].T @ WPHI[i]) @ x[i] = b[i] for all columns i at once, where the matrices are banded (with
+    'bandwidth' sub-diagonals), except for the last 'nextra' rows/columns, which can be dense. Only the band (and the border)
+    of the matrices is ever computed. Columns for which the banded Cholesky decomposition fails (ie the matrix is not positive
+    definite, eg due to zero weights) are solved with the full (dense) matrices instead.
+
+    INPUT:
+    'PHI'        : normalized fibre profiles, shape (ncol, nrow, nfib)
+    'WPHI'       : weighted profiles (or just PHI again for C' = PHI.T @ PHI), shape (ncol, nrow, nfib)
+    'b'          : right-hand sides, shape (ncol, nfib)
+    'bandwidth'  : number of sub-diagonals of the banded part
+    'nextra'     : number of rows/columns of the dense border
+
+    OUTPUT:
+    'x'  : the solutions, shape (ncol, nfib)
+    """
+
+    nfib = PHI.shape[2]
+    nband = nfib - nextra
+    bandwidth = int(min(bandwidth, nband - 1))
+
+    #create band storage directly from the profiles, ie ab[:,d,j] = C[:,j+d,j] (ie "lower form")
+    ab = np.zeros((PHI.shape[0], bandwidth + 1, nband))
+    for d in range(bandwidth + 1):
+        ab[:,d,:nband-d] = np.einsum('crj,crj->cj', WPHI[:,:,:nband-d], PHI[:,:,d:nband])
+
+    if nextra == 0:
+        x = solve_banded_batched(ab, b[:,:,np.newaxis])[:,:,0]
+    else:
+        #the dense border, ie C = [[A, B], [B.T, D]], where A is banded
+        B = np.matmul(np.swapaxes(PHI[:,:,:nband], 1, 2), WPHI[:,:,nband:])
+        D = np.matmul(np.swapaxes(PHI[:,:,nband:], 1, 2), WPHI[:,:,nband:])
+        #solve A @ [y, Y] = [b1, B] in one go
+        yY = solve_banded_batched(ab, np.concatenate((b[:,:nband,np.newaxis], B), axis=2))
+        y = yY[:,:,0]
+        Y = yY[:,:,1:]
+        #Schur complement
+        S = D - np.matmul(np.swapaxes(B, 1, 2), Y)
+        x2 = solve_batched(S, b[:,nband:] - np.sum(B * y[:,:,np.newaxis], axis=1))
+        x1 = y - np.sum(Y * x2[:,np.newaxis,:], axis=2)
+        x = np.concatenate((x1, x2), axis=1)
+
+    #fall back to the dense solver for the columns where the Cholesky decomposition failed
+    bad = ~np.all(np.isfinite(x), axis=1)
+    if np.any(bad):
+        C = np.matmul(np.swapaxes(PHI[bad], 1, 2), WPHI[bad])
+        x[bad] = solve_batched(C, b[bad])
+
+    return x
+
+
+
+
+
+def solve_banded_batched(ab, b):
+    """
+    Solves the symmetric positive-definite banded linear systems A[i] @ x[i] = b[i] for a whole stack of matrices at once,
+    using a banded Cholesky decomposition (A = L @ L.T). This is the same as calling "scipy.linalg.solveh_banded(ab[i], b[i], lower=True)"
+    for every i, but vectorised over the stack (the loops are only over the matrix size and the bandwidth).
+    Matrices that are not positive definite result in NaNs in the respective solutions.
+
+    INPUT:
+    'ab'  : the matrices in "lower form" band storage, ie ab[i,d,j] = A[i,j+d,j], shape (n, bandwidth+1, m)
+    'b'   : stack of right-hand sides, shape (n, m, k)
+
+    OUTPUT:
+    'x'  : the solutions, shape (n, m, k)
+    """
+
+    u = ab.shape[1] - 1
+    m = ab.shape[2]
+
+    #banded Cholesky decomposition, stored in the same way as ab, ie L[:,d,j] = L[:,j+d,j]
+    L = np.zeros(ab.shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for j in range(m):
+            k0 = max(0, j - u)
+            ks = np.arange(k0, j)
+            # L[j,k] = L[j-k,k]
+            Ljk = L[:, j - ks, ks]
+            L[:,0,j] = np.sqrt(ab[:,0,j] - np.sum(Ljk * Ljk, axis=1))
+            for d in range(1, min(u, m - 1 - j) + 1):
+                i = j + d
+                ks = np.arange(max(0, i - u), j)
+                L[:,d,j] = (ab[:,d,j] - np.sum(L[:, i - ks, ks] * L[:, j - ks, ks], axis=1)) / L[:,0,j]
+
+        #forward substitution, ie solve L @ y = b
+        y = np.zeros(b.shape)
+        for j in range(m):
+            ks = np.arange(max(0, j - u), j)
+            y[:,j,:] = (b[:,j,:] - np.sum(L[:, j - ks, ks][:,:,np.newaxis] * y[:,ks,:], axis=1)) / L[:,0,j][:,np.newaxis]
+
+        #back substitution, ie solve L.T @ x = y
+        x = np.zeros(b.shape)
+        for j in range(m - 1, -1, -1):
+            ii = np.arange(j + 1, min(m, j + u + 1))
+            x[:,j,:] = (y[:,j,:] - np.sum(L[:, ii - j, j][:,:,np.newaxis] * x[:,ii,:], axis=1)) / L[:,0,j][:,np.newaxis]
+
+    return x
+
+
+
+
+
 def mikes_linalg_extraction(col_data, col_inv_var, phi, no=19):
     """
     col_data = z
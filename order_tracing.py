@@ -9,6 +9,9 @@ import numpy as np
 from scipy import ndimage
 import scipy.sparse as sparse
 import time
+import warnings
+import os
+import hashlib
 
 from helper_functions import sigma_clip
 
@@ -84,75 +87,35 @@ def find_stripes(flat, deg_polynomial=2, gauss_filter_sigma=3., min_peak=0.05, m
     #logging.info('Number of stripes found: %d' % n_order)
     print('Number of stripes found: %d' % n_order)
 
-    orders = np.zeros((n_order, nx))
-    # because we only want to use good pixels in the fit later on
-    mask = np.ones((n_order, nx), dtype=bool)
+    # trace all orders simultaneously (walking to the left and right along the maximum of the orders)
+    orders, peakflux = trace_orders(filtered_flat, maxima)
 
-    # walk through to the left and right along the maximum of the order
-    # loop over all orders:
-    for m, row in enumerate(maxima):
-        column = int(nx / 2)
-        orders[m, column] = row
-        start_row = row
-        # walk right
-        while (column + 1 < nx):
-            column += 1
-            args = np.array(np.linspace(max(1, start_row - 1), min(start_row + 1, ny - 1), 3), dtype=int)
-            args = args[np.logical_and(args < ny, args > 0)]     #deal with potential edge effects
-            p = filtered_flat[args, column]
-            # new maximum (apply only when there are actually flux values in p, ie not when eg p=[0,0,0]), otherwise leave start_row unchanged
-            if ~(p[0]==p[1] and p[0]==p[2]):
-                start_row = args[np.argmax(p)]
-            orders[m, column] = start_row
-            #build mask - exclude pixels at upper/lower end of chip; also exclude peaks that do not lie at least 5 sigmas above rms of 3-sigma clipped background (+/- cliprange pixels from peak location)
-            #if ((p < 10).all()) or ((column > 3500) and (mask[m,column-1]==False)) or (start_row in (0,nx-1)) or (m==42 and (p < 100).all()):
-            if slowmask:
-                cliprange = 25
-                bg = filtered_flat[start_row-cliprange:start_row+cliprange+1, column]
-                clipped = sigma_clip(bg,3.)
-                if (filtered_flat[start_row,column] - np.median(clipped) < 5.*np.std(clipped)) or (start_row in (0,nx-1)):
-                    mask[m,column] = False
-            else:
-                if ((p < maskthresh).all()) or (start_row in (0,ny-1)):
-                    mask[m,column] = False
-        # walk left
-        column = int(nx / 2)
-        start_row = row
-        while (column > 0):
-            column -= 1
-            args = np.array(np.linspace(max(1, start_row - 1), min(start_row + 1, ny - 1), 3), dtype=int)
-            args = args[np.logical_and(args < ny, args > 0)]     #deal with potential edge effects
-            p = filtered_flat[args, column]
-            # new maximum (apply only when there are actually flux values in p, ie not when eg p=[0,0,0]), otherwise leave start_row unchanged
-            if ~(p[0]==p[1] and p[0]==p[2]):
-                start_row = args[np.argmax(p)]
-            orders[m, column] = start_row
-            #build mask - exclude pixels at upper/lower end of chip; also exclude peaks that do not lie at least 5 sigmas above rms of 3-sigma clipped bcakground (+/- cliprange pixels from peak location)
-            #if ((p < 10).all()) or ((column < 500) and (mask[m,column+1]==False)) or (start_row in (0,nx-1)) or (m==42 and (p < 100).all()):
-            if slowmask:
-                cliprange = 25
-                bg = filtered_flat[start_row-cliprange:start_row+cliprange+1, column]
-                clipped = sigma_clip(bg,3.)
-                if (filtered_flat[start_row,column] - np.median(clipped) < 5.*np.std(clipped)) or (start_row in (0,nx-1)):
-                    mask[m,column] = False
+    # build mask - exclude pixels at upper/lower end of chip; also exclude peaks that do not lie at least 5 sigmas above rms of 3-sigma clipped background (+/- cliprange pixels from peak location)
+    xx = np.arange(nx)
+    if slowmask:
+        mask = make_slowmask(filtered_flat, orders, cliprange=25)
+    else:
+        mask = ~np.logical_or(peakflux < maskthresh, np.logical_or(orders == 0, orders == ny-1))
+        # exclude the range of order_01 that does fall off the chip
+        if n_order > 0:
+            if simu:
+                mask[0, xx < min(1300, int(nx / 2))] = False
             else:
-                if ((p < maskthresh).all()) or (start_row in (0,ny-1)) or (simu==True and m==0 and column < 1300) or (simu==False and m==0 and column < 900):
-                    mask[m,column] = False
+                mask[0, xx < min(900, int(nx / 2))] = False
+
     # do Polynomial fit for each order
     #logging.info('Fit polynomial of order %d to each stripe' % deg_polynomial)
     print('Fit polynomial of order %d to each stripe...' % deg_polynomial)
     P = []
-    xx = np.arange(nx)
+    # the filtered flux along all orders in one go
+    filtered_flux_along_orders = filtered_flat[orders.astype(int), xx]
     for i in range(len(orders)):
         if not weighted_fits:
             #unweighted
             p = np.poly1d(np.polyfit(xx[mask[i,:]], orders[i,mask[i,:]], deg_polynomial))
         else:
             #weighted
-            filtered_flux_along_order = np.zeros(nx)
-            for j in range(nx):
-                #filtered_flux_along_order[j] = filtered_flat[o[j].astype(int),j]    #that was when the loop reas: "for o in orders:"
-                filtered_flux_along_order[j] = filtered_flat[orders[i,j].astype(int),j]
+            filtered_flux_along_order = filtered_flux_along_orders[i,:].copy()
             filtered_flux_along_order[filtered_flux_along_order < 1] = 1   
             #w = 1. / np.sqrt(filtered_flux_along_order)   this would weight the order centres less!!!
             w = np.sqrt(filtered_flux_along_order)
@@ -175,6 +138,231 @@ def find_stripes(flat, deg_polynomial=2, gauss_filter_sigma=3., min_peak=0.05, m
 
 
 
+def trace_orders(filtered_flat, start_rows, start_col=None):
+    """
+    Traces all orders simultaneously, by starting at 'start_rows' in column 'start_col' and then walking to the right and to the left
+    along the maximum of the orders one column at a time (ie for each order the new maximum is the brightest of the 3 pixels
+    adjacent to the previous maximum). Instead of walking along each order individually, the current rows of all orders are kept in
+    a vector, so that there is only one gather per column.
+    
+    INPUT:
+    'filtered_flat'  : the (smoothed) flat field
+    'start_rows'     : the rows of the order maxima in the starting column
+    'start_col'      : the starting column (default is the central column)
+    
+    OUTPUT:
+    'orders'    : the rows of the maxima of all orders in all columns, shape (n_order, nx)
+    'peakflux'  : the maximum of the 3 pixels considered in each step, shape (n_order, nx) (inf for the starting column)
+    """
+    
+    ny, nx = filtered_flat.shape
+    if start_col is None:
+        start_col = int(nx / 2)
+    start_rows = np.asarray(start_rows, dtype=int)
+    n_order = len(start_rows)
+    ix = np.arange(n_order)
+    
+    orders = np.zeros((n_order, nx))
+    peakflux = np.zeros((n_order, nx))
+    orders[:, start_col] = start_rows
+    peakflux[:, start_col] = np.inf
+    
+    # walk right, then walk left
+    for columns in (np.arange(start_col + 1, nx), np.arange(start_col - 1, -1, -1)):
+        rows = start_rows.copy()
+        for column in columns:
+            # same as np.linspace(max(1, row - 1), min(row + 1, ny - 1), 3) for each row (deals with potential edge effects)
+            lo = np.maximum(1, rows - 1)
+            hi = np.minimum(rows + 1, ny - 1)
+            args = np.vstack((lo, lo + (hi - lo) // 2, hi)).T
+            p = filtered_flat[args, column]
+            # new maximum (apply only when there are actually flux values in p, ie not when eg p=[0,0,0]), otherwise leave row unchanged
+            same = np.logical_and(p[:,0] == p[:,1], p[:,0] == p[:,2])
+            rows = np.where(same, rows, args[ix, np.argmax(p, axis=1)])
+            orders[:, column] = rows
+            peakflux[:, column] = np.max(p, axis=1)
+    
+    return orders, peakflux
+
+
+
+def make_slowmask(filtered_flat, orders, cliprange=25, clipsig=3., peaksig=5., start_col=None, chunksize=256):
+    """
+    Creates the "slowmask" for "find_stripes", ie excludes all pixels at the upper/lower end of the chip, and also all peaks that do
+    not lie at least 'peaksig' sigmas above the rms of the 'clipsig'-sigma clipped background (+/- cliprange pixels from the peak location).
+    This is vectorised over all orders and columns (in chunks of 'chunksize' columns), ie the background windows are gathered
+    into one (NaN-padded) array, and the (iterative) sigma-clipping is done for all windows at once.
+    
+    INPUT:
+    'filtered_flat'  : the (smoothed) flat field
+    'orders'         : the rows of the maxima of all orders in all columns, shape (n_order, nx) (as returned by "trace_orders")
+    'cliprange'      : the background windows are +/- cliprange pixels from the peak location
+    'clipsig'        : threshold (in sigmas) for the sigma-clipping of the background
+    'peaksig'        : the peaks need to lie at least 'peaksig' sigmas above the background
+    'start_col'      : the column where the tracing started (which is never masked); default is the central column
+    'chunksize'      : number of columns to process at once
+    
+    OUTPUT:
+    'mask'  : boolean mask, shape (n_order, nx)
+    
+    NOTE: for peaks closer than 'cliprange' to the edge of the chip, only the part of the window that lies on the chip is used.
+    """
+    
+    ny, nx = filtered_flat.shape
+    if start_col is None:
+        start_col = int(nx / 2)
+    rows = orders.astype(int)
+    n_order = rows.shape[0]
+    
+    mask = np.ones((n_order, nx), dtype=bool)
+    offsets = np.arange(-cliprange, cliprange+1)
+    
+    for c0 in range(0, nx, chunksize):
+        cols = np.arange(c0, min(c0 + chunksize, nx))
+        r = rows[:, cols]
+        # gather the background windows, shape (n_order, ncol, 2*cliprange+1), with NaNs for pixels that are off the chip
+        winrows = r[:, :, np.newaxis] + offsets
+        onchip = np.logical_and(winrows >= 0, winrows < ny)
+        bg = np.where(onchip, filtered_flat[np.clip(winrows, 0, ny-1), cols[np.newaxis, :, np.newaxis]], np.nan)
+        # iterative sigma-clipping (same as "sigma_clip" for each window)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            while True:
+                med = np.nanmedian(bg, axis=2)[:, :, np.newaxis]
+                rms = np.nanstd(bg, axis=2)[:, :, np.newaxis]
+                bad = np.logical_or(bg - med > clipsig*rms, med - bg > clipsig*rms)
+                if not np.any(bad):
+                    break
+                bg[bad] = np.nan
+            med = np.nanmedian(bg, axis=2)
+            rms = np.nanstd(bg, axis=2)
+        peak = filtered_flat[r, cols]
+        mask[:, cols] = ~np.logical_or(peak - med < peaksig*rms, np.logical_or(r == 0, r == ny-1))
+    
+    # the starting column is never masked
+    mask[:, start_col] = True
+    
+    return mask
+
+
+
+def refine_stripes(flat, P_id_prev, ncols=32, search=5, deg_correction=1, maxresid=0.25, gauss_filter_sigma=3., deg_polynomial=2,
+                   maskthresh=100., weighted_fits=True, simu=False, timit=False, debug_level=0):
+    """
+    Incremental alternative to "find_stripes", for when the traces of the orders are already known from a previous night (orders usually
+    only shift by a fraction of a pixel). The positions of the peaks of all orders are measured in a handful of columns (in a window
+    of +/- 'search' pixels around the previous traces, with sub-pixel precision from a parabola through the 3 highest pixels), and the
+    previous traces are then corrected by a low-order polynomial in x (ie an offset for deg_correction=0, or offset & tilt for
+    deg_correction=1, etc.). Only orders for which this correction does not describe the measured offsets well (or for which there
+    are not enough measurements) are re-traced from scratch (see "trace_orders"); if there are not enough valid peaks for that either,
+    the previous trace is kept. The order numbering (ie the keys) is the same as in 'P_id_prev'.
+    
+    INPUT:
+    'flat'                : dark-corrected flat field spectrum
+    'P_id_prev'           : dictionary of the form of {order: np.poly1d, ...} from a previous night
+    'ncols'               : number of columns used to measure the offsets
+    'search'              : the peaks are searched for within +/- search pixels of the previous traces
+    'deg_correction'      : degree of the polynomial correction applied to the previous traces
+    'maxresid'            : maximum rms (in pixels) of the measured offsets around the correction; orders with larger rms are re-traced
+    'gauss_filter_sigma'  : sigma of the gaussian filter used to smooth the image
+    'deg_polynomial'      : degree of the polynomial fit for re-traced orders
+    'maskthresh'          : minimum (smoothed) flux for the peak of an order to be considered valid
+    'weighted_fits'       : boolean - weighted polynomial fits for re-traced orders (as in "find_stripes")?
+    'simu'                : boolean - are you using ES-simulated spectra???
+    'timit'               : boolean - do you want to measure execution run time?
+    'debug_level'         : for debugging...
+    
+    OUTPUT:
+    'P_id'  : dictionary of the form of {order: np.poly1d, ...} containing the refined traces
+    'mask'  : dictionary of boolean masks (keys = orders) (same as from "make_mask_dict")
+    """
+    
+    if timit:
+        start_time = time.time()
+    
+    print("Refining stripes...")
+    ny, nx = flat.shape
+    xx = np.arange(nx)
+    
+    # smooth image slightly for noise reduction
+    filtered_flat = ndimage.gaussian_filter(flat.astype(float), gauss_filter_sigma)
+    
+    ords = sorted(P_id_prev.keys())
+    cols = np.linspace(0, nx-1, ncols+2)[1:-1].astype(int)
+    
+    # predicted positions of the peaks, shape (n_order, ncols)
+    y0 = np.array([np.poly1d(P_id_prev[o])(cols) for o in ords])
+    # the profiles of all orders in all sampled columns, shape (n_order, ncols, 2*search+1)
+    winrows = np.round(y0).astype(int)[:, :, np.newaxis] + np.arange(-search, search+1)
+    onchip = np.logical_and(winrows >= 0, winrows < ny)
+    prof = np.where(onchip, filtered_flat[np.clip(winrows, 0, ny-1), cols[np.newaxis, :, np.newaxis]], -np.inf)
+    # sub-pixel peak positions
+    k = np.argmax(prof, axis=2)
+    kk = np.clip(k, 1, 2*search-1)
+    fm, f0, fp = [np.take_along_axis(prof, (kk + d)[:, :, np.newaxis], axis=2)[:, :, 0] for d in (-1, 0, 1)]
+    valid = np.logical_and(np.logical_and(k > 0, k < 2*search), f0 >= maskthresh)
+    valid = np.logical_and(valid, np.logical_and(np.isfinite(fm), np.isfinite(fp)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        denom = fm - 2.*f0 + fp
+        subpix = np.where(np.logical_and(valid, denom < 0), 0.5 * (fm - fp) / denom, 0.)
+    dy = winrows[:, :, 0] + k + subpix - y0
+    
+    P_id = {}
+    mask = {}
+    n_retraced = 0
+    for i, o in enumerate(ords):
+        v = valid[i, :]
+        refined = False
+        if np.sum(v) > deg_correction + 2:
+            corr = np.poly1d(np.polyfit(cols[v], dy[i, v], deg_correction))
+            resid = dy[i, v] - corr(cols[v])
+            if np.sqrt(np.mean(resid**2)) <= maxresid:
+                # just apply the correction to the previous trace
+                P_id[o] = np.poly1d(P_id_prev[o]) + corr
+                rows = np.round(P_id[o](xx)).astype(int)
+                onchip = np.logical_and(rows > 0, rows < ny-1)
+                mask[o] = np.logical_and(onchip, filtered_flat[np.clip(rows, 0, ny-1), xx] >= maskthresh)
+                refined = True
+        if not refined:
+            # re-trace this order from scratch, starting at the peak closest to the (corrected) previous trace in the central column
+            n_retraced += 1
+            if debug_level > 0:
+                print('Re-tracing ' + o + '...')
+            centre = int(nx / 2)
+            shift = np.median(dy[i, v]) if np.any(v) else 0.
+            start_row = int(np.round(np.poly1d(P_id_prev[o])(centre) + shift))
+            window = np.arange(max(1, start_row - search), min(ny - 1, start_row + search + 1))
+            start_row = window[np.argmax(filtered_flat[window, centre])]
+            orders, peakflux = trace_orders(filtered_flat, [start_row], start_col=centre)
+            mask[o] = ~np.logical_or(peakflux[0] < maskthresh, np.logical_or(orders[0] == 0, orders[0] == ny-1))
+            if np.sum(mask[o]) <= deg_polynomial:
+                # not enough valid peaks for the fit, so keep the previous trace
+                print('WARNING: not enough valid peaks to re-trace ' + o + ' - keeping the previous trace!!!')
+                P_id[o] = np.poly1d(P_id_prev[o])
+                rows = np.round(P_id[o](xx)).astype(int)
+                onchip = np.logical_and(rows > 0, rows < ny-1)
+                mask[o] = np.logical_and(onchip, filtered_flat[np.clip(rows, 0, ny-1), xx] >= maskthresh)
+            elif weighted_fits:
+                w = np.sqrt(np.clip(filtered_flat[orders[0].astype(int), xx], 1, None))
+                P_id[o] = np.poly1d(np.polyfit(xx[mask[o]], orders[0, mask[o]], deg_polynomial, w=w[mask[o]]))
+            else:
+                P_id[o] = np.poly1d(np.polyfit(xx[mask[o]], orders[0, mask[o]], deg_polynomial))
+        # exclude the range of order_01 (m = 65) that does fall off the chip!
+        if o == 'order_01':
+            if simu:
+                mask[o][xx < 1300] = False
+            else:
+                mask[o][xx < 900] = False
+    
+    print('Number of stripes re-traced: %d' % n_retraced)
+    
+    if timit:
+        print('Elapsed time: '+str(time.time() - start_time)+' seconds')
+    
+    return P_id, mask
+
+
+
 def make_P_id(P):
     P_id = {}
     ordernames = []
@@ -326,6 +514,129 @@ def extract_stripes(img, P_id, slit_height=25, return_indices=True, savefiles=Fa
 
 
 
+def get_stripe_window_bounds(y, slit_height=25):
+    """
+    Returns the first and last row of the window of pixels around the order trace in each pixel column, ie of all rows with
+    abs(row - y) <= slit_height (as in "extract_single_stripe"). The rows are computed with exactly the same floating-point comparison,
+    so that rows lying right at the edge of the window are treated the same way as in a full-frame comparison. The rows are NOT
+    restricted to the chip.
+    
+    INPUT:
+    'y'            : the order trace, ie the (fractional) row numbers of the order trace in each pixel column
+    'slit_height'  : half the height of the window in pixels
+    
+    OUTPUT:
+    'first'  : the first row of the window in each pixel column (as float)
+    'last'   : the last row of the window in each pixel column (as float)
+    """
+    
+    first = np.ceil(y - slit_height)
+    first[np.abs(first - 1. - y) <= slit_height] -= 1.
+    first[np.abs(first - y) > slit_height] += 1.
+    last = np.floor(y + slit_height)
+    last[np.abs(last + 1. - y) <= slit_height] += 1.
+    last[np.abs(last - y) > slit_height] -= 1.
+    
+    return first, last
+
+
+
+def make_stripe_geometry(P_id, nx, slit_height=25):
+    """
+    Compact alternative to the "stripe_indices" returned by "extract_stripes". Rather than a full-frame boolean mask for each
+    order, the geometry of each stripe is described by the row number of the lowest pixel of each cutout (ie one integer per
+    pixel column; see "get_stripe_start_rows"), computed directly from the polynomials describing the traces. It can be used
+    instead of "stripe_indices" by all routines that use "flatten_single_stripe_from_indices", ie "quick_extract_from_indices",
+    "collapse_extract_from_indices", "optimal_extraction_from_indices", "extract_spectrum_from_indices", and "fit_profiles_from_indices".
+    
+    INPUT:
+    'P_id'         : dictionary of the form of {order: np.poly1d, ...} (as returned by "identify_stripes")
+    'nx'           : number of pixel columns of the image
+    'slit_height'  : height of the extraction slit (ie the pixel columns are 2*slit_height pixels long)
+    
+    OUTPUT:
+    'stripe_geometry'  : dictionary (keys = orders) containing the row numbers of the lowest pixel of each cutout
+    
+    NOTE: the start rows are the same as from "get_stripe_start_rows" for the "stripe_indices" from "extract_stripes", except for cutouts
+          that lie completely above the top of the chip (as 'ny' is not known here); "flatten_single_stripe_from_indices" gives
+          identical results for those as well.
+    """
+    
+    xx = np.arange(nx, dtype='f8')
+    
+    stripe_geometry = {}
+    for o, p in sorted(P_id.items()):
+        y = np.poly1d(p)(xx)
+        first, last = get_stripe_window_bounds(y, slit_height=slit_height)
+        # same conventions as in "get_stripe_start_rows", ie the cutouts start at the first row of the window (so if p(x) is an
+        # integer and the window has 2*slit_height+1 rows, the top row is not included), unless the window is cut off at the
+        # bottom of the chip, in which case the cutouts end at the last row of the window
+        start_rows = first.astype(int)
+        bottom = first <= 0
+        start_rows[bottom] = last[bottom].astype(int) + 1 - 2*slit_height
+        # cutouts completely off the chip (at the bottom)
+        start_rows[last < 0] = -2*slit_height
+        stripe_geometry[o] = start_rows
+    
+    return stripe_geometry
+
+
+
+# in-memory cache for the stripe geometries (keys = hashes of P_id & slit_height; see "get_stripe_geometry")
+stripe_geometry_cache = {}
+
+def get_stripe_geometry(P_id, nx, slit_height=25, cachedir=None):
+    """
+    Cached version of "make_stripe_geometry". As the same P_id is used for all frames of a night, the stripe geometry only needs to be
+    computed once. It is kept in memory, and (if 'cachedir' is provided) also saved to disk as a small .npz file, so that it can be
+    re-used in later sessions as well. The cache key is a hash of the polynomial coefficients in P_id, 'nx' and 'slit_height'.
+    
+    INPUT:
+    'P_id'         : dictionary of the form of {order: np.poly1d, ...} (as returned by "identify_stripes")
+    'nx'           : number of pixel columns of the image
+    'slit_height'  : height of the extraction slit (ie the pixel columns are 2*slit_height pixels long)
+    'cachedir'     : directory for the .npz cache files (if None, the stripe geometry is only cached in memory)
+    
+    OUTPUT:
+    'stripe_geometry'  : dictionary (keys = orders) containing the row numbers of the lowest pixel of each cutout (as read-only arrays)
+    """
+    
+    sha = hashlib.sha1()
+    sha.update(str((nx, slit_height)).encode())
+    for o, p in sorted(P_id.items()):
+        sha.update(o.encode())
+        sha.update(np.asarray(np.poly1d(p).coeffs, dtype=float).tobytes())
+    key = sha.hexdigest()
+    
+    if key not in stripe_geometry_cache:
+        if cachedir is not None:
+            cachefile = os.path.join(cachedir, 'stripe_geometry_' + key + '.npz')
+        
+        if cachedir is not None and os.path.exists(cachefile):
+            with np.load(cachefile) as npz:
+                stripe_geometry = {o: npz[o] for o in npz.files}
+        else:
+            stripe_geometry = make_stripe_geometry(P_id, nx, slit_height=slit_height)
+            if cachedir is not None:
+                if not os.path.exists(cachedir):
+                    os.makedirs(cachedir)
+                # write to temporary file first, so that other processes never see a half-written cache file
+                tmpfile = cachefile[:-4] + '_' + str(os.getpid()) + '.tmp.npz'
+                np.savez(tmpfile, **stripe_geometry)
+                os.replace(tmpfile, cachefile)
+        
+        # the cached arrays are shared between all callers, so make sure they cannot be modified in place
+        for start_rows in stripe_geometry.values():
+            start_rows.setflags(write=False)
+        stripe_geometry_cache[key] = stripe_geometry
+    
+    # (shallow) copy, so that adding / removing orders does not change the cached entry
+    stripe_geometry = dict(stripe_geometry_cache[key])
+    
+    return stripe_geometry
+
+
+
 def flatten_single_stripe(stripe, slit_height=25, timit=False):
     """
     CMB 06/09/2017
@@ -468,6 +779,32 @@ def flatten_single_stripe(stripe, slit_height=25, timit=False):
    
    
 
+def get_stripe_start_rows(indices, slit_height=25):
+    """
+    Converts the indices (ie the full-frame boolean mask) of a stripe into a compact representation of the stripe geometry, ie
+    into the row number of the lowest pixel of each cutout (ie one integer per pixel column). For cutouts that are partly cut off
+    at the bottom of the chip the start row is negative, and for cutouts that lie completely off the chip it is -2*slit_height.
+    
+    INPUT:
+    "indices": indices of img, that correspond to the stripe identified in 'extract_single_stripe'
+    "slit_height": height of the extraction slit is 2*slit_height pixels
+    
+    OUTPUT:
+    "start_rows": row numbers of the lowest pixel of each cutout
+    """
+    
+    n = np.sum(indices, axis=0)
+    start_rows = np.argmax(indices, axis=0)
+    #parts missing at BOTTOM???
+    bottom = indices[0,:]
+    start_rows[bottom] = n[bottom] - 2*slit_height
+    #cutout completely off the chip?
+    start_rows[n == 0] = -2*slit_height
+    
+    return start_rows
+
+
+
 def flatten_single_stripe_from_indices(img, indices, slit_height=25, timit=False):
     """
     CMB 07/03/2018
@@ -477,7 +814,8 @@ def flatten_single_stripe_from_indices(img, indices, slit_height=25, timit=False
 
     INPUT:
     "img": the image from the FITS file
-    "indices": indices of img, that correspond to the stripe identified in 'extract_single_stripe'
+    "indices": indices of img, that correspond to the stripe identified in 'extract_single_stripe'; alternatively, the row numbers
+               of the lowest pixel of each cutout (see "get_stripe_start_rows"), which is much faster
     
     OUTPUT:
     "stripe_columns": dense rectangular matrix containing only the non-zero elements of "stripe". This has
@@ -493,38 +831,18 @@ def flatten_single_stripe_from_indices(img, indices, slit_height=25, timit=False
     
     ny, nx = img.shape
     
-    #stripe_flux = np.zeros((2*slit_height, 4096))
-    stripe_flux = np.zeros((2*slit_height, nx))
-    #stripe_rows = np.zeros((int(len(contents[0]) / len(col_indices)),len(col_indices)))
-    stripe_rows = np.zeros((2*slit_height, nx))
+    if np.ndim(indices) == 2:
+        start_rows = get_stripe_start_rows(indices, slit_height=slit_height)
+    else:
+        start_rows = np.asarray(indices)
     
-    for i in range(nx):
-        #this is the cutout from the original image
-        flux = img[:,i][indices[:,i]]
-        rownum = (indices[:,i] * np.arange(ny))[indices[:,i]]
-        #now check if the full cutout lies on the image
-        #cutout completely off the chip?
-        if len(rownum) == 0:
-            n_miss = 2 * slit_height
-            flux = np.repeat([-1],n_miss)
-            rownum = np.repeat([0],n_miss)
-        #parts missing at BOTTOM???
-        elif rownum[0] == 0:
-            #how many missing?
-            n_miss = 2*slit_height - len(rownum)
-            #append flux and rownum
-            flux = np.append(np.repeat([-1],n_miss),flux)
-            rownum = np.append(np.repeat([0],n_miss),rownum)
-        #parts missing at TOP???
-        elif rownum[-1] == ny-1:
-            #how many missing?
-            n_miss = 2*slit_height - len(rownum)
-            #append flux and rownum
-            flux = np.append(flux,np.repeat([-1],n_miss))
-            rownum = np.append(rownum,np.repeat([0],n_miss))
-    
-        stripe_flux[:,i] = flux
-        stripe_rows[:,i] = rownum
+    #row numbers of all pixels in all cutouts
+    rownum = start_rows[np.newaxis,:] + np.arange(2*slit_height)[:,np.newaxis]
+    #pixels that do not lie on the chip are filled with -1 (flux) and 0 (row number)
+    onchip = np.logical_and(rownum >= 0, rownum < ny)
+    rownum[~onchip] = 0
+    stripe_flux = np.where(onchip, img[rownum, np.arange(nx)], -1.).astype(float)
+    stripe_rows = rownum
     
     if timit:
         delta_t = time.time() - start_time
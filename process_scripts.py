@@ -9,11 +9,11 @@ import numpy as np
 import time
 # import os
 
-from helper_functions import binary_indices
-from calibration import correct_for_bias_and_dark_from_filename
+from helper_functions import binary_indices, correct_orientation
+from calibration import correct_for_bias_and_dark_from_filename, combine_images, read_frames, make_dark_library, get_dark
 # from basic_reduction.cosmic_ray_removal import remove_cosmics
 # from basic_reduction.background import remove_background
-from order_tracing import extract_stripes
+from order_tracing import extract_stripes, get_stripe_geometry
 from extraction import extract_spectrum, extract_spectrum_from_indices
 # from basic_reduction.relative_intensities import get_relints, get_relints_from_indices, append_relints_to_FITS
 # from basic_reduction.get_info_from_headers import get_obs_coords_from_header
@@ -67,57 +67,60 @@ def process_whites(white_list, MB=None, ronmask=None, MD=None, gain=None, scalab
     if ronmask is None:
         #no need to fix orientation, this is already a processed file [e-]
         ronmask = pyfits.getdata(path+'read_noise_mask.fits')
-    if MD is None:
-        if scalable:
-            #no need to fix orientation, this is already a processed file [e-]
-            MD = pyfits.getdata(path+'master_dark_scalable.fits', 0)
-#             err_MD = pyfits.getdata(path+'master_dark_scalable.fits', 1)
-        else:
-            #no need to fix orientation, this is already a processed file [e-]
-            MD = pyfits.getdata(path+'master_dark_t'+str(int(np.round(texp,0)))+'.fits', 0)
-#             err_MD = pyfits.getdata(path+'master_dark_t'+str(int(np.round(texp,0)))+'.fits', 1)
-
-
-    #prepare arrays
-    allimg = []
-    allerr = []
-
-    #loop over all files in "white_list"; correct for bias and darks on the fly
-    for n,fn in enumerate(sorted(white_list)):
-        if debug_level >=1:
-            print('Now processing file: '+str(fn))
-
-        # if the darks have a different exposure time than the whites, then we need to re-scale the master dark
-        try:
-            texp = pyfits.getval(white_list[0], 'TOTALEXP')
-        except:
-            texp = 1.
-
-        #call routine that does all the bias and dark correction stuff and converts from ADU to e-
-        # if scalable:
-        #     img = correct_for_bias_and_dark_from_filename(fn, MB, MD*texp, gain=gain, scalable=scalable, savefile=saveall,
-        #                                                   path=path, timit=timit)     #these are now bias- & dark-corrected images; units are e-
-        # else:
-        #     img = correct_for_bias_and_dark_from_filename(fn, MB, MD, gain=gain, scalable=scalable, savefile=saveall,
-        #                                                   path=path, timit=timit)  # these are now bias- & dark-corrected images; units are e-
-        img = pyfits.getdata(fn)
-
-        if debug_level >=2:
-            print('min(img) = '+str(np.min(img)))
-        allimg.append(img)
-#         allerr.append(err)
-#         allerr.append( np.sqrt(img + ronmask*ronmask) )   # [e-]
-        #dumb fix for negative pixel values that can occur, if we haven't masked out bad pixels yet
-        allerr.append( np.sqrt(np.abs(img) + ronmask*ronmask) )   # [e-]
-
-
-    #########################################################################
-    ### now we do essentially what "CREATE_MASTER_IMG" does for whites... ###
-    #########################################################################
-    #add individual-image errors in quadrature (need it either way, not only for fancy method)
-    err_summed = np.sqrt(np.sum((np.array(allerr)**2),axis=0))
-    #get median image
-    medimg = np.median(np.array(allimg), axis=0)
+    if MD is None and scalable:
+        #no need to fix orientation, this is already a processed file [e-]
+        MD = pyfits.getdata(path+'master_dark_scalable.fits', 0)
+#         err_MD = pyfits.getdata(path+'master_dark_scalable.fits', 1)
+    #NOTE: the dark correction of the whites is currently switched off (see below), so there is no need to load a master dark
+    #      with the matching exposure time from the dark library (see "make_dark_library" / "get_dark") here
+
+
+    if fancy:
+        #the 'fancy' method needs all individual images
+        #prepare arrays
+        allimg = []
+        allerr = []
+
+        #loop over all files in "white_list"; correct for bias and darks on the fly (files are read in the background)
+        for n,(fn,img) in enumerate(zip(sorted(white_list), read_frames(sorted(white_list), raw=True))):
+            if debug_level >=1:
+                print('Now processing file: '+str(fn))
+
+            # if the darks have a different exposure time than the whites, then we need to re-scale the master dark
+            try:
+                texp = pyfits.getval(white_list[0], 'TOTALEXP')
+            except:
+                texp = 1.
+
+            #call routine that does all the bias and dark correction stuff and converts from ADU to e-
+            # if scalable:
+            #     img = correct_for_bias_and_dark_from_filename(fn, MB, MD*texp, gain=gain, scalable=scalable, savefile=saveall,
+            #                                                   path=path, timit=timit)     #these are now bias- & dark-corrected images; units are e-
+            # else:
+            #     img = correct_for_bias_and_dark_from_filename(fn, MB, MD, gain=gain, scalable=scalable, savefile=saveall,
+            #                                                   path=path, timit=timit)  # these are now bias- & dark-corrected images; units are e-
+
+            if debug_level >=2:
+                print('min(img) = '+str(np.min(img)))
+            allimg.append(img)
+    #         allerr.append(err)
+    #         allerr.append( np.sqrt(img + ronmask*ronmask) )   # [e-]
+            #dumb fix for negative pixel values that can occur, if we haven't masked out bad pixels yet
+            allerr.append( np.sqrt(np.abs(img) + ronmask*ronmask) )   # [e-]
+
+
+        #########################################################################
+        ### now we do essentially what "CREATE_MASTER_IMG" does for whites... ###
+        #########################################################################
+        #add individual-image errors in quadrature (need it either way, not only for fancy method)
+        err_summed = np.sqrt(np.sum((np.array(allerr)**2),axis=0))
+        #get median image
+        medimg = np.median(np.array(allimg), axis=0)
+    else:
+        #combine tile by tile from the memory-mapped files, rather than stacking all images in memory;
+        #sum over all images of (np.abs(img) + ronmask*ronmask) gives the same errors as adding the individual-image errors in quadrature
+        medimg, abssum = combine_images(sorted(white_list), method='median', raw=True, return_abssum=True, debug_level=debug_level)
+        err_summed = np.sqrt(abssum + len(white_list) * ronmask*ronmask)
 
     if fancy:
         #need to create a co-added frame if we want to do outlier rejection the fancy way
@@ -156,7 +159,6 @@ def process_whites(white_list, MB=None, ronmask=None, MD=None, gain=None, scalab
         err_master = err_summed / len(white_list)
     else:
         #ie not fancy, just take the median image to remove outliers
-        medimg = np.median(np.array(allimg), axis=0)
         #now set master image equal to median image
         master = medimg.copy()
         #estimate of the corresponding error array (estimate only!!!)
@@ -195,7 +197,7 @@ def process_whites(white_list, MB=None, ronmask=None, MD=None, gain=None, scalab
 
 
 def process_science_images(imglist, P_id, mask=None, sampling_size=25, slit_height=25, gain=[1.,1.,1.,1.], MB=None, ronmask=None, MD=None, scalable=False, saveall=False, path=None, ext_method='optimal', 
-                           from_indices=True, slope=True, offset=True, fibs='all', timit=False):
+                           from_indices=True, slope=True, offset=True, fibs='all', bias_from_overscan=False, timit=False):
     """
     Process all science images. This includes:
     
@@ -224,26 +226,28 @@ def process_science_images(imglist, P_id, mask=None, sampling_size=25, slit_heig
         print('Using same directory as input file...')
         dum = imglist[0].split('/')
         path = imglist[0][0:-len(dum[-1])]
-    if MB is None:
+    if MB is None and not bias_from_overscan:
         #no need to fix orientation, this is already a processed file [ADU]
         MB = pyfits.getdata(path+'master_bias.fits')
     if ronmask is None:
         #no need to fix orientation, this is already a processed file [e-]
         ronmask = pyfits.getdata(path+'read_noise_mask.fits')
+    dark_library = None
     if MD is None:
         if scalable:
             #no need to fix orientation, this is already a processed file [e-]
             MD = pyfits.getdata(path+'master_dark_scalable.fits', 0)
 #             err_MD = pyfits.getdata(path+'master_dark_scalable.fits', 1)
         else:
-            #no need to fix orientation, this is already a processed file [e-]
-            MD = pyfits.getdata(path+'master_dark_t'+str(int(np.round(texp,0)))+'.fits', 0)
-#             err_MD = pyfits.getdata(path+'master_dark_t'+str(int(np.round(texp,0)))+'.fits', 1)
+            #the exposure times can differ between images, so the appropriate master dark is picked from the dark library for each image (see below)
+            dark_library = make_dark_library(path)
     
     if not from_indices:
         ron_stripes = extract_stripes(ronmask, P_id, return_indices=False, slit_height=slit_height, savefiles=False, timit=True)
     
-    for i,filename in enumerate(sorted(imglist)):
+    #the raw images are read (and brought to "correct" orientation, and overscan regions removed) in the background while we work on the previous one
+    #(if the bias levels are determined from the overscan regions, these must not be cropped, so in that case we only correct the orientation here)
+    for i,(filename,raw_img) in enumerate(zip(sorted(imglist), read_frames(sorted(imglist), raw=bias_from_overscan))):
 
         print('Extracting stellar spectrum '+str(i+1)+'/'+str(len(imglist)))
 
@@ -253,7 +257,14 @@ def process_science_images(imglist, P_id, mask=None, sampling_size=25, slit_heig
         obsname = dum2[0]
               
         # (1) call routine that does all the bias and dark correction stuff and proper error treatment
-        img = correct_for_bias_and_dark_from_filename(filename, MB, MD, gain=gain, scalable=scalable, savefile=saveall, path=path, timit=True)   #[e-]
+        if bias_from_overscan:
+            raw_img = correct_orientation(raw_img)
+        if dark_library is not None:
+            #get the master dark with the nearest exposure time from the dark library (these are loaded lazily, and only once)
+            img_MD = get_dark(dark_library, pyfits.getval(filename, 'TOTALEXP'), method='nearest')
+        else:
+            img_MD = MD
+        img = correct_for_bias_and_dark_from_filename(filename, MB, img_MD, gain=gain, scalable=scalable, savefile=saveall, path=path, img=raw_img, bias_from_overscan=bias_from_overscan, timit=True)   #[e-]
         #err = np.sqrt(img + ronmask*ronmask)   # [e-]
         #TEMPFIX:
         err_img = np.sqrt(np.clip(img,0,None) + ronmask*ronmask)   # [e-]
@@ -277,8 +288,11 @@ def process_science_images(imglist, P_id, mask=None, sampling_size=25, slit_heig
         #adjust errors?
 
         # (5) extract stripes
-        stripes,stripe_indices = extract_stripes(final_img, P_id, return_indices=True, slit_height=slit_height, savefiles=saveall, obsname=obsname, path=path, timit=True)
-        if not from_indices:
+        if from_indices:
+            # the stripe geometry only depends on P_id and slit_height, so it is only computed once (and cached on disk)
+            stripe_indices = get_stripe_geometry(P_id, final_img.shape[1], slit_height=slit_height, cachedir=path)
+        else:
+            stripes,stripe_indices = extract_stripes(final_img, P_id, return_indices=True, slit_height=slit_height, savefiles=saveall, obsname=obsname, path=path, timit=True)
             err_stripes = extract_stripes(err_img, P_id, return_indices=False, slit_height=slit_height, savefiles=saveall, obsname=obsname+'_err', path=path, timit=True)
 
         # (6) perform extraction of 1-dim spectrum
@@ -664,6 +664,8 @@ def fit_profiles_from_indices(P_id, img, err_img, stripe_indices, mask=None, sta
     'P_id'          : dictionary of the form of {order: np.poly1d, ...} (as returned by "identify_stripes")
     'img'           : 2-dim input array/image
     'err_img'       : estimated uncertainties in the 2-dim input array/image
+    'stripe_indices': dictionary (keys = orders) containing the indices of the pixels that are identified as the "stripes" (or alternatively the
+                      much more compact stripe geometry from "make_stripe_geometry")
     'mask'          : dictionary of boolean masks (keys = orders) from "find_stripes" (masking out regions of very low signal)
     'stacking'      : boolean - do you want to stack the profiles from multiple pixel-columns (in order to achieve sub-pixel sampling)?
     'slit_height'   : height of the extraction slit (ie the pixel columns are 2*slit_height pixels long)
@@ -730,6 +732,7 @@ def make_model_stripes_gausslike(fibre_profiles, flat, err_img, stripe_indices,
     'flat'            : the 2-dim master white / flat-field image
     'err_img'         : the 2-dim array of the corresponding uncertainties
     'stripe_indices'  : dictionary (keys = orders) containing the indices of the pixels that are identified as the "stripes" (ie the to-be-extracted regions centred on the orders)
+                        (or alternatively the much more compact stripe geometry from "make_stripe_geometry")
     'mask'            : dictionary of boolean masks (keys = orders) from "find_stripes" (masking out regions of very low signal)
     'slit_height'     : height of the extraction slit (ie the pixel columns are 2*slit_height pixels long)
     'return_fitpars'  : boolean - do you want to return the best-fit polynomial coefficients for the parameters as well?
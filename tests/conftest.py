@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules live in the top-level directory of the repository (not in a package)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
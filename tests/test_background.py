@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from background import fit_background, fit_background_robust, get_background_mask
+
+
+def make_fake_background(ny=200, nx=200, step=1, seed=4):
+    """dictionary of background pixels (as from "extract_background_pixels") drawn from a smooth surface, plus a few outliers"""
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[0:ny:step, 0:nx:step]
+    rows = rows.ravel()
+    cols = cols.ravel()
+    z = 50. + 0.05 * rows + 0.02 * cols - 1e-4 * rows * cols + rng.normal(0., 1., len(rows))
+    return {'rows': rows, 'cols': cols, 'z': z, 'shape': (ny, nx)}
+
+
+def test_robust_fit_ignores_outliers():
+    bg = make_fake_background()
+    truth = fit_background(bg, deg=2, return_full=True)[1]
+    # add some "cosmics" / scattered-light blobs
+    hit = (bg['rows'] // 16 == 5) & (bg['cols'] // 16 == 7)
+    bg['z'][hit] += 500.
+    coeffs, bkgd_img = fit_background(bg, deg=2, return_full=True, robust=True)
+    assert bkgd_img.shape == (200, 200)
+    assert np.max(np.abs(bkgd_img - truth)) < 1.
+
+
+def test_robust_fit_falls_back_to_plain_fit():
+    # only 4 boxes with enough pixels, ie not enough to constrain a 5th-order surface
+    bg = make_fake_background(ny=32, nx=32)
+    coeffs, bkgd_img = fit_background_robust(bg, deg=5, boxsize=16)
+    plain_coeffs, plain_img = fit_background(bg, deg=5)
+    assert np.allclose(coeffs, plain_coeffs)
+    assert np.allclose(bkgd_img, plain_img)
+    # and without the full image
+    assert np.allclose(fit_background(bg, deg=5, return_full=False, robust=True), plain_coeffs)
+
+
+def old_background_mask(P_id, ny, nx, slit_height):
+    """the full-frame distance-array version of "get_background_mask" (as previously in "extract_background")"""
+    xx = np.arange(nx, dtype='f8')
+    yy = np.arange(ny, dtype='f8')
+    x_grid, y_grid = np.meshgrid(xx, yy, copy=False)
+    bg_mask = np.ones((ny, nx), dtype=bool)
+    for o, p in sorted(P_id.items()):
+        y = np.poly1d(p)(xx)
+        distance = y_grid - y.repeat(ny).reshape((nx, ny)).T
+        bg_mask *= abs(distance) > slit_height
+    return bg_mask
+
+
+@pytest.mark.parametrize('slit_height', [10, 7.3, 12.5])
+def test_background_mask_matches_distance_mask(slit_height):
+    ny, nx = 300, 200
+    P_id = {'order_01': np.poly1d([2e-4, -0.04, 3.3]),          # cut off at the bottom of the chip
+            'order_02': np.poly1d([0.25, 40.]),                  # integer values at every 4th column
+            'order_03': np.poly1d([150.]),                       # integer everywhere
+            'order_04': np.poly1d([-1e-4, 0.05, 170.123]),
+            'order_05': np.poly1d([0.13, 270.7]),                # cut off at the top of the chip
+            'order_06': np.poly1d([-0.3, 15.5]),                 # partly completely off the chip at the bottom
+            'order_07': np.poly1d([0.1, 200.3]),                 # lots of rows right at the edge of the window
+            'order_08': np.poly1d([0.7, 100.1])}
+    bg_mask = get_background_mask(P_id, ny, nx, slit_height=slit_height)
+    assert np.array_equal(bg_mask, old_background_mask(P_id, ny, nx, slit_height))
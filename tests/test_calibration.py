@@ -0,0 +1,265 @@
+import gc
+
+import astropy.io.fits as pyfits
+import numpy as np
+import pytest
+
+import calibration
+from calibration import crop_overscan_region, get_raw_frame_view, read_frames
+from helper_functions import correct_orientation, sigma_clip
+
+
+def write_fake_frames(tmp_path, n=3, shape=(4112, 4202), dtype=np.uint16):
+    rng = np.random.default_rng(0)
+    filelist = []
+    for i in range(n):
+        data = rng.integers(1000, 60000, shape).astype(dtype)
+        filename = str(tmp_path / ('frame_%d.fits' % i))
+        pyfits.PrimaryHDU(data).writeto(filename)
+        filelist.append(filename)
+    return filelist
+
+
+def test_get_raw_frame_view_matches_astropy(tmp_path):
+    filename = write_fake_frames(tmp_path, n=1)[0]
+    img = get_raw_frame_view(filename)
+    assert np.array_equal(img, crop_overscan_region(correct_orientation(pyfits.getdata(filename))))
+    raw_img = get_raw_frame_view(filename, raw=True)
+    assert np.array_equal(raw_img, pyfits.getdata(filename))
+
+
+@pytest.mark.filterwarnings('error::ResourceWarning', 'error::pytest.PytestUnraisableExceptionWarning')
+def test_read_frames_closes_files(tmp_path):
+    filelist = write_fake_frames(tmp_path, shape=(64, 48))
+    imgs = list(read_frames(filelist, raw=True, nthreads=2))
+    gc.collect()
+    for filename, img in zip(filelist, imgs):
+        assert np.array_equal(img, pyfits.getdata(filename))
+        # the images are independent of the (closed) files
+        img += 1.
+
+
+def write_fake_bias_frames(tmp_path, n=3, offsets=(1000., 1010., 1020., 1030.), ron=5.):
+    """raw bias frames with a different offset level in each quadrant (of the cropped, correctly oriented frame)"""
+    rng = np.random.default_rng(1)
+    ny, nx = 4096, 4112
+    filelist = []
+    for i in range(n):
+        img = rng.normal(0., ron, (ny, nx))
+        img[:ny//2, :nx//2] += offsets[0]
+        img[:ny//2, nx//2:] += offsets[1]
+        img[ny//2:, nx//2:] += offsets[2]
+        img[ny//2:, :nx//2] += offsets[3]
+        # put the cropped image back into a full-size raw frame (the inverse of "correct_orientation")
+        full = np.full((4202, 4112), 999.)
+        full[53:4149, :] = img
+        raw = np.fliplr(full).T
+        filename = str(tmp_path / ('bias_%d.fits' % i))
+        pyfits.PrimaryHDU(np.round(raw).astype(np.uint16)).writeto(filename)
+        filelist.append(filename)
+    return filelist
+
+
+@pytest.fixture(scope='module')
+def bias_list(tmp_path_factory):
+    return write_fake_bias_frames(tmp_path_factory.mktemp('bias'))
+
+
+@pytest.mark.parametrize('pairs', ['consecutive', 'all'])
+def test_bias_frames_are_only_read_once(bias_list, monkeypatch, pairs):
+    filelist = bias_list
+    nreads = {}
+    def counting_get_raw_frame_view(filename, raw=False):
+        nreads[filename] = nreads.get(filename, 0) + 1
+        return get_raw_frame_view(filename, raw=raw)
+    monkeypatch.setattr(calibration, 'get_raw_frame_view', counting_get_raw_frame_view)
+    budgets = []
+    combine_images = calibration.combine_images
+    def recording_combine_images(imglist, **kwargs):
+        budgets.append(kwargs.get('memory_budget'))
+        return combine_images(imglist, **kwargs)
+    monkeypatch.setattr(calibration, 'combine_images', recording_combine_images)
+
+    medimg, coeffs, offsets, rons = calibration.get_bias_and_readnoise_from_bias_frames(filelist, degpol=1, gain=np.ones(4), pairs=pairs,
+                                                                                        memory_budget=64, save_medimg=False)
+
+    if pairs == 'consecutive':
+        # the noise estimate reads every frame exactly once
+        assert all(nreads[filename] == 1 for filename in filelist)
+    else:
+        # once for the offsets, plus once for every pair the frame is part of
+        assert all(nreads[filename] == len(filelist) for filename in filelist)
+    # the median image comes from the tiled combination, within the given memory budget
+    assert budgets == [64]
+    assert np.array_equal(medimg, np.median([get_raw_frame_view(filename) for filename in filelist], axis=0))
+    assert np.allclose(offsets, [1000., 1010., 1020., 1030.], atol=0.5)
+    assert np.allclose(rons, 5., rtol=0.05)
+    assert np.allclose(coeffs[:, 0], [1000., 1010., 1020., 1030.], atol=0.5)
+
+
+def write_fake_master_darks(tmp_path, texps=(10., 30., 60.), temps=None, scalable=True):
+    """small master dark frames with a constant dark current of 0.1 e-/s"""
+    for i,texp in enumerate(texps):
+        hdr = pyfits.Header()
+        hdr['TOTALEXP'] = texp
+        if temps is not None:
+            hdr['DETTEMP'] = temps[i]
+        pyfits.PrimaryHDU(np.full((8, 6), 0.1 * texp + i), header=hdr).writeto(str(tmp_path / ('master_dark_t%d_%d.fits' % (texp, i))))
+    if scalable:
+        pyfits.PrimaryHDU(np.full((8, 6), 0.1)).writeto(str(tmp_path / 'master_dark_scalable.fits'))
+    return str(tmp_path) + '/'
+
+
+def test_make_dark_library(tmp_path):
+    path = write_fake_master_darks(tmp_path)
+    library = calibration.make_dark_library(path)
+    assert len(library['files']) == 3
+    assert np.array_equal(library['texp'], [10., 30., 60.])
+    assert np.all(np.isnan(library['temp']))
+    assert library['scalable'] == path + 'master_dark_scalable.fits'
+    # only the headers are read when the library is created
+    assert library['data'] == {}
+
+
+def test_get_dark_nearest(tmp_path):
+    library = calibration.make_dark_library(write_fake_master_darks(tmp_path))
+    MD = calibration.get_dark(library, 25., method='nearest')
+    assert np.allclose(MD, 0.1 * 30. + 1)
+    # frames are loaded lazily, and only once
+    assert list(library['data'].keys()) == [library['files'][1]]
+    assert calibration.get_dark(library, 35., method='nearest') is MD
+    assert np.allclose(calibration.get_dark(library, 1000., method='nearest'), 0.1 * 60. + 2)
+
+
+def test_get_dark_interpolate(tmp_path):
+    library = calibration.make_dark_library(write_fake_master_darks(tmp_path))
+    # linear interpolation between the two bracketing master darks
+    assert np.allclose(calibration.get_dark(library, 20., method='interpolate'), 0.5 * (0.1 * 10.) + 0.5 * (0.1 * 30. + 1))
+    assert np.allclose(calibration.get_dark(library, 30., method='interpolate'), 0.1 * 30. + 1)
+    # outside the range of exposure times the nearest one is used
+    assert np.allclose(calibration.get_dark(library, 5., method='interpolate'), 0.1 * 10.)
+    assert np.allclose(calibration.get_dark(library, 100., method='interpolate'), 0.1 * 60. + 2)
+
+
+def test_get_dark_scale(tmp_path):
+    library = calibration.make_dark_library(write_fake_master_darks(tmp_path))
+    assert np.allclose(calibration.get_dark(library, 45., method='scale'), 4.5)
+    # without a scalable master dark, the nearest master dark is scaled to the exposure time
+    (tmp_path / 'noscale').mkdir()
+    library = calibration.make_dark_library(write_fake_master_darks(tmp_path / 'noscale', scalable=False))
+    assert library['scalable'] is None
+    assert np.allclose(calibration.get_dark(library, 45., method='scale'), (0.1 * 30. + 1) * 45. / 30.)
+
+
+def test_get_dark_nearest_temperature(tmp_path):
+    path = write_fake_master_darks(tmp_path, texps=(10., 30., 60.), temps=(-100., -90., -100.))
+    library = calibration.make_dark_library(path, tempkey='DETTEMP')
+    assert np.array_equal(library['temp'], [-100., -90., -100.])
+    # only master darks at the nearest temperature are considered
+    assert np.allclose(calibration.get_dark(library, 30., temp=-99., method='nearest'), 0.1 * 10.)
+    assert np.allclose(calibration.get_dark(library, 30., temp=-91., method='nearest'), 0.1 * 30. + 1)
+    assert np.allclose(calibration.get_dark(library, 35., temp=-101., method='interpolate'), 0.5 * (0.1 * 10.) + 0.5 * (0.1 * 60. + 2))
+
+
+def write_fake_raw_stack(tmp_path, n=5, shape=(64, 48)):
+    """small frames (in raw orientation) with exposure times, and a few outliers"""
+    rng = np.random.default_rng(2)
+    filelist = []
+    for i in range(n):
+        data = rng.normal(1000., 10., shape)
+        data[rng.integers(0, shape[0], 5), rng.integers(0, shape[1], 5)] += 5000.
+        hdr = pyfits.Header()
+        hdr['TOTALEXP'] = 10. * (i + 1)
+        filename = str(tmp_path / ('raw_%d.fits' % i))
+        pyfits.PrimaryHDU(data, header=hdr).writeto(filename)
+        filelist.append(filename)
+    return filelist
+
+
+@pytest.mark.parametrize('memory_budget', [1024, 0.01])
+def test_combine_images_matches_full_stack(tmp_path, memory_budget):
+    filelist = write_fake_raw_stack(tmp_path)
+    stack = np.array([pyfits.getdata(filename) for filename in filelist])
+    texps = np.array([pyfits.getval(filename, 'TOTALEXP') for filename in filelist])
+    MB = np.full(stack.shape[1:], 990.)
+
+    assert np.array_equal(calibration.combine_images(filelist, method='median', raw=True, memory_budget=memory_budget),
+                          np.median(stack, axis=0))
+    assert np.allclose(calibration.combine_images(filelist, method='mean', raw=True, memory_budget=memory_budget),
+                       np.mean(stack, axis=0), rtol=1e-14)
+    medimg, abssum = calibration.combine_images(filelist, method='median', MB=MB, scalable=True, raw=True, return_abssum=True,
+                                                memory_budget=memory_budget)
+    scaled = (stack - MB) / texps[:, np.newaxis, np.newaxis]
+    assert np.allclose(medimg, np.median(scaled, axis=0), rtol=1e-14)
+    assert np.allclose(abssum, np.sum(np.abs(scaled), axis=0), rtol=1e-14)
+    assert np.allclose(calibration.make_median_image(filelist, raw=True, memory_budget=memory_budget), np.median(stack, axis=0))
+
+    # iteratively sigma-clipped mean of the full stack
+    clipped = stack.copy()
+    for n in range(3):
+        outies = np.abs(clipped - np.nanmedian(clipped, axis=0)) > 2. * np.nanstd(clipped, axis=0)
+        if not np.any(outies):
+            break
+        clipped[outies] = np.nan
+    assert np.allclose(calibration.combine_images(filelist, method='clippedmean', clip=2., raw=True, memory_budget=memory_budget),
+                       np.nanmean(clipped, axis=0), rtol=1e-14)
+
+
+def test_combine_images_raw_frames_matches_full_stack(bias_list):
+    # uint16 frames (ie with BZERO), brought to the correct orientation and cropped tile by tile
+    medimg = calibration.combine_images(bias_list, method='median', memory_budget=16)
+    assert medimg.shape == (4096, 4112)
+    assert np.array_equal(medimg, np.median([get_raw_frame_view(filename) for filename in bias_list], axis=0))
+
+
+def test_quadrant_statistics_match_masks():
+    rng = np.random.default_rng(3)
+    ny, nx = 40, 56
+    img = rng.normal(100., 5., (ny, nx))
+    img[rng.integers(0, ny, 20), rng.integers(0, nx, 20)] = np.nan
+    masks = calibration.make_quadrant_masks(nx, ny)
+    assert np.array_equal(calibration.get_quadrant_medians(img), [np.nanmedian(img[q]) for q in masks])
+    for view, q in zip(calibration.get_quadrant_views(img), masks):
+        assert np.array_equal(view.ravel(), img[q], equal_nan=True)
+        assert np.array_equal(np.nanstd(sigma_clip(view.ravel(), 5)), np.nanstd(sigma_clip(img[q], 5)))
+    # in-place operations on the views (eg the gain correction)
+    gain = [1.1, 1.2, 1.3, 1.4]
+    img_views = img.copy()
+    for view, g in zip(calibration.get_quadrant_views(img_views), gain):
+        view *= g
+    img_masks = img.copy()
+    for q, g in zip(masks, gain):
+        img_masks[q] = g * img_masks[q]
+    assert np.array_equal(img_views, img_masks, equal_nan=True)
+    offmask, ronmask = calibration.make_offmask_and_ronmask([1., 2., 3., 4.], [5., 6., 7., 8.], nx, ny)
+    for q, offset, ron in zip(masks, [1., 2., 3., 4.], [5., 6., 7., 8.]):
+        assert np.all(offmask[q] == offset) and np.all(ronmask[q] == ron)
+
+
+def test_overscan_bias_and_readnoise_match_masks():
+    rng = np.random.default_rng(4)
+    offsets = np.array([1000., 1010., 1020., 1030.])
+    rons = np.array([4., 5., 6., 7.])
+    # in the correct orientation, the overscan regions are the first and last 53 rows
+    img = np.zeros((4202, 4112))
+    ny, nx = img.shape
+    top = np.zeros((ny, nx), dtype=bool)
+    top[:53, :] = True
+    bottom = np.zeros((ny, nx), dtype=bool)
+    bottom[ny-53:, :] = True
+    left = np.zeros((ny, nx), dtype=bool)
+    left[:, :nx//2] = True
+    masks = [top & left, top & ~left, bottom & ~left, bottom & left]
+    for q, offset, ron in zip(masks, offsets, rons):
+        img[q] = rng.normal(offset, ron, np.sum(q))
+    img[5, 10] = 60000.
+    masked_offsets = [np.nanmedian(img[q]) for q in masks]
+    masked_rons = [np.nanstd(sigma_clip(img[q], 5)) for q in masks]
+    gain = np.array([0.9, 1., 1.1, 1.2])
+    # either in the correct orientation, or as read from disk
+    for frame in (img, np.fliplr(img).T):
+        overscan_offsets, overscan_rons = calibration.get_bias_and_readnoise_from_overscan(frame, gain=gain)
+        assert np.array_equal(overscan_offsets, masked_offsets)
+        assert np.allclose(overscan_rons, np.array(masked_rons) * gain, rtol=1e-14)
+    assert np.allclose(overscan_offsets, offsets, atol=0.5)
+    assert np.allclose(overscan_rons, rons * gain, rtol=0.05)
@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+from cosmic_ray_removal import clean_cosmics, identify_cosmics, identify_cosmics_tiled, rebin2x2
+
+
+def make_fake_frame(ny=200, nx=120, seed=3):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:ny, :nx]
+    # smooth background plus a few "orders"
+    img = 100. + 0.2 * xx + 500. * np.exp(-0.5 * ((yy % 40 - 20) / 3.) ** 2)
+    img = rng.poisson(img).astype(float) + rng.normal(0., 4., img.shape)
+    # cosmics, including some that cross the boundaries of 4 bands (at rows 50, 100, 150)
+    tracks = [(48, 10, 6, 1), (99, 40, 4, 0), (149, 70, 2, 1), (150, 90, 1, 1), (101, 100, 3, 3), (20, 60, 1, 0), (170, 5, 1, 2)]
+    for y0, x0, length, dx in tracks:
+        for k in range(length):
+            img[y0 + k, x0 + k * dx] += 3000.
+    return img, tracks
+
+
+def test_rebin2x2():
+    a = np.arange(24.).reshape(4, 6)
+    b = rebin2x2(a)
+    assert b.shape == (2, 3)
+    assert np.allclose(b, a.reshape(2, 2, 3, 2).mean(axis=(1, 3)))
+    with pytest.raises(RuntimeError):
+        rebin2x2(np.zeros((3, 4)))
+
+
+def test_identify_cosmics_finds_cosmics():
+    img, tracks = make_fake_frame()
+    mask = identify_cosmics(img, 4.)
+    assert mask.shape == img.shape
+    for y0, x0, length, dx in tracks:
+        for k in range(length):
+            assert mask[y0 + k, x0 + k * dx]
+
+
+@pytest.mark.parametrize('nbands', [2, 4, 7])
+@pytest.mark.parametrize('halo', [8, 12])
+def test_tiled_mask_equals_full_frame_mask(nbands, halo):
+    img, tracks = make_fake_frame()
+    ronmask = 4. * np.ones(img.shape)
+    full_mask = identify_cosmics(img, ronmask)
+    tiled_mask = identify_cosmics_tiled(img, ronmask, nbands=nbands, halo=halo, nthreads=2)
+    assert np.sum(full_mask) > 0
+    assert np.array_equal(tiled_mask, full_mask)
+
+
+def test_tiled_rejects_bad_halo():
+    img, tracks = make_fake_frame()
+    assert identify_cosmics_tiled(img, 4., halo=6) is None
+    assert identify_cosmics_tiled(img, 4., halo=9) is None
+
+
+def clean_cosmics_loop(img, mask, badpixmask=None, boxsize=5):
+    """the original per-pixel implementation of the median method of "clean_cosmics" (ported to Python 3)"""
+    cleaned = img.copy()
+    cleaned[mask] = np.inf
+    w, h = cleaned.shape
+    padsize = boxsize // 2
+    padarray = np.zeros((w + boxsize - 1, h + boxsize - 1)) + np.inf
+    padarray[padsize:w + padsize, padsize:h + padsize] = cleaned.copy()
+    if badpixmask is not None:
+        padarray[padsize:w + padsize, padsize:h + padsize][badpixmask] = np.inf
+    for x, y in np.argwhere(mask):
+        cutout = padarray[x:x + boxsize, y:y + boxsize].ravel()
+        goodcutout = cutout[cutout != np.inf]
+        if len(goodcutout) > 0:
+            replacementvalue = np.median(goodcutout)
+        else:
+            replacementvalue = np.median(padarray[padarray != np.inf])
+        cleaned[x, y] = replacementvalue
+    return cleaned
+
+
+@pytest.mark.parametrize('boxsize', [3, 5, 7])
+@pytest.mark.parametrize('use_badpixmask', [False, True])
+def test_clean_cosmics_median_equals_loop(boxsize, use_badpixmask):
+    rng = np.random.default_rng(7)
+    img = rng.normal(100., 5., (60, 50))
+    mask = rng.uniform(size=img.shape) < 0.05
+    # cosmics at the edges and corners of the chip
+    mask[0, :3] = True
+    mask[-1, -1] = True
+    mask[20:25, 0] = True
+    # a huge cosmic that fills the entire box
+    mask[30:40, 30:40] = True
+    img[mask] += 5000.
+    badpixmask = (rng.uniform(size=img.shape) < 0.02) if use_badpixmask else None
+
+    cleaned = clean_cosmics(img, mask, badpixmask=badpixmask, method='median', boxsize=boxsize)
+    assert np.allclose(cleaned, clean_cosmics_loop(img, mask, badpixmask=badpixmask, boxsize=boxsize))
+    assert np.array_equal(cleaned[~mask], img[~mask])
+
+
+def test_clean_cosmics_surface_fit():
+    # a smooth quadratic surface is reproduced exactly by the surface fit (but not by the median)
+    yy, xx = np.mgrid[:40, :40]
+    img = 100. + 2. * xx + 0.5 * yy + 0.05 * xx * xx
+    mask = np.zeros(img.shape, dtype=bool)
+    mask[10, 10] = mask[20, 31] = mask[5, 25] = True
+    spiked = img + 5000. * mask
+    cleaned = clean_cosmics(spiked, mask, method='surface', boxsize=5)
+    assert np.allclose(cleaned, img)
+
+
+def test_clean_cosmics_rejects_wrong_badpixmask():
+    img = np.ones((20, 30))
+    mask = np.zeros(img.shape, dtype=bool)
+    with pytest.raises(ValueError):
+        clean_cosmics(img, mask, badpixmask=np.zeros((30, 20), dtype=bool))
@@ -0,0 +1,132 @@
+import numpy as np
+import pytest
+
+import extraction
+from helper_functions import make_norm_profiles_for_order
+from order_tracing import flatten_single_stripe_from_indices
+
+
+NY, NX = 80, 40
+SLIT_HEIGHT = 30
+START_ROW = 10
+
+
+def make_fake_fibparms():
+    fppo = {}
+    for k in range(24):
+        fppo['fibre_' + str(k + 1).zfill(2)] = {'mu_fit': np.repeat(14. + 2.2 * (23 - k), NX) + np.linspace(0., 0.5, NX),
+                                                'sigma_fit': np.repeat(0.8, NX), 'beta_fit': np.repeat(2., NX)}
+    return {'order_02': fppo}
+
+
+def make_fake_frame(fibparms, eta, slope=False, offset=False):
+    """the image of one order that is exactly described by the normalized fibre profiles (plus offset and/or slope)"""
+    stripe_indices = {'order_02': np.repeat(START_ROW, NX)}
+    img = np.zeros((NY, NX))
+    sc, sr = flatten_single_stripe_from_indices(img, stripe_indices['order_02'], slit_height=SLIT_HEIGHT)
+    cols = np.arange(NX)
+    phi = make_norm_profiles_for_order(sr, cols, fibparms['order_02'], fibs='all', slope=slope, offset=offset)
+    img[sr, cols] = np.einsum('crf,cf->rc', phi, eta)
+    return img, stripe_indices
+
+
+@pytest.fixture
+def fake_fibparms(monkeypatch):
+    fibparms = make_fake_fibparms()
+    # the fibre profile parameters are read from a hardcoded location
+    monkeypatch.setattr(extraction.np, 'load', lambda *args, **kwargs: np.array(fibparms, dtype=object))
+    return fibparms
+
+
+@pytest.mark.parametrize('slope,offset', [(False, False), (True, False), (False, True), (True, True)])
+@pytest.mark.parametrize('batched', [True, False])
+def test_individual_fibres_with_slope_and_offset(fake_fibparms, slope, offset, batched):
+    rng = np.random.default_rng(1)
+    naddfib = int(slope) + int(offset)
+    eta = np.c_[rng.uniform(100., 1000., (NX, 24)), rng.uniform(10., 20., (NX, naddfib))]
+    img, stripe_indices = make_fake_frame(fake_fibparms, eta, slope=slope, offset=offset)
+    err_img = np.sqrt(np.abs(img) + 9.)
+
+    pix, flux, err, pixarr, fluxarr, errarr, addarr, adderrarr = extraction.optimal_extraction_from_indices(
+        img, stripe_indices, err_img=err_img, RON=3. * np.ones(img.shape), slit_height=SLIT_HEIGHT, slope=slope,
+        offset=offset, batched=batched, return_arrays=True)
+
+    assert fluxarr.shape == (1, 24, NX)
+    assert np.allclose(fluxarr[0], eta[:, :24].T, rtol=1e-6)
+    assert np.allclose(flux['order_02']['fibre_01'], fluxarr[0, 0])
+    if batched:
+        assert addarr.shape == (1, naddfib, NX)
+        assert np.allclose(addarr[0], eta[:, 24:].T, rtol=1e-6)
+
+
+@pytest.mark.parametrize('slope,offset', [(False, False), (True, False), (False, True), (True, True)])
+@pytest.mark.parametrize('batched', [True, False])
+def test_objects_from_individual_fibres(fake_fibparms, slope, offset, batched):
+    rng = np.random.default_rng(2)
+    naddfib = int(slope) + int(offset)
+    eta = np.c_[rng.uniform(100., 1000., (NX, 24)), rng.uniform(10., 20., (NX, naddfib))]
+    img, stripe_indices = make_fake_frame(fake_fibparms, eta, slope=slope, offset=offset)
+    err_img = np.sqrt(np.abs(img) + 9.)
+
+    pix, flux, err, pixarr, fluxarr, errarr, addarr, adderrarr = extraction.optimal_extraction_from_indices(
+        img, stripe_indices, err_img=err_img, RON=3. * np.ones(img.shape), slit_height=SLIT_HEIGHT, individual_fibres=False,
+        slope=slope, offset=offset, batched=batched, return_arrays=True)
+
+    objcols = extraction.get_object_columns(24)
+    assert fluxarr.shape == (1, 4, NX)
+    for k, obj in enumerate(['laser', 'sky', 'stellar', 'thxe']):
+        assert np.allclose(fluxarr[0, k], np.sum(eta[:, objcols[obj]], axis=1), rtol=1e-6)
+        assert np.allclose(flux['order_02'][obj], fluxarr[0, k])
+    # all 24 fibres belong to one of the objects
+    assert np.allclose(np.sum(fluxarr[0], axis=0), np.sum(eta[:, :24], axis=1), rtol=1e-6)
+
+
+def test_parallel_extraction_equals_serial(fake_fibparms):
+    rng = np.random.default_rng(3)
+    eta = np.c_[rng.uniform(100., 1000., (NX, 24)), rng.uniform(10., 20., (NX, 2))]
+    img, stripe_indices = make_fake_frame(fake_fibparms, eta, slope=True, offset=True)
+    # a second order
+    img = np.r_[img, img]
+    stripe_indices = {'order_02': stripe_indices['order_02'], 'order_03': stripe_indices['order_02'] + NY}
+    fake_fibparms['order_03'] = {fib: dict(parms, mu_fit=parms['mu_fit'] + NY) for fib, parms in fake_fibparms['order_02'].items()}
+    err_img = np.sqrt(np.abs(img) + 9.)
+
+    results = {}
+    for nproc in [1, 2]:
+        results[nproc] = extraction.optimal_extraction_from_indices(img, stripe_indices, err_img=err_img, RON=3. * np.ones(img.shape),
+                                                                    slit_height=SLIT_HEIGHT, slope=True, offset=True, nproc=nproc,
+                                                                    return_arrays=True)
+    for serial, parallel in zip(results[1][3:], results[2][3:]):
+        assert np.array_equal(serial, parallel)
+    assert results[2][0] == results[1][0]
+
+
+@pytest.mark.parametrize('batched', [True, False])
+def test_collapse_returns_arrays(fake_fibparms, batched):
+    rng = np.random.default_rng(4)
+    eta = rng.uniform(100., 1000., (NX, 24))
+    img, stripe_indices = make_fake_frame(fake_fibparms, eta)
+    err_img = np.sqrt(np.abs(img) + 9.)
+
+    # 'collapse' always uses the per-column loop, whatever 'batched' says
+    pix, flux, err, pixarr, fluxarr, errarr, addarr, adderrarr = extraction.optimal_extraction_from_indices(
+        img, stripe_indices, err_img=err_img, RON=3. * np.ones(img.shape), slit_height=SLIT_HEIGHT, collapse=True,
+        batched=batched, return_arrays=True)
+
+    sc, sr = flatten_single_stripe_from_indices(img, stripe_indices['order_02'], slit_height=SLIT_HEIGHT)
+    assert fluxarr.shape == (1, NX)
+    assert errarr.shape == (1, NX)
+    assert np.allclose(fluxarr[0], np.sum(sc, axis=0))
+    assert np.allclose(flux['order_02'], fluxarr[0])
+    assert len(pix['order_02']) == NX
+    assert addarr is None
+
+
+def test_extract_spectrum_per_column(fake_fibparms):
+    rng = np.random.default_rng(5)
+    eta = rng.uniform(100., 1000., (NX, 24))
+    img, stripe_indices = make_fake_frame(fake_fibparms, eta)
+    err_img = np.sqrt(np.abs(img) + 9.)
+    pix, flux, err = extraction.extract_spectrum_from_indices(img, err_img, stripe_indices, method='optimal', slit_height=SLIT_HEIGHT,
+                                                              RON=3. * np.ones(img.shape), batched=False)
+    assert np.allclose(flux['order_02']['fibre_01'], eta[:, 0], rtol=1e-6)
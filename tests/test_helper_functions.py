@@ -0,0 +1,196 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.modeling import models
+from scipy.integrate import fixed_quad, quad
+
+import helper_functions
+from helper_functions import eval_poly_surface_2D_grid, fibmodel, fibmodel_integrated, get_cache_key, make_norm_profiles_5, make_norm_profiles_for_order, \
+    make_norm_profiles_for_order_cached, polyfit2d, polyfit2d_normal, polyval2d, polyval2d_grid, run_cached
+
+
+def make_fake_step(ncalls):
+    def fake_step(filename, scale=1.):
+        ncalls.append(filename)
+        P_id = {'order_01': np.poly1d([1e-4, 0.5, 10.]), 'order_02': np.poly1d([2e-4, 0.4, 60.])}
+        mask = np.ones((2, 5), dtype=bool)
+        return np.loadtxt(filename) * scale, (P_id, mask), {'nbad': 3, 'note': None}
+    return fake_step
+
+
+def test_run_cached_roundtrip(tmp_path):
+    filename = str(tmp_path / 'input.txt')
+    np.savetxt(filename, np.arange(6.))
+    ncalls = []
+    fake_step = make_fake_step(ncalls)
+
+    result = run_cached(fake_step, args=(filename,), kwargs=dict(scale=2.), cachedir=str(tmp_path / 'cache'))
+    cached = run_cached(fake_step, args=(filename,), kwargs=dict(scale=2.), cachedir=str(tmp_path / 'cache'))
+    assert len(ncalls) == 1
+    assert np.array_equal(cached[0], result[0])
+    P_id, mask = cached[1]
+    assert isinstance(P_id['order_01'], np.poly1d)
+    assert P_id['order_02'] == result[1][0]['order_02']
+    assert np.array_equal(mask, result[1][1]) and mask.dtype == bool
+    assert cached[2] == {'nbad': 3, 'note': None}
+    # the cache files can be read without pickling
+    cachefile = [f for f in os.listdir(str(tmp_path / 'cache')) if f.endswith('.npz')][0]
+    with np.load(str(tmp_path / 'cache' / cachefile), allow_pickle=False) as npz:
+        assert 'structure' in npz.files
+
+    # different parameters
+    run_cached(fake_step, args=(filename,), kwargs=dict(scale=3.), cachedir=str(tmp_path / 'cache'))
+    assert len(ncalls) == 2
+
+
+def test_cache_key_depends_on_file_contents(tmp_path):
+    filename = str(tmp_path / 'input.txt')
+    with open(filename, 'w') as f:
+        f.write('abc')
+    mtime = os.stat(filename).st_mtime_ns
+    key = get_cache_key(filename)
+    # same name, size and modification time, but different contents
+    with open(filename, 'w') as f:
+        f.write('abd')
+    os.utime(filename, ns=(mtime, mtime))
+    helper_functions.file_hash_cache.clear()
+    assert get_cache_key(filename) != key
+
+
+def test_run_cached_does_not_cache_unsupported_results(tmp_path):
+    ncalls = []
+    def unsupported_step():
+        ncalls.append(1)
+        return object()
+    run_cached(unsupported_step, cachedir=str(tmp_path))
+    run_cached(unsupported_step, cachedir=str(tmp_path))
+    assert len(ncalls) == 2
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_polyfit2d_normal_matches_polyfit2d():
+    rng = np.random.default_rng(2)
+    x = rng.uniform(-1., 1., 5000)
+    y = rng.uniform(-1., 1., 5000)
+    z = 100. + 3.*x - 2.*y + 0.5*x*y**2 - x**3 + rng.normal(0., 0.1, len(x))
+    m, res = polyfit2d(x, y, z, order=3, return_res=True)
+    # several chunks, the last one incomplete
+    m_normal, res_normal = polyfit2d_normal(x, y, z, order=3, chunksize=1234, return_res=True)
+    assert np.allclose(m_normal, m, rtol=0, atol=1e-9)
+    assert np.allclose(res_normal, res, rtol=1e-6)
+    # equal weights do not change the result
+    assert np.allclose(polyfit2d_normal(x, y, z, order=3, weights=np.full(len(x), 4.)), m, rtol=0, atol=1e-9)
+    # integer weights are the same as repeating the points
+    w = rng.integers(1, 4, len(x))
+    m_weighted = polyfit2d_normal(x, y, z, order=3, weights=w)
+    assert np.allclose(m_weighted, polyfit2d(np.repeat(x, w), np.repeat(y, w), np.repeat(z, w), order=3), rtol=0, atol=1e-9)
+
+
+def make_fake_fppo(nx=30):
+    """fibre profile parameters of 24 fibres for one order (in explicit form, as for "make_norm_profiles_5")"""
+    return {'fibre_' + str(k + 1).zfill(2): {'mu_fit': np.repeat(12. + 2.2 * (23 - k), nx) + np.linspace(0., 0.5, nx),
+                                             'sigma_fit': np.repeat(0.8, nx), 'beta_fit': np.repeat(2., nx)} for k in range(24)}
+
+
+@pytest.mark.parametrize('slope,offset', [(False, False), (True, True)])
+@pytest.mark.parametrize('integrate', [False, True])
+def test_norm_profiles_for_order_match_per_column(slope, offset, integrate):
+    fppo = make_fake_fppo()
+    sr = 5 + np.arange(60)[:, np.newaxis] + np.zeros(30, dtype=int)
+    cols = np.arange(3, 27)
+    phinorm = make_norm_profiles_for_order(sr, cols, fppo, integrate=integrate, fibs='all', slope=slope, offset=offset)
+    for i, col in enumerate(cols):
+        assert np.allclose(phinorm[i], make_norm_profiles_5(sr[:, col], col, fppo, integrate=integrate, fibs='all', slope=slope,
+                                                            offset=offset))
+
+
+def test_norm_profiles_cache_hit_and_invalidation(tmp_path, monkeypatch):
+    fppo = make_fake_fppo()
+    sr = 5 + np.arange(60)[:, np.newaxis] + np.zeros(30, dtype=int)
+    cols = np.arange(30)
+    cachedir = str(tmp_path / 'phi_cache')
+    ncalls = []
+    def counting_make_norm_profiles_for_order(*args, **kwargs):
+        ncalls.append(1)
+        return make_norm_profiles_for_order(*args, **kwargs)
+    monkeypatch.setattr(helper_functions, 'make_norm_profiles_for_order', counting_make_norm_profiles_for_order)
+    def get_phi(sr=sr, cols=cols, fibparms_hash='abc', **kwargs):
+        return make_norm_profiles_for_order_cached(sr, cols, fppo, cachedir, fibparms_hash, 'order_02', slit_height=30, **kwargs)
+
+    phi = get_phi()
+    assert np.array_equal(phi, make_norm_profiles_for_order(sr, cols, fppo))
+    # cache hit
+    assert np.array_equal(get_phi(), phi)
+    assert len(ncalls) == 1
+    # the cached profiles are read-only
+    with pytest.raises(ValueError):
+        phi[0, 0, 0] = 1.
+    # no temporary files are left behind
+    assert all(fn.startswith('phi_order_02_') and fn.endswith('.npy') and not fn.endswith('.tmp.npy') for fn in os.listdir(cachedir))
+
+    # anything that changes the profiles invalidates the cache
+    assert np.array_equal(get_phi(fibparms_hash='def'), phi)
+    assert len(ncalls) == 2
+    assert np.array_equal(get_phi(sr=sr + 1), make_norm_profiles_for_order(sr + 1, cols, fppo))
+    assert len(ncalls) == 3
+    assert np.array_equal(get_phi(cols=cols[1:]), phi[1:])
+    assert len(ncalls) == 4
+    assert np.array_equal(get_phi(slope=True), make_norm_profiles_for_order(sr, cols, fppo, slope=True))
+    assert len(ncalls) == 5
+    assert np.array_equal(get_phi(integrate=True), make_norm_profiles_for_order(sr, cols, fppo, integrate=True))
+    assert len(ncalls) == 6
+    assert np.array_equal(get_phi(fibs='all'), make_norm_profiles_for_order(sr, cols, fppo, fibs='all'))
+    assert len(ncalls) == 7
+    assert len(os.listdir(cachedir)) == 7
+
+
+@pytest.mark.parametrize('beta', [2., 1.7, 2.6])
+def test_fibmodel_integrated_matches_quadrature(beta):
+    x = np.arange(20.)
+    mu, sigma = 9.3, 1.2
+    phi = fibmodel_integrated(x, mu, sigma, beta=beta)
+    # the loop that was replaced
+    phi_fixed_quad = np.array([fixed_quad(fibmodel, xi - 0.5, xi + 0.5, args=(mu, sigma, beta))[0] for xi in x])
+    # and the exact integrals
+    phi_quad = np.array([quad(fibmodel, xi - 0.5, xi + 0.5, args=(mu, sigma, beta), epsabs=1e-13, epsrel=1e-13)[0] for xi in x])
+    if beta == 2.:
+        # closed form
+        assert np.allclose(phi, phi_quad, rtol=1e-10, atol=1e-14)
+    else:
+        assert np.allclose(phi, phi_fixed_quad, rtol=1e-12, atol=1e-15)
+        assert np.allclose(phi, phi_quad, rtol=1e-3, atol=1e-4)
+
+
+def test_fibmodel_integrated_broadcasts():
+    x = np.arange(15.)[np.newaxis, :, np.newaxis]
+    mu = np.array([[5., 7.2], [6.1, 8.]])[:, np.newaxis, :]
+    sigma = np.array([[0.9, 1.1], [1., 1.3]])[:, np.newaxis, :]
+    beta = np.array([[2., 2.4], [1.8, 2.]])[:, np.newaxis, :]
+    phi = fibmodel_integrated(x, mu, sigma, beta=beta)
+    assert phi.shape == (2, 15, 2)
+    for i in range(2):
+        for k in range(2):
+            assert np.allclose(phi[i, :, k], fibmodel_integrated(x[0, :, 0], mu[i, 0, k], sigma[i, 0, k], beta=beta[i, 0, k]))
+
+
+def test_polyval2d_grid_matches_meshgrid():
+    rng = np.random.default_rng(6)
+    x = np.linspace(-1., 1., 37)
+    y = np.linspace(-1., 1., 23)
+    m = rng.normal(size=(4 + 1)**2)
+    z = polyval2d_grid(x, y, m)
+    assert z.shape == (len(y), len(x))
+    assert np.allclose(z, polyval2d(*np.meshgrid(x, y), m), rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('model', [models.Polynomial2D(3), models.Chebyshev2D(4, 2), models.Legendre2D(2, 5),
+                                   models.Chebyshev2D(3, 3, x_domain=[0, 36], y_domain=[-5, 17])])
+def test_eval_poly_surface_2D_grid_matches_meshgrid(model):
+    rng = np.random.default_rng(7)
+    model.parameters = rng.normal(size=len(model.parameters))
+    x = np.linspace(0., 36., 37)
+    y = np.linspace(-5., 17., 23)
+    z = eval_poly_surface_2D_grid(model, x, y)
+    assert z.shape == (len(y), len(x))
+    assert np.allclose(z, model(*np.meshgrid(x, y)), rtol=1e-12, atol=1e-12)
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from scipy.linalg import solveh_banded
+
+from linalg import linalg_extract_column, linalg_extract_order, solve_banded_batched
+
+
+NCOL, NROW, NFIB = 40, 60, 19
+
+
+def make_fake_column_data(nextra=0, seed=3):
+    """cutouts with (compact) fibre profiles that only overlap with their nearest neighbours, plus optional slope / offset terms"""
+    rng = np.random.default_rng(seed)
+    rows = np.arange(NROW)
+    PHI = np.zeros((NCOL, NROW, NFIB + nextra))
+    for i in range(NCOL):
+        for k in range(NFIB):
+            mu = 5. + 2.7*k + 0.02*i
+            prof = np.exp(-0.5 * ((rows - mu) / 1.1)**2)
+            # the profiles are exactly zero beyond 4 pixels from the centre, ie each fibre only overlaps with its neighbours
+            prof[np.abs(rows - mu) > 4.] = 0.
+            PHI[i, :, k] = prof / np.sum(prof)
+    if nextra > 0:
+        PHI[:, :, NFIB] = 1. / NROW
+    if nextra > 1:
+        PHI[:, :, NFIB + 1] = (rows - rows[0]) / np.sum(rows - rows[0])
+    eta_true = rng.uniform(100., 1000., (NCOL, NFIB + nextra))
+    Z = np.sum(PHI * eta_true[:, np.newaxis, :], axis=2) + rng.normal(0., 3., (NCOL, NROW))
+    W = 1. / (np.abs(Z) + 3.3**2)
+    return Z, W, PHI
+
+
+@pytest.mark.parametrize('nextra', [0, 1, 2])
+@pytest.mark.parametrize('altvar', [True, False])
+def test_banded_matches_dense_and_per_column(nextra, altvar):
+    Z, W, PHI = make_fake_column_data(nextra=nextra)
+    eta_dense, var_dense = linalg_extract_order(Z, W, PHI, RON=3.3, altvar=altvar, solver='dense')
+    eta_banded, var_banded = linalg_extract_order(Z, W, PHI, RON=3.3, altvar=altvar, solver='banded', bandwidth=3, nextra=nextra)
+    assert np.allclose(eta_banded, eta_dense, rtol=1e-9, atol=1e-9)
+    assert np.allclose(var_banded, var_dense, rtol=1e-9, atol=1e-9)
+    # and the same as the original column-by-column extraction
+    for i in range(NCOL):
+        eta, var = linalg_extract_column(Z[i], W[i], PHI[i], RON=3.3, altvar=altvar)
+        assert np.allclose(eta_banded[i], eta, rtol=1e-8, atol=1e-8)
+        assert np.allclose(var_banded[i], var, rtol=1e-8, atol=1e-8)
+
+
+def test_solve_banded_batched_matches_solveh_banded():
+    rng = np.random.default_rng(4)
+    n, m, bw = 7, 12, 2
+    # symmetric, diagonally dominant (hence positive definite) banded matrices in lower band storage, ie ab[i,d,j] = A[i,j+d,j]
+    ab = rng.uniform(-1., 1., (n, bw+1, m))
+    ab[:, 0, :] = 2.*bw + 1.
+    for d in range(1, bw+1):
+        ab[:, d, m-d:] = 0.
+    b = rng.normal(size=(n, m, 3))
+    x = solve_banded_batched(ab, b)
+    for i in range(n):
+        assert np.allclose(x[i], solveh_banded(ab[i], b[i], lower=True))
@@ -0,0 +1,153 @@
+import os
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+import order_tracing
+from order_tracing import extract_stripes, flatten_single_stripe_from_indices, get_stripe_start_rows, make_slowmask, \
+    make_stripe_geometry, refine_stripes, trace_orders
+
+
+NY, NX = 300, 200
+SLIT_HEIGHT = 10
+
+
+def make_fake_P_id():
+    return {'order_01': np.poly1d([2e-4, -0.04, 3.3]),          # cut off at the bottom of the chip
+            'order_02': np.poly1d([0.25, 40.]),                  # integer values at every 4th column
+            'order_03': np.poly1d([150.]),                       # integer everywhere, ie 2*slit_height+1 rows in the window
+            'order_04': np.poly1d([-1e-4, 0.05, 170.123]),
+            'order_05': np.poly1d([0.13, 270.7]),                # cut off at the top of the chip
+            'order_06': np.poly1d([-0.3, 15.5])}                 # partly completely off the chip at the bottom
+
+
+def test_stripe_geometry_matches_extract_stripes():
+    rng = np.random.default_rng(5)
+    img = rng.uniform(1., 2., (NY, NX))
+    P_id = make_fake_P_id()
+    stripes, stripe_indices = extract_stripes(img, P_id, slit_height=SLIT_HEIGHT)
+    stripe_geometry = make_stripe_geometry(P_id, NX, slit_height=SLIT_HEIGHT)
+    for ord in sorted(P_id.keys()):
+        old_start_rows = get_stripe_start_rows(stripe_indices[ord], slit_height=SLIT_HEIGHT)
+        assert np.array_equal(stripe_geometry[ord], old_start_rows)
+        sc, sr = flatten_single_stripe_from_indices(img, stripe_geometry[ord], slit_height=SLIT_HEIGHT)
+        old_sc, old_sr = flatten_single_stripe_from_indices(img, stripe_indices[ord], slit_height=SLIT_HEIGHT)
+        assert np.array_equal(sc, old_sc)
+        assert np.array_equal(sr, old_sr)
+
+
+def test_stripe_geometry_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(order_tracing, 'stripe_geometry_cache', {})
+    P_id = make_fake_P_id()
+    # the cache directory does not exist yet
+    cachedir = str(tmp_path / 'cache')
+    stripe_geometry = order_tracing.get_stripe_geometry(P_id, NX, slit_height=SLIT_HEIGHT, cachedir=cachedir)
+    new_stripe_geometry = make_stripe_geometry(P_id, NX, slit_height=SLIT_HEIGHT)
+    assert sorted(stripe_geometry.keys()) == sorted(new_stripe_geometry.keys())
+    for ord in P_id.keys():
+        assert np.array_equal(stripe_geometry[ord], new_stripe_geometry[ord])
+    # no temporary files are left behind
+    cachefiles = os.listdir(cachedir)
+    assert len(cachefiles) == 1 and cachefiles[0].startswith('stripe_geometry_') and cachefiles[0].endswith('.npz')
+    
+    # the callers cannot change the cached entry
+    with pytest.raises(ValueError):
+        stripe_geometry['order_02'][0] = -1
+    del stripe_geometry['order_01']
+    assert 'order_01' in order_tracing.get_stripe_geometry(P_id, NX, slit_height=SLIT_HEIGHT, cachedir=cachedir)
+    
+    # read back from disk in a new session
+    monkeypatch.setattr(order_tracing, 'stripe_geometry_cache', {})
+    monkeypatch.setattr(order_tracing, 'make_stripe_geometry', None)
+    stripe_geometry = order_tracing.get_stripe_geometry(P_id, NX, slit_height=SLIT_HEIGHT, cachedir=cachedir)
+    for ord in P_id.keys():
+        assert np.array_equal(stripe_geometry[ord], new_stripe_geometry[ord])
+
+
+def test_slowmask_edges():
+    # more rows than columns, so that the first/last row and the first/last column are easy to tell apart
+    ny, nx = 300, 100
+    rows = np.arange(ny)[:, np.newaxis]
+    orders = np.array([np.repeat(nx - 1, nx), np.repeat(150, nx), np.repeat(ny - 1, nx), np.repeat(0, nx)])
+    flat = np.ones((ny, nx)) + np.sum([1000. * np.exp(-0.5 * ((rows - o[0]) / 0.7) ** 2) for o in orders], axis=0)
+    flat += np.random.default_rng(6).normal(0., 0.01, flat.shape)
+    mask = make_slowmask(flat, orders, cliprange=10, start_col=0)
+    # peaks in the row nx-1 are fine...
+    assert np.all(mask[0, :])
+    assert np.all(mask[1, :])
+    # ...but peaks in the first or last row of the chip are not
+    assert not np.any(mask[2, 1:])
+    assert not np.any(mask[3, 1:])
+
+
+def test_refine_stripes_keeps_previous_trace_without_peaks():
+    ny, nx = 300, 200
+    rows = np.arange(ny)[:, np.newaxis]
+    xx = np.arange(nx)
+    truth = {'order_02': np.poly1d([0.02, 60.]), 'order_03': np.poly1d([-0.01, 150.])}
+    flat = np.zeros((ny, nx))
+    for p in truth.values():
+        flat += 1000. * np.exp(-0.5 * ((rows - p(xx)) / 2.)**2)
+    # the traces from a previous night, plus an order that has no flux at all in this flat
+    P_id_prev = {'order_02': truth['order_02'] + 0.3, 'order_03': truth['order_03'] - 0.3, 'order_04': np.poly1d([0.01, 275.])}
+    P_id, mask = refine_stripes(flat, P_id_prev)
+    for o in truth.keys():
+        assert np.max(np.abs(P_id[o](xx) - truth[o](xx))) < 0.1
+        assert np.any(mask[o])
+    assert np.array_equal(P_id['order_04'].coeffs, P_id_prev['order_04'].coeffs)
+    assert not np.any(mask['order_04'])
+
+
+def old_trace_order(filtered_flat, row, maskthresh=100.):
+    """the per-order tracer (without the slowmask and the order_01 cut-off) (as previously in "find_stripes")"""
+    ny, nx = filtered_flat.shape
+    order = np.zeros(nx)
+    mask = np.ones(nx, dtype=bool)
+    column = int(nx / 2)
+    order[column] = row
+    for step in (1, -1):
+        column = int(nx / 2)
+        start_row = row
+        while (column + step < nx) and (column + step >= 0):
+            column += step
+            args = np.array(np.linspace(max(1, start_row - 1), min(start_row + 1, ny - 1), 3), dtype=int)
+            args = args[np.logical_and(args < ny, args > 0)]
+            p = filtered_flat[args, column]
+            if ~(p[0]==p[1] and p[0]==p[2]):
+                start_row = args[np.argmax(p)]
+            order[column] = start_row
+            if ((p < maskthresh).all()) or (start_row in (0,ny-1)):
+                mask[column] = False
+    return order, mask
+
+
+def test_trace_orders_matches_old_tracer():
+    ny, nx = 200, 300
+    rows = np.arange(ny)[:, np.newaxis]
+    xx = np.arange(nx)
+    traces = [np.poly1d([2e-4, -0.02, 20.]),         # bright order
+              np.poly1d([-3e-4, 0.1, 70.]),          # faint order, ie partly below maskthresh
+              np.poly1d([1e-4, 0.02, 120.]),
+              np.poly1d([0.25, 150.])]               # runs off the top of the chip
+    amps = [5000., 150., 3000., 2000.]
+    flat = np.zeros((ny, nx))
+    for p, amp in zip(traces, amps):
+        flat += amp * (1. + 0.3 * np.sin(xx / 17.)) * np.exp(-0.5 * ((rows - p(xx)) / 1.5)**2)
+    # a block without any flux, ie the tracer has to leave the rows unchanged there
+    flat[:, 250:270] = 0.
+    filtered_flat = ndimage.gaussian_filter(flat, 1.)
+    filtered_flat[:, 253:267] = 0.
+    start_rows = [int(np.round(p(nx // 2))) for p in traces]
+    # start at the maximum in the central column
+    start_rows = [r - 2 + np.argmax(filtered_flat[r-2:r+3, nx // 2]) for r in start_rows]
+
+    orders, peakflux = trace_orders(filtered_flat, start_rows)
+    mask = ~np.logical_or(peakflux < 100., np.logical_or(orders == 0, orders == ny-1))
+    for m, row in enumerate(start_rows):
+        old_order, old_mask = old_trace_order(filtered_flat, row)
+        assert np.array_equal(orders[m], old_order)
+        assert np.array_equal(mask[m], old_mask)
+    # sanity checks of the test setup
+    assert np.any(orders[3] == ny - 1)
+    assert not np.all(mask[1]) and np.any(mask[1])
@@ -19,7 +19,7 @@ import datetime
 import astropy.io.fits as pyfits
 
 from helper_functions import fibmodel_with_amp, CMB_pure_gaussian, multi_fibmodel_with_amp, CMB_multi_gaussian, offset_pseudo_gausslike
-from helper_functions import fit_poly_surface_2D, single_sigma_clip, find_nearest, gaussian_with_offset_and_slope, fibmodel_with_amp_and_offset
+from helper_functions import fit_poly_surface_2D, eval_poly_surface_2D_grid, single_sigma_clip, find_nearest, gaussian_with_offset_and_slope, fibmodel_with_amp_and_offset
 # from veloce_reduction.utils.linelists import make_gaussmask_from_linelist
 # from veloce_reduction.veloce_reduction.lfc_peaks import find_affine_transformation_matrix, divide_lfc_peaks_into_orders
 
@@ -820,8 +820,7 @@ def get_wavelength_solution_from_thorium(thflux, poly_deg=5, polytype='chebyshev
         xxn = (xx / ((len(xx)-1)/2.)) - 1.
         oo = np.arange(1,len(thflux))
         oon = ((oo-1) / ((len(thflux)-1)/2.)) - 1.   
-        X,O = np.meshgrid(xxn,oon)
-        p_wl = p(X,O)
+        p_wl = eval_poly_surface_2D_grid(p, xxn, oon)
 
     
     if timit:
@@ -1123,9 +1122,8 @@ def get_arc_dispsol(thflux, satmask=None, polytype='chebyshev', lamptype=None, d
         xxn = (xx / ((len(xx)-1)/2.)) - 1.
         oo = np.arange(1,len(thflux)+1)
         oon = ((oo-1) / ((len(thflux)-1)/2.)) - 1.   
-        X,O = np.meshgrid(xxn,oon)
-        p_air_wl = p_air(X,O)
-        p_vac_wl = p_vac(X,O)
+        p_air_wl = eval_poly_surface_2D_grid(p_air, xxn, oon)
+        p_vac_wl = eval_poly_surface_2D_grid(p_vac, xxn, oon)
         return p_air_wl, p_vac_wl
     else:
         return p_air, p_vac
@@ -1338,9 +1336,8 @@ def get_dispsol_from_known_lines(thflux, fibre=None, fitwidth=4, satmask=None, l
         xxn = (xx / ((len(xx)-1)/2.)) - 1.
         oo = np.arange(1,len(thflux)+1+1)     # note the double-adding of 1 is intentional in order to make a wl-solution for 40 orders!!!
         oon = ((oo-1) / ((40-1)/2.)) - 1.   
-        X,O = np.meshgrid(xxn,oon)
-        p_air_wl = p_air(X,O)
-        p_vac_wl = p_vac(X,O)
+        p_air_wl = eval_poly_surface_2D_grid(p_air, xxn, oon)
+        p_vac_wl = eval_poly_surface_2D_grid(p_vac, xxn, oon)
         return p_air_wl, p_vac_wl
     else:
         return p_air, p_vac